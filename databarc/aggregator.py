@@ -19,6 +19,7 @@ Several :ref:`predefined aggregation functions<prov_afuncs>` are provided in thi
 
 .. note::
 	An unbound convenience method :meth:`self.fx(bin)<Aggregator.fx>` is also provided which returns a copy of :obj:`list` *bin* of :class:`Records<databarc.schema.Record>` from which all records with ``x`` attributes equal to a flag value (from ``self.p_flags``) have been removed.
+	For :class:`~databarc.schema.Record_num` parents, it returns the values as scaled integers instead (see :attr:`Aggregator.scaled`), so that sums and means are computed at integer speed; the result then needs to be converted with :meth:`self.unscaled(x)<Aggregator.unscaled>`, as done by ``ave`` and ``rain_month``.
 
 
 .. _run_meth:
@@ -33,7 +34,48 @@ The ``run`` method of :class:`Aggregator` subclasses has the following responsib
 3. Call :meth:`~Aggregator.step` at an appropriate time. This method is a wrapper around the aggregation function ``func`` which takes care of some housekeeping.
 4. Call :meth:`~Aggregator.finish` after completing the interation over ``self.parent.records``.
 
-Since :meth:`~Aggregator.step` and :meth:`~Aggregator.finish` take care of some synchronization calls for the case when the aggregation is performed on multiple threads and :ref:`auxiliary fields<aux_fields>` are needed, it is not advisable to omit these calls, even though in principle it is possible (if the complete iteration logic is contained in ``run``).
+Since :meth:`~Aggregator.step` and :meth:`~Aggregator.finish` pass the bins on to concurrently running aggregators which need the field as :ref:`auxiliary field<aux_fields>`, it is not advisable to omit these calls, even though in principle it is possible (if the complete iteration logic is contained in ``run``).
+
+Rather than iterating over the records one by one, the ``run`` methods of :class:`Daily_aggregator` and :class:`Monthly_aggregator` compute the index of the bin of every record at once, from the :meth:`~Aggregator.timestamps` of the records as :mod:`numpy` ``datetime64`` array, and hand it to :meth:`~Aggregator.run_bins`, which takes care of points 1. to 4.: each bin is a slice of ``self.parent.records``, and intervals without records (data gaps) cost nothing, since they are never visited. This means that the :ref:`aggregation function<aggr_func>` is only called for non-empty bins (the predefined ones don't create a record for an empty bin anyway).
+
+.. _aggr_compact:
+
+Compact provenance
+------------------
+
+By default, each aggregated record is associated with each of the records it has been computed from (its :attr:`~databarc.schema.Record.binned` records) by a row of the ``record_assoc`` table, which therefore grows by about as many rows as the parent has records, for each level of aggregation, and loading the associations back takes a join per aggregated record. If :attr:`Aggregator.compact` is set, the binned records are instead stored as a :class:`~databarc.schema.Bin_range` (parent field and the timestamps of the first and last record in the bin), i.e. one small row per aggregated record::
+
+	Aggregator.compact = True
+	Daily_aggregator.run_threads(fields, DMI_daily, num_threads=4)
+
+:attr:`Record.sources <databarc.schema.Record.sources>` returns the records of either kind of provenance (:attr:`~databarc.schema.Record.binned` only those in ``record_assoc``), so that code using it (such as :ref:`auxiliary fields<aux_fields>` and the aggregation functions) works the same. For many aggregated records, the ranges are best resolved in bulk, with one query per parent field, by :meth:`Bin_range.load <databarc.schema.Bin_range.load>`.
+
+.. _aggr_incr:
+
+Incremental aggregation
+-----------------------
+
+Normally, every run of an :class:`Aggregator` creates a new :class:`~databarc.schema.Aggregate_field` from the whole history of the parent. If :attr:`Aggregator.incremental` is set, an existing :class:`~databarc.schema.Aggregate_field` of the parent with the same definition (:attr:`~databarc.schema.Aggregate_field.interval`, :attr:`~databarc.schema.Aggregate_field.func`, :attr:`~databarc.schema.Aggregate_field.zero_hour`, :attr:`~databarc.schema.Aggregate_field.zero_incl`, :attr:`~databarc.schema.Aggregate_field.postpone` and the :attr:`~databarc.schema.Field.name`, if given) is extended instead, e.g. after each import of new data::
+
+	Aggregator.incremental = True
+	Daily_aggregator.run_threads(fields, DMI_daily, num_threads=4)
+
+Since the last bin of the existing field may have been incomplete when it was aggregated, its record is deleted and recomputed: only the parent's records from the first one :attr:`~databarc.schema.Record.binned` in the last aggregated record (or its :class:`~databarc.schema.Bin_range`) onward are loaded (``self.parent.records`` then only contains these), and the binning starts with the bin of the deleted record, so that the bin boundaries (including :attr:`~databarc.schema.Aggregate_field.zero_hour` and :attr:`~databarc.schema.Aggregate_field.postpone`) are the same as for the existing records. The new records are appended to the existing field, with their :attr:`~databarc.schema.Record.sources` as usual. If no such field exists yet, a new one is created from the whole history. This also works with :ref:`aggregation in the database<aggr_sql>`, which then only reads the parent's records from the last bin onward.
+
+.. note::
+	If an aggregated field is itself the parent of another aggregation (e.g. monthly from daily values), the latter has to be extended after the former, since its last bin may contain the deleted record. Each call of :meth:`Aggregator.run_threads` is independent of earlier ones, so that this can be done repeatedly in the same process.
+
+.. _aggr_sql:
+
+Aggregation in the database
+---------------------------
+
+For plain statistics, loading every record of the parent into python is pure overhead. If :attr:`Aggregator.sql` is set and the :ref:`aggregation function<aggr_func>` is one of those in :data:`sql_funcs` (currently :func:`ave` and :func:`rain_month`), the ``run`` method instead translates the definition of the :class:`~databarc.schema.Aggregate_field` (the bins given by :attr:`~databarc.schema.Aggregate_field.interval`, :attr:`~databarc.schema.Aggregate_field.zero_hour`, :attr:`~databarc.schema.Aggregate_field.zero_incl` and :attr:`~databarc.schema.Aggregate_field.postpone`, and the parent's flag values, which are excluded as by :meth:`~Aggregator.fx`) into a single ``INSERT ... SELECT`` statement with a ``GROUP BY`` over the shifted timestamps, which is executed by the database (see :meth:`Aggregator.run_sql`)::
+
+	Aggregator.sql = True
+	Daily_aggregator.run_threads(fields, DMI_daily, num_threads=4)
+
+The aggregated records, their ``info`` counts and their :attr:`~databarc.schema.Record.binned` associations (or :ref:`ranges<aggr_compact>`) are written without the data leaving PostgreSQL; the results are the same as those of the python functions (up to floating point rounding; values for :class:`~databarc.schema.Record_int` fields are truncated, as by its validator). Fields with other aggregation functions (e.g. :func:`rain_XT` or :func:`wind_dir`), and sessions bound to other databases, are aggregated in python as before. If a field aggregated in the database is an :ref:`auxiliary field<aux_fields>` of a concurrent aggregator, its records are loaded after the statement, for the dependent aggregator to use.
 
 
 .. _aux_fields:
@@ -41,16 +83,16 @@ Since :meth:`~Aggregator.step` and :meth:`~Aggregator.finish` take care of some
 Auxiliary fields
 ----------------
 
-It is conceivable that the :ref:`aggregation function<aggr_func>` needs access to contemporary records of another :class:`~databarc.schema.Field` of the same :class:`~databarc.schema.Station`. For example, when dealing with wind direction, the value ``0`` is frequently found in conjunction with a ``0`` value in wind speed, and hence should not be taken into account when computing an average. When instantiating an :class:`Aggregator`, the keyword argument ``aux_fields`` can be specified with a list of :obj:`str` :attr:`codes<databarc.schema.Field.code>` referring to the needed fields. During intialization, the :class:`Aggregator` searches first for other previously instantiated aggregators (via :meth:`Aggregator.run_threads`) for fields with the required codes; if it does not find them, it searches the database if the :class:`Aggregate_fields<databarc.schema.Aggregate_field>` already exist there. If neither search is successful, aggregation proceeds without the auxiliary fields. 
+It is conceivable that the :ref:`aggregation function<aggr_func>` needs access to contemporary records of another :class:`~databarc.schema.Field` of the same :class:`~databarc.schema.Station`. For example, when dealing with wind direction, the value ``0`` is frequently found in conjunction with a ``0`` value in wind speed, and hence should not be taken into account when computing an average. When instantiating an :class:`Aggregator`, the keyword argument ``aux_fields`` can be specified with a list of :obj:`str` :attr:`codes<databarc.schema.Field.code>` referring to the needed fields. If the fields with the required codes are aggregated in the same call of :meth:`Aggregator.run_threads`, their bins are passed on by their aggregators; otherwise, the :class:`Aggregator` searches the database during initialization for the :class:`Aggregate_fields<databarc.schema.Aggregate_field>` of these fields, and raises an exception if it doesn't find them. 
 
 Within the :ref:`aggregation function<aggr_func>`, a dictionary is available as instance variable ``self.aux``, with the auxiliary fields' :attr:`codes<databarc.schema.Field.code>` as keys. The corresponding values are python generators whose ``next()`` method can be called upon from within the :ref:`aggregation function<aggr_func>` and yields the auxiliary field's 'bin' of values for the current aggregation interval::
 
 	auxiliary_bin = self.aux['f'].next()	# if the auxiliary field's code is 'f'
 	
-This call blocks until the needed aggregation interval is available from the auxiliary field if the fields are aggragated concurrently; if, on the other hand, a particular interval is not available (e.g., because the auxiliary field is missing data), it simply returns an empty list. See the source code for :func:`wind_dir` for a use example. 
+This call blocks until the needed aggregation interval is available from the auxiliary field if the fields are aggregated concurrently; if, on the other hand, a particular interval is not available (e.g., because the auxiliary field is missing data), it simply returns an empty list. See the source code for :func:`wind_dir` for a use example. 
 
 .. warning::
-	It is the user's responsibility to add needed auxiliary fields which do not have an associated :class:`~databarc.schema.Aggregate_field` in the database yet to a bulk aggregation operation via :meth:`Aggregator.run_threads`. This method will start interdependent aggregations concurrently and synchronize them so that all needed information is available at the right time. If, on the other hand, aggregations are performed manually one-by-one, it is only necessary to perform interdependent ones in the correct order (as long as the results are committed to the database). In above example, wind speed needs to be aggregated before wind direction since ``0`` direction values need to be eliminated on the basis of ``0`` speed values. The reason why the :class:`databarc.schema.Aggregate_field` is needed for the auxiliary field is because the temporal binning has been performed already and the bins can be made available to the aggregator for the dependent field.
+	It is the user's responsibility to add needed auxiliary fields which do not have an associated :class:`~databarc.schema.Aggregate_field` in the database yet to a bulk aggregation operation via :meth:`Aggregator.run_threads`. This method builds the graph of the dependencies between the fields of each station from the aggregation dictionary (raising an exception if it contains a cycle), and starts interdependent aggregations together, connected by bounded queues (see :attr:`Aggregator.feed_size`), or, if there are fewer threads than aggregations depending on each other, each one after the aggregations it needs. If, on the other hand, aggregations are performed manually one-by-one, it is only necessary to perform interdependent ones in the correct order (as long as the results are committed to the database). In above example, wind speed needs to be aggregated before wind direction since ``0`` direction values need to be eliminated on the basis of ``0`` speed values. The reason why the :class:`databarc.schema.Aggregate_field` is needed for the auxiliary field is because the temporal binning has been performed already and the bins can be made available to the aggregator for the dependent field.
 
 .. _aggr_dicts:
 
@@ -72,15 +114,32 @@ An :class:`Aggregator` has to be instantiated with a number of keyword arguments
 	Daily_aggregator.run_threads([f, d], aggr_dict, num_threads=2)
 	
 This example defines a dictionary containing aggregation parameters for fields with :attr:`codes<databarc.schema.Field.code>` 'f' and 'd' (wind speed and wind direction, in the `DMI <http://www.dmi.dk>`_ data). The :meth:`run_threads` class method of :class:`Aggregator` takes a list of :class:`Fields<databarc.schema.Field>` as first argument and matches their code with the corresponding entry from the aggregation dictionary (the second positional argument). Relevant keywords for the dictionary are ``type``, ``func`` and ``aux_fields``, corresponding to the keyword arguments for the :class:`Aggregator` constructor.
+
+.. _aggr_procs:
+
+Aggregation in processes
+------------------------
+
+The threads of :meth:`~Aggregator.run_threads` mostly wait for each other, since the aggregation functions hold the GIL. For the fields of many stations, :meth:`Aggregator.run_processes` shards them by station over a pool of processes; since the auxiliary fields a field may need belong to the same station, each process aggregates (and commits) one station's fields in dependency order, without synchronizing with the other processes::
+
+	Session = session()
+	fields = Session.query(Field).filter(Field.source=='DMI', Field.code.in_(DMI_daily.keys())).all()
+	Daily_aggregator.run_processes(Session, fields, DMI_daily, num_procs=6)
 """
 from types import MethodType
 from datetime import timedelta, datetime
-from sqlalchemy import not_
-from sqlalchemy.orm import object_session, joinedload
+from sqlalchemy import not_, inspect, text
+from sqlalchemy.sql import func
+from sqlalchemy.orm import object_session, joinedload, defer, undefer
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from threading import Thread, Event, current_thread
-from databarc.schema import Record, Record_int, Record_float, Field, Aggregate_field
+from Queue import Queue, Full, Empty
+from collections import OrderedDict
+from copy import deepcopy
+from databarc.schema import Record, Record_int, Record_float, Record_num, Field, Aggregate_field, Bin_range, record_assoc
 from databarc.utils import flags
+from databarc.metrics import metrics
 import numpy as np		
 import logging
 
@@ -105,6 +164,8 @@ Abstract base class for aggregation classes. The keyword arguments passed to the
 
 :keyword bool commit: whether to commit resulting :class:`~databarc.schema.Aggregate_field` to database or not
 
+:keyword dict feeds: used by :meth:`run_threads` to pass the bins of the aggregators of auxiliary fields in the same run, by :attr:`~databarc.schema.Field.code`
+
 :ivar field: field subclass 'containing' the records resulting from aggregation
 :vartype field: :class:`~databarc.schema.Aggregate_field`
 
@@ -114,13 +175,35 @@ Abstract base class for aggregation classes. The keyword arguments passed to the
 
 :ivar list p_flags: a list of :attr:`~databarc.schema.Flags.in_data` flag **values** defined for the records of the *parent* :class:`~databarc.schema.Field`, in case they are necessary for the computation of the aggregate value (e.g. as in the case of the common ``-1`` flag for a trace amount of precipitation)
 
+:ivar datetime resume: if an existing field is extended (see :attr:`incremental`), the timestamp of its last record, which is recomputed (otherwise ``None``)
+
+:ivar datetime since: if an existing field is extended, the timestamp of the first *parent* record loaded (otherwise ``None``)
+
+:ivar bool scaled: ``True`` if the *parent*'s records are :class:`~databarc.schema.Record_num` and have been loaded with their values as scaled integers (:attr:`~databarc.schema.Record_num.x_scaled`), which :meth:`fx` then returns (see :meth:`unscaled`); their :attr:`~databarc.schema.Record_num.x` is only loaded (one record at a time) if accessed
+
 .. method:: fx(bin)
 	
 	Convenience method that does::
 	
 		return [r.x for r in bin if r.x is not None and r.x not in self.p_flags]
+	
+	or the same with :attr:`~databarc.schema.Record_num.x_scaled` (and scaled flag values) if :attr:`scaled` is set.
 	"""
-	registry = {}
+	resume = since = None
+	feeds = ()
+	
+	compact = False
+	"""If ``True``, the original records (:attr:`~databarc.schema.Record.sources`) of the aggregated records are stored as :class:`~databarc.schema.Bin_range` instead of as :attr:`~databarc.schema.Record.binned` in the ``record_assoc`` table; see :ref:`compact provenance <aggr_compact>`."""
+	
+	incremental = False
+	"""If ``True``, an existing :class:`~databarc.schema.Aggregate_field` with the same definition is extended instead of creating a new one; see :ref:`incremental aggregation <aggr_incr>`."""
+	
+	sql = False
+	"""If ``True``, aggregations with a function in :data:`sql_funcs` are computed by the database (if it is PostgreSQL, and the class implements :meth:`bin_sql`) with :meth:`run_sql`; see :ref:`aggregation in the database <aggr_sql>`. Set to ``False`` on instances for which this isn't the case."""
+	
+	feed_size = 1000
+	"""Maximum number of bins an aggregator of :meth:`run_threads` may be ahead of a concurrently running aggregator which needs it as :ref:`auxiliary field<aux_fields>`, i.e. size of the queue between them."""
+	
 	def __init__(self,**kw):
 		self.log = logging.getLogger(__name__)
 		self.type = kw.pop('type')
@@ -130,6 +213,7 @@ Abstract base class for aggregation classes. The keyword arguments passed to the
 		
 		# need to be popped before handing kw to Aggregate_field constructor
 		aux = kw.pop('aux_fields',[])
+		feeds = kw.pop('feeds',{})
 		new_flags = flags(object_session(self.parent), kw.pop('flags',[]))
 
 		# this populates the new instance with default column values in case these are needed for computations
@@ -138,190 +222,339 @@ Abstract base class for aggregation classes. The keyword arguments passed to the
 				try: kw[c.name] = c.default.arg
 				except AttributeError: pass
 		
-		self.field = Aggregate_field(
-			parent = self.parent,
-			type = self.type.__name__,
-			func = self.func.__name__,
-			interval = self.interval,
-			**kw
-		)
-		self.field.flags = new_flags
+		self.field = self.__existing(kw) if self.incremental else None
+		if self.field is None:
+			self.field = Aggregate_field(
+				parent = self.parent,
+				type = self.type.__name__,
+				func = self.func.__name__,
+				interval = self.interval,
+				**kw
+			)
+			self.field.flags = new_flags
+		else:
+			self.__resume()
 		
-		# instantiate helper classes for threaded import when auxiliary fields are needed
+		# the bins of auxiliary fields, from aggregators of the same run (see run_threads) or from the database
 		if aux:
-			self.aux = dict(self.__aux(c) for c in aux)
+			self.aux = dict((c, feeds[c].bins(self)) if c in feeds else self.__aux(c) for c in aux)
 		
 		self.bin = []
 		self.p_flags = [f.value for f in self.parent.flags if f.in_data]
-		if self.p_flags:
+		session = object_session(self.parent)
+		self.sql = self.sql and self.func.__func__ in sql_funcs and session is not None and session.get_bind().dialect.name=='postgresql'
+		if self.sql and type(self).bin_sql.__func__ is Aggregator.bin_sql.__func__:
+			self.log.info('{} has no bin_sql, {} aggregated in python'.format(type(self).__name__, self.field.name))
+			self.sql = False
+		self.scaled = False if self.sql else self.__load()
+		if self.scaled:
+			p_flags = [v * 10**Record_num.scale for v in self.p_flags]
+			self.fx = lambda bin:[r.x_scaled for r in bin if r.x_scaled is not None and r.x_scaled not in p_flags]
+		elif self.p_flags:
 			self.fx = lambda bin:[r.x for r in bin if r.x is not None and r.x not in self.p_flags]
 		else:
 			self.fx = lambda bin:[r.x for r in bin if r.x is not None]
 		
-		key = (self.field.code, self.field.station_id, self.field.source)
-		if key in self.registry:
-			raise Exception('Code/station/source multiplicity ({} / {} / {}) [{name}].'.format(*key, name=self.parent.name))
-		else:
-			self.registry[key] = self
-		
 		self.log.debug('{}, {} started'.format(self.field.name,self.field.station_id))
 		
 		
 	
 	def step(self):
 		"""
-Convenience wrapper around the aggregation function *func* which can be called from subclasses' ``run`` method. It instantiates new aggregated :attr:`Records<databarc.schema.Record>`, adds the binned *parent* records to the new record's :attr:`~databarc.schema.Record.binned` attribute appends the record to *field*.
+Convenience wrapper around the aggregation function *func* which can be called from subclasses' ``run`` method. It instantiates new aggregated :attr:`Records<databarc.schema.Record>`, adds the binned *parent* records to the new record's :attr:`~databarc.schema.Record.binned` attribute (or its :attr:`~databarc.schema.Record.bin_range`, if :attr:`compact` is set) and appends the record to *field*.
 		"""
 		self.info = None
-		if self.func():
+		name = self.func.__name__
+		with metrics.time('aggregator_func_seconds', func=name):
+			done = self.func()
+		metrics.count('aggregator_records_total', len(self.bin), func=name)
+		if done:
 			y = self.type(t=self.t, x=self.x, info=self.info)
-			y.binned = self.bin[:] 						# possibly important, [:] ensures COPY
+			if self.compact and self.bin:
+				y.bin_range = Bin_range(field=self.parent, t_start=self.bin[0].t, t_end=self.bin[-1].t)
+				y.bin_range.records = self.bin[:]
+			else:
+				y.binned = self.bin[:] 						# possibly important, [:] ensures COPY
 			self.field.records.append(y)
+			# for the aggregators which need this field as auxiliary field
+			for feed in self.feeds:
+				feed.put(self.t, self.bin)
 		self.bin = []
-		# this synchronizes threads when aux_fields are present
-		try:
-			self.lock.set()
-		except AttributeError: pass
 
 			
 	def finish(self):
 		"""
 Finalization method to be called from subclasses' ``run`` method after iteration through ``self.parent.records`` is complete.
 		"""
-		# another synchronization lock for the case with aux_fields
-		try: 
-			self.done.set()
-		except AttributeError: pass
 		self.step()
+		for feed in self.feeds:
+			feed.put(None, None)
 		print '{} done'.format(self.field.name)
 		if self.commit:
 			session = object_session(self.field)
-			session.add(self.field)
-			session.commit()
+			with metrics.time('aggregator_commit_seconds'):
+				session.add(self.field)
+				session.commit()
 			print '{} committed'.format(self.field.name)
 			session.close()
 	
 	
-	def __aux(self, code):				
-		# are we running concurrently with anself aggregator?
-		# if yes, we need synchronization
+	def timestamps(self):
+		"""
+Returns the :attr:`timestamps<databarc.schema.Record.t>` of ``self.parent.records`` as ``datetime64[us]`` :class:`~numpy.ndarray`.
+		"""
+		return np.array([r.t for r in self.parent.records], 'datetime64[us]')
+	
+	def run_bins(self, k, label):
+		"""
+Aggregates ``self.parent.records`` in bins given by the :obj:`int` array *k* of bin indexes (one per record, non-decreasing), calling :meth:`step` for each non-empty bin (with ``self.bin`` set to the slice of the records in it) and :meth:`finish` at the end. The bin boundaries are found with :func:`~numpy.searchsorted`.
+
+:param k: :class:`~numpy.ndarray` with the bin index of each record
+
+:param callable label: function returning the timestamp ``self.t`` of the aggregated record for a bin index
+		"""
+		records = self.parent.records
+		u = np.unique(k)
+		a, b = np.searchsorted(k, u, 'left'), np.searchsorted(k, u, 'right')
+		for i in xrange(len(u)):
+			self.t = label(u[i])
+			self.bin = records[a[i]:b[i]]
+			if i+1<len(u):
+				self.step()
+		self.finish()
+	
+	def bin_sql(self, t):
+		"""
+Returns an SQL expression for the timestamp of the aggregated record to whose bin a record ``r`` (i.e. a row of the ``record`` table) of the *parent* belongs, together with a :obj:`dict` of the parameters it uses, for :meth:`run_sql`. Needs to be implemented by subclasses supporting :attr:`sql`; for the others, :attr:`sql` is unset on instantiation, so that they aggregate in python.
+
+:param datetime t: the timestamp of the first record of the *parent*
+		"""
+		raise NotImplementedError
+	
+	def run_sql(self):
+		"""
+Computes the aggregation in the database with a single ``INSERT ... SELECT`` statement built from :meth:`bin_sql` and the SQL expressions in :data:`sql_funcs` for *func*, and calls :meth:`finish`. Called by ``run`` if :attr:`sql` is set.
+		"""
+		session = object_session(self.parent)
+		q = session.query(func.min(Record.t), func.min(Record.type)).filter(Record.field_id==self.parent.id)
+		if self.since is not None:
+			q = q.filter(Record.t>=self.since)
+		first, type = q.one()
+		if first is not None:
+			session.add(self.field)
+			session.flush()
+			bin, params = self.bin_sql(first)
+			x, info = sql_funcs[self.func.__func__]
+			if issubclass(self.type, Record_int):
+				x = 'trunc({})'.format(x) # the Record_int validator truncates (a numeric is rounded by the INSERT)
+			ok = 'x.x IS NOT NULL AND x.x <> ALL(:flags)' if self.p_flags else 'x.x IS NOT NULL'
+			params.update(parent_id=self.parent.id, field_id=self.field.id, flags=self.p_flags, type=self.type.__mapper__.polymorphic_identity, since=self.since)
+			sql = _aggregate.format(
+				bin=bin, ok=ok, x=x, info=info, since='' if self.since is None else ' AND r.t>=:since',
+				parent=Record.__mapper__.polymorphic_map[type].local_table.name,
+				table=self.type.__table__.name,
+				provenance=_ranges if self.compact else _assoc
+			)
+			with metrics.time('aggregator_sql_seconds', func=self.func.__name__):
+				n = session.execute(text(sql), params).scalar()
+			metrics.count('aggregator_records_total', n, func=self.func.__name__)
+			if self.feeds: # an auxiliary field of other aggregators of the run
+				records = session.query(Record).options(joinedload(Record.binned))\
+					.filter(Record.field_id==self.field.id).order_by(Record.t).all()
+				Bin_range.load(records)
+				set_committed_value(self.field, 'records', records)
+				for r in records:
+					for feed in self.feeds:
+						feed.put(r.t, r.sources)
+		self.finish()
+	
+	def unscaled(self, x):
+		"""
+Converts a value computed from the output of :meth:`fx` (e.g. a sum or mean) back from scaled integers if :attr:`scaled` is set, to a :class:`~decimal.Decimal` (rounded to :attr:`~databarc.schema.Record_num.scale` decimal places) if *type* is :class:`~databarc.schema.Record_num` and to a :obj:`float` otherwise. Returns *x* unchanged if :attr:`scaled` isn't set.
+		"""
+		if not self.scaled or x is None:
+			return x
+		if issubclass(self.type, Record_num):
+			return Record_num.from_scaled(int(round(x)))
+		return x / 10.**Record_num.scale
+	
+	def __load(self):
+		# loads the records of the parent from self.since onward (if set), those of a Record_num parent 
+		# with the scaled values instead of the Decimals; returns whether they are scaled
+		session = object_session(self.parent)
+		if session is None or self.parent.id is None:
+			return False
+		if 'records' not in inspect(self.parent).unloaded:
+			if self.since is not None:
+				set_committed_value(self.parent, 'records', [r for r in self.parent.records if r.t>=self.since])
+			return False
+		scaled = session.query(Record.type).filter(Record.field_id==self.parent.id).limit(1).scalar()=='num'
+		if not scaled and self.since is None:
+			return False
+		if scaled:
+			q = session.query(Record_num).options(defer(Record_num.x), undefer(Record_num.x_scaled))
+		else:
+			q = session.query(Record)
+		q = q.filter(Record.field_id==self.parent.id)
+		if self.since is not None:
+			q = q.filter(Record.t>=self.since)
+		set_committed_value(self.parent, 'records', q.order_by(Record.t).all())
+		return scaled
+	
+	def __existing(self, kw):
+		# the Aggregate_field of the parent with the same definition, if there is one
+		session = object_session(self.parent)
+		if session is None or self.parent.id is None:
+			return None
+		q = session.query(Aggregate_field).filter_by(parent_id=self.parent.id, interval=self.interval, func=self.func.__name__)
+		q = q.filter_by(**dict((k, kw[k]) for k in ('name', 'zero_hour', 'zero_incl', 'postpone') if k in kw))
 		try:
-			aggregator = self.registry[(code, self.field.station_id, self.field.source)]
-			records = aggregator.field.records
-			try:
-				lock = aggregator.lock
-				done = aggregator.done
-			except AttributeError:
-				aggregator.lock = Event()
-				aggregator.done = Event()
-				lock = aggregator.lock
-				done = aggregator.done
-	
-			def step(i):
-				while True:
-					if (not done.is_set()) and (len(records)==0 or self.t>records[-1].t):
-						lock.clear()
-						lock.wait() # sync
-					while i+1<len(records) and records[i].t<self.t:
-						i += 1
-					yield records[i].binned if records[i].t==self.t else []
-				
-			self.log.debug('Aux {} for field {} started with running aggregator.'.format(aggregator.field.code, self.parent))
-			return code, step(0)
-					
+			return q.one()
+		except NoResultFound:
+			return None
+		except MultipleResultsFound:
+			raise Exception("Multiple aggregated fields in database to extend for field {}.".format(self.parent.name))
+	
+	def __resume(self):
+		# deletes the last record of the existing field, which is recomputed from the first of its binned records onward
+		session = object_session(self.field)
+		q = session.query(Record).filter(Record.field_id==self.field.id).order_by(Record.t.desc())
+		last = q.first()
+		if last is None:
+			return
+		self.resume = last.t
+		if last.bin_range is not None:
+			self.since = last.bin_range.t_start
+		else:
+			self.since = session.query(func.min(Record.t)).join(record_assoc, record_assoc.c.child_id==Record.id)\
+				.filter(record_assoc.c.parent_id==last.id).scalar() or last.t
+		# the record before, for functions which look at it (e.g. rain_XT)
+		prev = q.filter(Record.t<last.t).first()
+		session.delete(last)
+		session.flush() # before the recomputed record with the same timestamp is inserted
+		set_committed_value(self.field, 'records', [prev] if prev else [])
+		self.log.debug('{}, {} resumed at {}'.format(self.field.name, self.field.station_id, self.resume))
+	
+	def __aux(self, code):
+		# the needed Aggregate_field has to be in the database already
+		session = object_session(self.field.parent)
+		try:
+			aux_field = session.query(Aggregate_field).filter_by(
+				code=code, station_id=self.field.station_id, 
+				source=self.field.parent.source, 
+				interval=self.field.interval
+			).one()
+		except NoResultFound:
+			raise Exception("Auxiliary PARENT {} for field {} not available.".format(code,self.field.name))
+		except MultipleResultsFound:
+			raise Exception("Multiple results in database for Auxiliary PARENT {} for field {}.".format(code,self.field.name))
 		
-		# if we're not running concurrently, is the needed Aggregate_field it already in the DB?
-		except KeyError:
-			session = object_session(self.field.parent)
-			try:
-				aux_field = session.query(Aggregate_field).filter_by(
-					code=code, station_id=self.field.station_id, 
-					source=self.field.parent.source, 
-					interval=self.field.interval
-				).one()
-			except NoResultFound:
-				raise Exception("Auxiliary PARENT {} for field {} not available.".format(code,self.field.name))
-			except MultipleResultsFound:
-				raise Exception("Multiple results in database for Auxiliary PARENT {} for field {}.".format(code,self.field.name))
-			else:
+		# load all the records, including the bins as joinedload
+		records = session.query(Record).options(joinedload(Record.binned)).filter_by(field_id=aux_field.id).all()
+		Bin_range.load(records)
+		if not records: 
+			raise Exception("No Records located in database for Auxiliary PARENT {} for field {}.".format(code,self.field.name))
+		
+		def step(i):
+			while True:
+				while i+1<len(records) and records[i].t<self.t:
+					i += 1
+				yield records[i].sources if records[i].t==self.t else []
 		
-		# if it is, load all the records, including the bins as joinedload
-		# in this case, we don't need all the synchronization machinery
-				records = session.query(Record).options(joinedload(Record.binned)).filter_by(field_id=aux_field.id).all()
-				if not records: 
-					raise Exception("No Records located in database for Auxiliary PARENT {} for field {}.".format(code,self.field.name))
-				
-				def step(i):
-					while True:
-						while i+1<len(records) and records[i].t<self.t:
-							i += 1
-						yield records[i].binned if records[i].t==self.t else []
-				
-				self.log.debug('Aux {} for field {} started from existing aggregation.'.format(aux_field.code, self.parent))
-				return code, step(0)
+		self.log.debug('Aux {} for field {} started from existing aggregation.'.format(aux_field.code, self.parent))
+		return code, step(0)
 	
 	
 	
 	@classmethod
 	def run_threads(cls, fields, aggr_dict, num_threads=1, **kw):
 		"""
-Helper method to perform aggregations concurrently on *num_threads* :class:`Threads<threading.Thread>`.
+Helper method to perform aggregations concurrently on *num_threads* :class:`Threads<threading.Thread>`. The :ref:`auxiliary fields<aux_fields>` of *aggr_dict* define a dependency graph between the *fields* of each station, which mustn't contain cycles. Interdependent aggregations (up to *num_threads* of them) are started together, and an aggregator passes its bins to those which need them through queues of :attr:`feed_size`; if there are more of them, an aggregation is only started when those of its auxiliary fields are finished. If an aggregation fails, the aggregations which need it fail as well; the others continue. On :exc:`KeyboardInterrupt`, no further aggregations are started and the running ones are finished.
+
+:param list fields: list of :class:`~databarc.schema.Field` objects whose records should be aggregated, at most one per :attr:`~databarc.schema.Field.code`, :attr:`~databarc.schema.Field.station_id` and :attr:`~databarc.schema.Field.source`
+
+:param dict aggr_dict: :ref:`dictionary<aggr_dict>` describing the field-dependent aggregation parameters
+
+:return: a :obj:`list` of the resulting :class:`Aggregate_fields<databarc.schema.Aggregate_field>` of the successful aggregations, auxiliary fields first
+		"""
+		return _Scheduler(fields, aggr_dict).run(cls, num_threads, kw)
+	
+	@classmethod
+	def run_processes(cls, session, fields, aggr_dict, num_procs=None, **kw):
+		"""
+Performs the aggregations of *fields* of many stations on *num_procs* :class:`processes <multiprocessing.Process>`, which, unlike the threads of :meth:`run_threads`, aren't serialized by the :pydoc:`GIL <glossary.html#term-global-interpreter-lock>`. The fields are sharded by :attr:`~databarc.schema.Field.station_id`: each process takes one station at a time and aggregates its fields one after the other, with :ref:`auxiliary fields<aux_fields>` before the fields which need them (as :meth:`run_threads` does), so that all dependencies stay within a process. Each process has its own database connections, and each aggregation is committed when it is finished, hence auxiliary fields are taken from the database (the *commit* keyword is ignored).
+
+The :mod:`~databarc.metrics` recorded in the processes are merged into the :data:`~databarc.metrics.metrics` registry of the calling process.
+
+:param session: the SQLAlchemy session (or :class:`~sqla:sqlalchemy.orm.scoping.scoped_session`) *fields* are attached to, which is used by the processes; it is closed and its engine's connection pool disposed of before the processes are started, so that no connection is shared between processes
 
 :param list fields: list of :class:`~databarc.schema.Field` objects whose records should be aggregated
 
 :param dict aggr_dict: :ref:`dictionary<aggr_dict>` describing the field-dependent aggregation parameters
+
+:param int num_procs: number of processes (by default, the number of CPUs)
+
+:return: a :obj:`list` with, for each field, the :attr:`~databarc.schema.Field.id` of the resulting :class:`~databarc.schema.Aggregate_field`, the exception (as :obj:`str`) that stopped the aggregation, or ``None`` if *aggr_dict* has no entry for the field's :attr:`~databarc.schema.Field.code`
+
+:Example:
+
+::
+	
+	from databarc.schema import Field, session
+	from databarc.aggregator import Daily_aggregator, DMI_daily
+	
+	Session = session()
+	fields = Session.query(Field).filter(Field.source=='DMI', Field.code.in_(DMI_daily.keys())).all()
+	Daily_aggregator.run_processes(Session, fields, DMI_daily)
 		"""
-		from Queue import Queue, Empty
-		from copy import deepcopy
-		from collections import OrderedDict
+		import multiprocessing as mp
+		from Queue import Empty
+		log = logging.getLogger(__name__)
 		
-		# sort fields such that dependent fields are initialized after auxiliary ones
-		def asort(codes):
-			d = OrderedDict()
-			for c in codes:
-				try: 
-					e = asort(aggr_dict[c]['aux_fields'])
-					e.update(d)
-					d = e	
-				except KeyError: pass
-				d[c] = deepcopy(aggr_dict[c])
-			return d
+		# the dependency order of run_threads, by station
+		schedule = _Scheduler(fields, aggr_dict)
+		index = dict(((f.code, f.station_id, f.source), i) for i,f in enumerate(fields))
+		stations = OrderedDict()
+		for k in schedule.order:
+			stations.setdefault(k[1], []).append((index[k], schedule.fields[k].id, k[0]))
+		tasks, results = mp.Queue(), mp.Queue()
+		for s in stations.itervalues():
+			tasks.put(s)
 		
-		# just to be on the safe side with respect to threading, all aggregators are
-		# instantiated on the main thread and added to the queue, and hence the registry, in order
-		q = Queue()
-		s = asort(f.code for f in fields)
-		for c,d in s.iteritems():
-			d.update(kw)
-			try: q.put(cls(parent=[f for f in fields if f.code==c][0], **d))
-			except IndexError: pass
+		session.close()
+		session.get_bind().dispose()
 		
-		stopped = Event()
+		procs = [mp.Process(target=_aggregate_stations, args=(cls, session, aggr_dict, kw, tasks, results)) 
+			for n in xrange(min(num_procs or mp.cpu_count(), len(stations)))]
+		for p in procs:
+			p.daemon = True
+			p.start()
+			tasks.put(None)
 		
-		def worker():
-			while not stopped.is_set():
-				try:
-					a = q.get_nowait()
+		out = [None] * len(fields)
+		pending = set(i for i,f in enumerate(fields) if f.code in aggr_dict)
+		try:
+			while pending:
+				try: msg = results.get(timeout=1)
 				except Empty:
-					stopped.wait(1) 
+					if not any(p.is_alive() for p in procs):
+						for i in pending:
+							out[i] = 'aggregation process died'
+						break
+					continue
+				if msg[0]=='metrics':
+					metrics.merge(msg[1])
 				else:
-					a.run()
-					q.task_done()
-		
-		for n in xrange(min(num_threads,len(cls.registry))):
-			thread = Thread(target=worker)
-			thread.setDaemon(True)
-			thread.start()
-		
-		try:
-			while not q.empty():
-				stopped.wait(1)
+					out[msg[1]] = msg[2]
+					pending.discard(msg[1])
 		except KeyboardInterrupt:
-			stopped.set()
-			q = Queue()
-		
-		q.join()
-		return [a.field for a in cls.registry.values()]
+			for p in procs:
+				p.terminate()
+			raise
+		for p in procs:
+			p.join()
+		log.info('{} of {} fields aggregated'.format(sum(isinstance(x, (int, long)) for x in out), len(fields)))
+		return out
 		
 		
 
@@ -330,26 +563,33 @@ class Daily_aggregator(Aggregator):
 	interval = 'day'
 	
 	def run(self):
-		if self.field.zero_incl:
-			self.cmp = lambda x,y:x<y+timedelta(days=1)+self.field.postpone
-		else: 
-			if hasattr(self.field,'postpone') and self.field.postpone!=timedelta(0):
-				self.cmp = lambda x,y:x<y+self.field.postpone
-			else: self.cmp = lambda x,y:x<=y
-		t = self.parent.records[0].t
-		s = np.sign(t.hour-self.field.zero_hour)
+		if self.sql:
+			return self.run_sql()
+		t = self.timestamps()
+		if not len(t):
+			return self.finish()
+		off, t0 = self.__offset(), self.resume or self.__start(self.parent.records[0].t)
+		d, day = (t - np.datetime64(t0+off, 'us')).astype(np.int64), 86400 * 10**6
+		k = d // day + 1 if off else -(-d // day)
+		# records before the first day go into it
+		self.run_bins(np.maximum(k, 0), lambda k: t0+timedelta(days=int(k)))
+	
+	def bin_sql(self, t):
+		# the first day at zero_hour which is later than r.t-off (or not earlier than r.t), i.e. as in run
+		off = self.__offset() or timedelta(microseconds=1)
+		h = timedelta(hours=self.field.zero_hour)
+		return "greatest(date_trunc('day', r.t - :shift) + :after, :start)", {'shift': off+h, 'after': h+timedelta(days=1), 'start': self.resume or self.__start(t)}
+	
+	def __offset(self):
+		# a record belongs to the first day (self.t) for which r.t<self.t+off (or r.t<=self.t if there's no offset)
+		postpone = getattr(self.field, 'postpone', None) or timedelta(0)
+		return timedelta(days=1)+postpone if self.field.zero_incl else postpone
+	
+	def __start(self, r):
+		# the first day, from the first timestamp
+		s = np.sign(r.hour-self.field.zero_hour)
 		s = s * int(self.field.zero_incl) if s<0 else s*(1-int(self.field.zero_incl))
-		self.t = datetime(t.year,t.month,t.day,self.field.zero_hour) + timedelta(days=s)
-		
-		for r in self.parent.records:
-			if self.cmp(r.t,self.t):
-				self.bin.append(r)
-			else:
-				while not self.cmp(r.t,self.t):
-					self.step()	
-					self.t += timedelta(days=1)
-				self.bin = [r]
-		self.finish()	
+		return datetime(r.year,r.month,r.day,self.field.zero_hour) + timedelta(days=s)
 		
 
 
@@ -357,20 +597,29 @@ class Monthly_aggregator(Aggregator):
 	interval = 'month'
 	
 	def run(self):
-		t = self.parent.records[0].t
-		self.t = datetime(t.year,t.month,1)
-		for r in self.parent.records:
-			if r.t.month==self.t.month and r.t.year==self.t.year:
-				self.bin.append(r)
-			else: 
-				if r.t.day==1 and not self.field.zero_incl:	# zero_incl==False implies aggregation
-					self.bin.append(r)						# over the previous 24h, i.e. value at 6 UTC
-					self.step()							# contains 18h accumulation from previous day
-				else:
-					self.step()	
-					self.bin = [r]
-				self.t = datetime(r.t.year,r.t.month,1)
-		self.finish()	
+		if self.sql:
+			return self.run_sql()
+		t = self.timestamps()
+		if not len(t):
+			return self.finish()
+		m = t.astype('datetime64[M]')
+		k = m.astype(np.int64)
+		if not self.field.zero_incl:	# zero_incl==False implies aggregation over the previous 24h, i.e. value at 6 UTC
+			# contains 18h accumulation from previous day: the first record of a month goes into the bin
+			# of the record before it if it is on the 1st (when resuming, the first one is in the resumed bin)
+			p = np.r_[k[:1] if self.resume is None else np.datetime64(self.resume, 'M').astype(np.int64), k[:-1]]
+			i = np.flatnonzero(k!=p)
+			i = i[(t[i] - m[i]) < np.timedelta64(1, 'D')]
+			k[i] = p[i]
+		self.run_bins(k, lambda k: np.datetime64(int(k), 'M').astype('datetime64[us]').astype(datetime))
+	
+	def bin_sql(self, t):
+		m = "date_trunc('month', r.t)"
+		if self.field.zero_incl:
+			return m, {}
+		# as in run, the first record of a month goes into the month of the record before it if it is on the 1st
+		p = "date_trunc('month', coalesce(lag(r.t) OVER (ORDER BY r.t), :resume))"
+		return "CASE WHEN r.t < {m} + interval '1 day' AND {m} <> {p} THEN {p} ELSE {m} END".format(m=m, p=p), {'resume': self.resume}
 
 	
 	
@@ -425,7 +674,7 @@ otherwise binning starts too early the previous day (>6 UTC instead >=12)
 			x += r.x
 			t = r.t-dt
 	if check_start:
-		try: r = self.field.records[-1].binned[-1]
+		try: r = self.field.records[-1].sources[-1]
 		except: pass
 		else:
 			if r.t-dt==t and r.x<=x: 
@@ -445,7 +694,7 @@ def rain_month(self):
 			self.x = len(self.bin) # since every trace value <= .1 mm and scaling = x10
 			return True
 		else: return False
-	self.x = sum(x)
+	self.x = self.unscaled(sum(x))
 	self.info = len(self.bin)
 	return True
 
@@ -457,7 +706,7 @@ def ave(self):
 			self.info = 0
 			return True
 		else: return False
-	self.x = np.mean(x)
+	self.x = self.unscaled(np.mean(x))
 	self.info = len(x)
 	return True
 	
@@ -491,6 +740,219 @@ def wind_dir(self):
 
 
 
+def _aggregate_stations(cls, session, aggr_dict, kw, tasks, results):
+	# aggregation process: aggregates the fields (index, id, code) of one station at a time, in order,
+	# and sends ('done', index, aggregate field id or error) for each, and the metrics recorded
+	log = logging.getLogger(__name__)
+	metrics.reset() # copied from the parent
+	for fields in iter(tasks.get, None):
+		for i, id, code in fields:
+			try:
+				d = deepcopy(aggr_dict[code])
+				d.update(kw, commit=True)
+				a = cls(parent=session.query(Field).get(id), **d)
+				a.run()
+				result = a.field.id
+			except Exception as e:
+				log.exception('aggregation of field {} failed'.format(id))
+				session.rollback()
+				result = '{}: {}'.format(e.__class__.__name__, e)
+			session.close()
+			results.put(('metrics', metrics.snapshot(reset=True)))
+			results.put(('done', i, result))
+
+class _Feed(object):
+	# the bins of an aggregator for one aggregator which needs it as auxiliary field, as (t, records) in the
+	# order of t and ended by (None, None), or (None, error) if the aggregation failed; maxsize 0 is unbounded
+	def __init__(self, code, maxsize=0):
+		self.code = code
+		self.queue = Queue(maxsize)
+		self.closed = Event() # set when the dependent aggregator doesn't read anymore
+	
+	def put(self, t, records):
+		while not self.closed.is_set():
+			try: return self.queue.put((t, records), timeout=1)
+			except Full: pass
+	
+	def bins(self, aggregator):
+		# yields the records binned at aggregator.t, or [] if there is no such bin
+		t, records, ended = None, [], False
+		while True:
+			while not ended and (t is None or t<aggregator.t):
+				t, records = self.queue.get()
+				if t is None:
+					if records is not None:
+						raise Exception('Auxiliary field {} for field {} failed: {}'.format(self.code, aggregator.field.name, records))
+					ended = True
+			yield records if t==aggregator.t else []
+
+
+class _Scheduler(object):
+	# one run of Aggregator.run_threads: the fields are the nodes of the dependency graph given by the aux_fields
+	# of aggr_dict, within (station_id, source); interdependent fields (weakly connected components) are started
+	# together if there are enough threads, with bounded feeds between them, otherwise one by one when their
+	# auxiliary fields are finished, with unbounded feeds
+	def __init__(self, fields, aggr_dict):
+		self.log = logging.getLogger(__name__)
+		self.aggr_dict = aggr_dict
+		self.fields = OrderedDict()
+		for f in fields:
+			if f.code not in aggr_dict:
+				continue
+			key = (f.code, f.station_id, f.source)
+			if key in self.fields:
+				raise Exception('Code/station/source multiplicity ({} / {} / {}) [{name}].'.format(*key, name=f.name))
+			self.fields[key] = f
+		self.inputs = dict((k, [(c,)+k[1:] for c in aggr_dict[k[0]].get('aux_fields', []) if (c,)+k[1:] in self.fields]) for k in self.fields)
+		self.order = self.__sort()
+	
+	def __sort(self):
+		# topological order of the fields (auxiliary fields first)
+		order, state = [], {}
+		def visit(k, path):
+			if state.get(k)=='done':
+				return
+			if k in state:
+				cycle = path[path.index(k):] + [k]
+				raise Exception('Circular auxiliary fields: {} (station {} / {}).'.format(' -> '.join(c[0] for c in cycle), *k[1:]))
+			state[k] = 'visiting'
+			for i in self.inputs[k]:
+				visit(i, path+[k])
+			state[k] = 'done'
+			order.append(k)
+		for k in self.fields:
+			visit(k, [])
+		return order
+	
+	def components(self):
+		# the lists of interdependent fields (weakly connected components), in topological order
+		comp = dict((k, [k]) for k in self.order)
+		for k in self.order:
+			for i in self.inputs[k]:
+				if comp[i] is not comp[k]:
+					c = comp[i] + comp[k]
+					for j in c:
+						comp[j] = c
+		seen, out = set(), []
+		for k in self.order:
+			if id(comp[k]) not in seen:
+				seen.add(id(comp[k]))
+				out.append(sorted(comp[k], key=self.order.index))
+		return out
+	
+	def run(self, cls, num_threads, kw):
+		num_threads = max(num_threads, 1)
+		# units of fields started together
+		units = []
+		for c in self.components():
+			units.extend([c] if len(c)<=num_threads else [[k] for k in c])
+		
+		# all aggregators are instantiated on the main thread, auxiliary fields first
+		aggregators, inputs, failed = {}, {}, {}
+		for u in units:
+			for k in u:
+				bad = [i for i in self.inputs[k] if i in failed]
+				if bad:
+					failed[k] = 'auxiliary field {} failed'.format(bad[0][0])
+					continue
+				feeds = dict((i, _Feed(i[0], cls.feed_size if len(u)>1 else 0)) for i in self.inputs[k])
+				d = deepcopy(self.aggr_dict[k[0]])
+				d.update(kw)
+				try:
+					a = cls(parent=self.fields[k], feeds=dict((i[0], f) for i,f in feeds.iteritems()), **d)
+				except Exception as e:
+					self.log.exception('{} ({} / {}) could not be started'.format(*k))
+					failed[k] = '{}: {}'.format(e.__class__.__name__, e)
+					continue
+				a.feeds = []
+				for i,f in feeds.iteritems():
+					aggregators[i].feeds.append(f)
+				aggregators[k], inputs[k] = a, feeds.values()
+		
+		tasks, done = Queue(), Queue()
+		def worker():
+			for k in iter(tasks.get, None):
+				a, error = aggregators[k], None
+				try:
+					a.run()
+				except Exception as e:
+					self.log.exception('{} ({} / {}) failed'.format(*k))
+					error = '{}: {}'.format(e.__class__.__name__, e)
+					for feed in a.feeds:
+						feed.put(None, error)
+				finally:
+					for feed in inputs[k]:
+						feed.closed.set()
+				done.put((k, error))
+		
+		for n in xrange(num_threads):
+			thread = Thread(target=worker)
+			thread.setDaemon(True)
+			thread.start()
+		
+		pending = [[k for k in u if k in aggregators] for u in units]
+		pending, finished, idle, stopped = [u for u in pending if u], set(), num_threads, False
+		while (pending and not stopped) or idle<num_threads:
+			try:
+				for u in ([] if stopped else pending[:]):
+					if len(u)>idle or len(u)==1 and any(i not in failed and i not in finished for i in self.inputs[u[0]]):
+						continue
+					pending.remove(u)
+					bad = [i for i in self.inputs[u[0]] if i in failed] if len(u)==1 else []
+					if bad:
+						failed[u[0]] = 'auxiliary field {} failed'.format(bad[0][0])
+						continue
+					for k in u:
+						tasks.put(k)
+					idle -= len(u)
+				if idle==num_threads: # nothing running and nothing left to start
+					break
+				try:
+					k, error = done.get(timeout=1)
+				except Empty:
+					continue
+				idle += 1
+				if error is None:
+					finished.add(k)
+				else:
+					failed[k] = error
+			except KeyboardInterrupt:
+				stopped = True
+		for n in xrange(num_threads):
+			tasks.put(None)
+		
+		if failed:
+			self.log.error('{} of {} aggregations failed: {}'.format(len(failed), len(self.fields), 
+				', '.join('{} ({} / {}): {}'.format(k[0], k[1], k[2], e) for k,e in failed.iteritems())))
+		return [aggregators[k].field for k in self.order if k in finished]
+
+
+sql_funcs = {
+	ave: ("CAST(avg(x) FILTER (WHERE ok) AS numeric)", "count(*) FILTER (WHERE ok)"),
+	rain_month: ("coalesce(sum(x) FILTER (WHERE ok), count(*))", "CASE WHEN bool_or(ok) THEN count(*) END")
+}
+"""
+:ref:`aggregation functions<aggr_func>` which can be computed by the database if :attr:`Aggregator.sql` is set, with the SQL aggregate expressions for ``x`` and ``info`` of the aggregated records (over a bin's rows with columns ``x`` and ``ok``, where the latter is ``false`` for ``NULL`` and flag values, see :meth:`Aggregator.fx`)
+"""
+
+# the binned records, the aggregates, the records, and their provenance; returns the number of binned records
+_aggregate = """WITH b AS (
+	SELECT r.id, r.t, x.x, {ok} AS ok, {bin} AS bin FROM record r JOIN {parent} x ON x.id=r.id WHERE r.field_id=:parent_id{since}
+), g AS (
+	SELECT bin, {x} AS x, {info} AS info, min(t) AS t_start, max(t) AS t_end FROM b GROUP BY bin
+), n AS (
+	INSERT INTO record (type, field_id, t, info) SELECT :type, :field_id, bin, info FROM g RETURNING id, t
+), y AS (
+	INSERT INTO {table} (id, x) SELECT n.id, g.x FROM n JOIN g ON g.bin=n.t
+), z AS (
+	{provenance}
+)
+SELECT count(*) FROM b"""
+
+_assoc = "INSERT INTO record_assoc (parent_id, child_id) SELECT n.id, b.id FROM n JOIN b ON b.bin=n.t"
+
+_ranges = "INSERT INTO bin_range (id, field_id, t_start, t_end) SELECT n.id, :parent_id, g.t_start, g.t_end FROM n JOIN g ON g.bin=n.t"
+
 DMI_daily = {
 	'd':{'type':Record_int,'func':wind_dir,'aux_fields':['f']},
 	'f':{'type':Record_float,'func':ave},
@@ -2,7 +2,7 @@
 Using the importer module
 =========================
 
-The importer module provides an interface to import larger quantities of data relatively quickly and attempts to cover a range of file formats encountered in practice. In addition to the basic single-threaded :class:`Importer` class, it provides the  helper function :func:`import_with_threads` to ingest multiple files simultaneously (one file per thread), which should give some speed-up since the limitation is I/O both on the file and the database side (despite the :pydoc:`GIL <glossary.html#term-global-interpreter-lock>` - I *think*). 
+The importer module provides an interface to import larger quantities of data relatively quickly and attempts to cover a range of file formats encountered in practice. In addition to the basic single-threaded :class:`Importer` class, it provides the  helper function :func:`import_with_threads` to ingest multiple files simultaneously (one file per thread), which should give some speed-up since the limitation is I/O both on the file and the database side (despite the :pydoc:`GIL <glossary.html#term-global-interpreter-lock>` - I *think*). For larger imports, :func:`import_with_processes` parses the files on several processes and leaves the database to one or a few writing processes, which actually scales with the number of cores. For files that arrive continuously, a :class:`Watcher` watches directories and imports new and changed files as a long-running service. 
 
 .. _field_dict:
 
@@ -62,6 +62,8 @@ Parsing of time values
 
 The values for the 'time' columns can be any :obj:`str` of ``year, month, day, hour, minute, second, microsecond``, i.e., the keyword arguments to the :class:`datetime.datetime` constructor (``year, month, day`` are mandatory). There is also another, :ref:`more flexible way to define the parsing of time values <timecall>`.
 
+A column can also be given the value ``'station'``, for files containing the data of several stations; such files are imported in one pass by a :class:`MultiImporter`, which reads the :attr:`~databarc.schema.Field.station_id` of each line from that column. :class:`Importer` ignores the column.
+
 .. _fixedwidth:
 
 Fixed-width files
@@ -101,21 +103,115 @@ Lastly, other timestamp formats can be parsed by replacing the 'time' key-value
 	}
 
 .. note:
-	If a :class:`~databarc.schema.Field` with the given :attr:`~databarc.schema.Field.name`, :attr:`~databarc.schema.Field.source` and :attr:`~databarc.schema.Field.station_id` already exists in the datebase, that field is retrieved, and only records with a timestamp **later** than the latest record in the database will be added. This is intended as convenience in case an error occurs during importing, **or** if the database is updated periodically with files that contain **all** data. **It is assumed that the records in the file are in temporal order**.	
+	If a :class:`~databarc.schema.Field` with the given :attr:`~databarc.schema.Field.name`, :attr:`~databarc.schema.Field.source` and :attr:`~databarc.schema.Field.station_id` already exists in the datebase, that field is retrieved, and only records with a timestamp **later** than the latest record in the database will be added. This is intended as convenience in case an error occurs during importing, **or** if the database is updated periodically with files that contain **all** data. **It is assumed that the records in the file are in temporal order** (see :ref:`unsorted files <sorting>` otherwise).	
 	
 .. warning::	
-	All parsing is done in :pydoc:`try...except <reference/compound_stmts.html#the-try-statement>` blocks. This means that, in order to be remain as general as possible, whatever cannot be parsed is simply ignored and does not upset the importer. In particular, header lines are expected to throw errors when parsed and hence are just ignored. In order to provide some basic check, errors that do **not** belong to some 'expected' set are logged to the file **'importer_parsing.log'** in the working directory. This 'expected' set contains :exc:`~databarc.schema.ValidationError`, raised during validation by the :class:`~databarc.schema.Record` subclasses (e.g. if :class:`~databarc.schema.Record_int` is instantiated with an :attr:`~databarc.schema.Record.x` argument that can't be made into an :obj:`int`), and :exc:`MissingValue`, raised internally by the importer when a value is recognized as equal to the 'missing' key in a 'field_dict'.
+	All parsing is done in :pydoc:`try...except <reference/compound_stmts.html#the-try-statement>` blocks. This means that, in order to be remain as general as possible, whatever cannot be parsed is simply ignored and does not upset the importer. In particular, header lines are expected to throw errors when parsed and hence are just ignored. In order to provide some basic check, errors that do **not** belong to some 'expected' set are logged to the file **'importer_parsing.log'** in the working directory. This 'expected' set contains :exc:`ValueError` and :exc:`ArithmeticError`, raised when a value can't be converted to the python type of the :class:`~databarc.schema.Record` subclass (e.g. to :obj:`int` for :class:`~databarc.schema.Record_int`), and values recognized as matching the 'missing' key in a 'field_dict'. The field_dict is compiled into a single row-parsing function by :func:`~databarc.parser.compile_row`, which handles all of this without raising.
+
+.. _bulk:
+
+Bulk loading
+------------
+
+By default, every parsed value becomes a :class:`~databarc.schema.Record` subclass instance which is appended to its :attr:`Field.records <databarc.schema.Field.records>` and persisted by the ORM, i.e. with one ``INSERT`` into the ``record`` table and one into the subtype table per value. For large backfills, this is by far the dominant cost. If :attr:`Importer.bulk` is set to ``True``, the values are instead converted to the python type of the record subclass and collected in column buffers (one per field). On :meth:`Importer.commit`, the buffers are written with PostgreSQL's ``COPY`` into a temporary staging table per record subclass, from which ``record`` and the subtype table are filled with one ``INSERT ... SELECT`` statement per batch::
+
+	from databarc.importer import Importer
+	Importer.bulk = True
+
+Batching via :attr:`Importer.max_commit` works the same as in the default mode. Records whose (:attr:`~databarc.schema.Record.field_id`, :attr:`~databarc.schema.Record.t`) combination already exists in the database are skipped, as are repeated timestamps within a batch (only one of them is loaded). Since no ORM instances are created, :attr:`Field.records <databarc.schema.Field.records>` remains empty in this mode. For full-archive backfills, the secondary indexes of the record tables can in addition be dropped for the duration of the load with :func:`~databarc.schema.bulk_load`.
+
+.. note::
+	The unique constraint on (``field_id``, ``t``) is deferrable, which PostgreSQL does not accept as an arbiter for ``INSERT ... ON CONFLICT``. The existing rows are therefore excluded with an anti-join (``NOT EXISTS``) instead, which amounts to ``ON CONFLICT DO NOTHING``.
+
+.. _compressed:
+
+Compressed files and archives
+-----------------------------
+
+Since :class:`Importer` accepts any iterable of lines, compressed files and members of archives can be imported without decompressing them to disk first. The generator :func:`open_streams` yields :class:`Stream` objects for ``.gz``, ``.bz2`` and ``.xz`` files and for each member of ``.tar`` (possibly compressed) and ``.zip`` archives. Each :class:`Stream` decompresses on a separate thread, handing the lines over through a bounded buffer::
+
+	from databarc.importer import Importer, NCDC_isd_lite, open_streams
+	
+	for stream in open_streams('isd-lite-2015.tar'):
+		# stream.name is the member's path without compression suffix, e.g. '2015/010010-99999-2015'
+		Imp = Importer(Session, 'NCDC', os.path.basename(stream.name)[:6], NCDC_isd_lite, stream)
+		Imp.do(Session)
+
+With :func:`import_with_threads`, the keyword argument ``unpack=True`` does the same for every file in the list.
+
+.. _incremental:
+
+Incremental imports
+-------------------
+
+Files that are delivered again and again with all the data (i.e. the old data plus whatever has been appended since) would normally be parsed from the first line on, only to discard everything that isn't later than the latest record in the database. If :attr:`Importer.incremental` is set, the importer keeps a :class:`~databarc.schema.Manifest` per file (by absolute path), :attr:`~databarc.schema.Field.source` and :attr:`~databarc.schema.Field.station_id`, which records the size and modification time of the file, the byte offset up to which it was imported and a SHA-1 digest of the contents up to that offset. On the next import of the same file:
+
+	* if size and modification time are unchanged, :meth:`Importer.do` does nothing (the instance's ``skip`` attribute is ``True``)
+	* if the contents up to the recorded offset are unchanged, the file is read from the offset on
+	* otherwise (or if there is no manifest yet), the start of the first line later than the latest record of all fields is found by a binary search in the file, and the file is read from (shortly before) there; if any of the fields is new, the whole file is read
+
+The manifest is updated by :meth:`Importer.finish`, together with the last commit, so that it only records a completed import. Regular files are needed for this, and they have to be in temporal order. Computing the digest means reading the part of the file that is skipped, but not parsing it::
+
+	from databarc.importer import Importer
+	Importer.incremental = True
+
+.. _rejects:
+
+Rejected rows
+-------------
+
+Normally, if the database refuses a batch of :attr:`Importer.max_commit` records because of a single bad row, :meth:`Importer.commit` rolls the whole batch back and raises the exception, which stops the import of the file (and :func:`import_with_threads` only logs the error). If :attr:`Importer.rejects` is set to a file name, a batch which fails because of an integrity error (e.g. the unique constraint on :attr:`~databarc.schema.Record.field_id` and :attr:`~databarc.schema.Record.t`) or a data error (e.g. a value out of range for the column) is retried, field by field, in :sqla:`savepoints <orm/session_transaction.html#using-savepoint>`. Any part that fails is split in halves and retried, until the failing rows are found; they are appended to the file, the rest is committed. Each line of the file contains (tab-separated) the name of the input file, the line number, the name of the field, the timestamp, the value and the error message::
+
+	Importer.rejects = 'rejected.txt'
+
+A batch which goes through costs the same as without this setting, except that the line numbers of the values are kept (and in the default, non-:attr:`~Importer.bulk` mode, the values themselves as well, since the :class:`~databarc.schema.Record` instances are gone after the rollback). On PostgreSQL, the deferred constraints are made immediate for the retries, since otherwise they wouldn't be checked before the final commit.
+
+.. _sorting:
+
+Unsorted files
+--------------
+
+Since only values later than the latest record of a field in the database are imported, the files are assumed to be in temporal order. Within a file, lines that are out of order are still imported, but a timestamp that occurs twice hits the unique constraint on (``field_id``, ``t``) on :meth:`~Importer.commit` (or, in :attr:`~Importer.bulk` mode, one of the values is loaded, whichever PostgreSQL picks). If :attr:`Importer.sort` is set, the parsed values (field, timestamp, line number and value) are instead sorted before they reach the session: they are collected in a buffer of :attr:`Importer.sort_buffer` values, which is sorted and written to a temporary file whenever it is full, and the sorted runs are merged when the file has been read (in :meth:`Importer.finish`). Values of a field with the same timestamp are collapsed into one according to :attr:`Importer.duplicates`, and the number of collapsed values is counted as ``importer_duplicates_total`` in the :mod:`~databarc.metrics`::
+
+	Importer.sort = True
+	Importer.duplicates = 'max'
+
+The records are then created (or buffered) in temporal order, with commits every :attr:`~Importer.max_commit` records as usual; memory use is bounded by :attr:`~Importer.sort_buffer` and :attr:`~Importer.max_commit`. Nothing is committed before the whole file has been read.
 """
 import os, csv, logging
-import sys
+import sys, stat, time
+import multiprocessing as mp
 from re import compile
 from copy import deepcopy
+from array import array
+from decimal import Decimal
+from cStringIO import StringIO
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError, DataError
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm import subqueryload
 from sqlalchemy.sql import func
-from threading import current_thread
-from databarc.schema import Field, Record, Record_int, Record_float, Record_num, Flag, ValidationError
+from threading import current_thread, Thread, Event, Lock
+from Queue import Queue, Full, Empty
+from itertools import islice, groupby
+from operator import itemgetter
+from heapq import merge
+from tempfile import TemporaryFile
+from contextlib import closing
+from zipfile import ZipFile
+import gzip, bz2, tarfile
+import cPickle as pickle
+try: import lzma
+except ImportError:
+	try: from backports import lzma
+	except ImportError: lzma = None
+from databarc.schema import Field, Record, Record_int, Record_float, Record_num, Flag, Manifest, ValidationError
 from databarc.utils import flags as uflags
+from databarc.parser import BlockParser, RowParser, NotVectorizable, compile_row, line_ranges, SKIP
+from databarc.metrics import metrics
+import numpy as np
 from datetime import datetime
+from hashlib import sha1
 
 
 
@@ -133,7 +229,7 @@ An instance of this class imports one file which can contain a number of columns
 
 :param dict field_dict: a dictionary describing the column-to-:class:`~databarc.schema.Field` mapping of the imported file, :ref:`described in the module docstring <field_dict>`
 
-:param file file: an opened file handle
+:param file file: an opened file handle, or any other iterable of lines (e.g. a pipe or a generator); the file is read only once
 
 :param str delimiter: if the file is to be parsed by the :mod:`csv` module and the delimiter is not a comma, it can be specified here
 
@@ -141,10 +237,16 @@ An instance of this class imports one file which can contain a number of columns
 
 :ivar committed: number of :class:`Records <databarc.schema.Record>` committed to the database
 
-:ivar lines: number of lines of file to be imported
+:ivar size: size of the file in bytes as given by :func:`os.fstat`, or ``None`` if unknown (e.g. for pipes, sockets or generators), in which case no percentage is shown in the printouts
+
+:ivar pos: number of bytes read from the file so far
 
 :ivar l: current line counter of Importer
 
+:ivar str name: name of the file (without directory) as written to the :attr:`rejects` file; the name of the current thread if the file has none (e.g. for generators)
+
+:ivar skip: ``True`` if the file is unchanged since the last import and :meth:`do` won't do anything (only with :attr:`incremental`)
+
 :Example:
 
 ::
@@ -172,7 +274,34 @@ In the example, :data:`DMI_subd` is a :ref:`field_dict<field_dict>` defined in t
 	
 	fail_lines = 100
 	"""number of lines for datetime parsing to fail before an :exc:`UnparsedLineLimit` exception is raised"""
-	
+
+	bulk = False
+	"""If ``True``, parsed values are collected in column buffers instead of :class:`~databarc.schema.Record` instances and loaded with ``COPY`` on :meth:`commit` (see :ref:`bulk loading <bulk>`). Needs a PostgreSQL database with the :mod:`psycopg2` driver."""
+
+	vectorize = False
+	"""If ``True``, regular files are memory-mapped and parsed block-wise into :mod:`numpy` arrays by a :class:`~databarc.parser.BlockParser`, instead of row by row. Field_dicts with a callable ``'datetime'`` entry and delimited files with quote characters are still parsed row by row."""
+
+	rejects = None
+	"""Name of a file to which rows are appended that the database refuses to take (e.g. because of a unique constraint or a value out of the column's range). If set, a :meth:`commit` which fails for such a reason is retried in parts, until the offending rows are isolated (see :ref:`rejected rows <rejects>`), instead of rolling back the whole batch and raising the exception."""
+
+	cache = None
+	"""A :class:`MetadataCache`, shared by all importers (of a process), which looks up the existing :class:`Fields <databarc.schema.Field>`, the timestamps of their latest records and the :class:`Flags <databarc.schema.Flag>` of a field_dict with a few grouped queries, instead of several queries per column and flag. If ``None``, every importer queries the database itself."""
+
+	incremental = False
+	"""If ``True``, regular files are imported incrementally with the help of a :class:`~databarc.schema.Manifest` (see :ref:`incremental imports <incremental>`): unchanged files are skipped, files that have only been appended to are read from where the last import stopped, and otherwise the import starts close to the first line later than the latest records in the database, which is found by binary search. **The file has to be in temporal order.**"""
+
+	stream = False
+	"""If ``True``, the :class:`Records <databarc.schema.Record>` are detached from :attr:`Field.records <databarc.schema.Field.records>` and expunged from the session after each :meth:`commit`, and the records already in the database are never loaded into :attr:`Field.records <databarc.schema.Field.records>` of a pre-existing field. Memory use is then bounded by :attr:`max_commit` instead of growing with the length of the file: e.g. with :attr:`max_commit` set to 20000, the peak RSS of an import of a 10 million line file stays at the level it reaches after the first few commits (about 200 MB). (In :attr:`bulk` mode, no record instances are created in the first place.)"""
+
+	sort = False
+	"""If ``True``, the parsed values are sorted by timestamp (per field) with bounded memory before they reach the session, and values of a field with the same timestamp are collapsed according to :attr:`duplicates` (see :ref:`unsorted files <sorting>`)."""
+
+	duplicates = 'last'
+	"""How values of a field with the same timestamp are collapsed if :attr:`sort` is set: ``'first'`` or ``'last'`` (in the order of the file), ``'min'``, ``'max'``, or a callable which takes the :obj:`list` of values (in the order of the file) and returns one."""
+
+	sort_buffer = 10**6
+	"""number of values held in memory if :attr:`sort` is set, before they are written to a temporary file as a sorted run"""
+
 	def __init__(self,session,source,station_id,field_dict,file,delimiter=','):
 		self.parselog = logging.getLogger('parsing')
 		self.out = logging.getLogger(__name__)
@@ -184,7 +313,9 @@ In the example, :data:`DMI_subd` is a :ref:`field_dict<field_dict>` defined in t
 		
 		# for debugging purposes, we give the thread the name of the file we're importing
 		th = current_thread()
-		th.name = os.path.basename(file.name)
+		try: th.name = os.path.basename(file.name)
+		except AttributeError: pass
+		self.name = th.name
 		
 		# if we're running in an interactive python shell, we also attach the importer instances to the thread
 		# this allows 'import_with_threads' to return a list of all used importer instances
@@ -194,33 +325,63 @@ In the example, :data:`DMI_subd` is a :ref:`field_dict<field_dict>` defined in t
 			except AttributeError:
 				th.importers = [self]
 		
-		# count number of lines in file for printouts
-		for i,j in enumerate(file): pass
-		self.lines = i
+		# file size for printouts, only known for regular files
+		try: st = os.fstat(file.fileno())
+		except (AttributeError, IOError, OSError, ValueError): self.size = None
+		else: self.size = st.st_size if stat.S_ISREG(st.st_mode) else None
+		self.pos = 0
 		self.__n = 0 # is compared against max_commit
+		self.__fail = 0 # lines without timestamp in load()
 		self.l = 0
 		self.committed = 0
-		file.seek(0)
+		lines = self.__lines(file)
+		
+		# the vectorized parser maps the file itself
+		self.__file = file
+		self.__parser = None
+		if self.vectorize and self.size is not None:
+			try: 
+				self.__parser = BlockParser(field_dict, delimiter)
+				self.pos = file.tell()
+			except NotVectorizable as E:
+				self.out.debug('{}, parsing row by row'.format(E))
+		
+		# the whole row (timestamp and all values) is parsed by one generated function
+		self.__row, keys = compile_row(field_dict, self.__log)
 		
 		fd = deepcopy(field_dict) # because we pop stuff, otherwise there would be side effects
-		 
-		 # uses datetime if present, else instantiates dateparser
-		self.datetime = fd.pop('datetime',['year','month','day','hour','minute','second','microsecond'])
+		fd.pop('datetime', None)
 		
 		# test weather to use a csv.reader or not (tuples or ints as keys in field_dict)
 		if isinstance(fd.keys()[0],int):
-			self.file_reader = csv.reader(file,delimiter=delimiter)
-			self.__initfields(session, fd, lambda s,c: s[c])
+			self.file_reader = csv.reader(lines,delimiter=delimiter)
+			self.__initfields(session, fd)
 			self.out.debug('{} [init as csv]'.format(self))
 		else:
-			self.file_reader = file
-			self.__initfields(session, fd, lambda s,c: s[c[0]:c[1]],last_line)
+			self.file_reader = lines
+			self.__initfields(session, fd)
 			self.out.debug('{} [init as fixed-width]'.format(self))
+		self.__order = [self.__fields[k] for k in keys]
+		self.__sorter = _Sorter(self.sort_buffer) if self.sort else None
+		
+		self.skip = False
+		self.__manifest = None
+		if self.incremental and self.size is not None:
+			self.__resume(session, file, st, delimiter if self.file_reader is not lines else None)
+		self.__counted = (self.l, 0) # lines and records added to the metrics
 		
 	
 	def __str__(self):
 		s = '; '.join(['{}: {}'.format(f['field'].name,f['field'].count) for f in self.__fields.values()])
-		return '{} => {}% read'.format(s, int((float(self.l)/self.lines*100)))		
+		if self.size:
+			return '{} => {}% read'.format(s, int(float(self.pos)/self.size*100))
+		return '{} => {} lines read'.format(s, self.l)
+	
+	def __lines(self, file):
+		# keeps track of the byte offset for the printouts
+		for line in file:
+			self.pos += len(line)
+			yield line
 	
 	@property
 	def fields(self):
@@ -228,44 +389,102 @@ In the example, :data:`DMI_subd` is a :ref:`field_dict<field_dict>` defined in t
 		return [(f['field'],f['count']) for f in self.__fields.values()]
 	
 	
-	def __initfields(self, session, fd, getv):
+	def __initfields(self, session, fd):
 		# field_dict is copied and elements of the individual field-dicts ('f') are popped
 		self.__fields = {}
+		if self.cache is not None:
+			known, flags = self.__prefetch(session, fd)
 		for c,f in fd.iteritems():
-			if isinstance(f,str):
-				# saves colums where to look 
-				self.datetime[self.datetime.index(f)] = c
-			else:
+			if not isinstance(f,str):
 				d = {'count':0, 'type':f.pop('type')}
-				flags = uflags(session,f.pop('flags',[]))
-							
-				try: mv = compile(f.pop('missing'))
-				except KeyError: d['getv'] = getv
-				else:
-					def getv_miss(s,c):
-						x = getv(s,c)
-						if mv.search(x): raise MissingValue
-						return x
-					d['getv'] = getv_miss
+				fl = f.pop('flags',[])
+				fl = [flags.next() for x in fl] if self.cache is not None else uflags(session,fl)
+				f.pop('missing',None)
+				
+				# column buffers used instead of records if *bulk* is set
+				d['t'], d['x'] = _bulk_buffers(d['type'])
+				d['l'] = array('l') # line numbers, only if *rejects* is set
+				# the parsers give the values of Record_num as scaled integers
+				d['value'] = Record_num.from_scaled if issubclass(d['type'], Record_num) else None
+				d['i'] = len(self.__fields) # identifies the field in sorted runs
 			
 				# is there a field with same station_id and same name in the database?
 				try: 
-					d['field'] = session.query(Field).filter_by(station_id=self.station_id, name=f['name'], source=self.source).one()
-					d['start'] = session.query(func.max(Record.t)).filter(Record.field_id==d['field'].id).scalar()
+					if self.cache is None:
+						d['field'] = session.query(Field).filter_by(station_id=self.station_id, name=f['name'], source=self.source).one()
+						d['start'] = session.query(func.max(Record.t)).filter(Record.field_id==d['field'].id).scalar()
+					elif f['name'] in known:
+						d['field'], d['start'] = known[f['name']]
+					else:
+						raise NoResultFound
 					self.out.debug('{} already exists'.format(d['field']))
+					if self.stream:
+						# otherwise, the first append loads all existing records of the field
+						set_committed_value(d['field'], 'records', [])
 				except NoResultFound:
 					d['field'] = Field(station_id=self.station_id, source=self.source, **f)
 				
-				d['field'].flags = flags
+				d['field'].flags = fl
 				self.__fields[c] = d
-		
-		# builds a datetime function if none is given in the field_dict
-		if isinstance(self.datetime,list):
-			getlist = [i for i in self.datetime if not isinstance(i,str)]
-			def dt(s):
-				return datetime(*[int(getv(s,i)) for i in getlist])
-			self.datetime = dt
-			
+	
+	def __prefetch(self, session, fd):
+		# existing fields (with their flags loaded) and flags of all columns, from the cache
+		known = self.cache.fields(session, self.source, self.station_id)
+		ids = dict((v[0], k) for k,v in known.iteritems())
+		fields = session.query(Field).filter(Field.id.in_(list(ids))).options(subqueryload(Field.flags)) if ids else []
+		known = dict((ids[x.id], (x, known[ids[x.id]][1])) for x in fields)
+		flags = self.cache.flags(session, [x for f in fd.values() if not isinstance(f,str) for x in f.get('flags',[])])
+		return known, iter(flags)
+	
+	def __resume(self, session, file, st, delimiter):
+		# sets *pos* and *l* to where the import should start, or *skip* if the file is unchanged
+		key = {'path': os.path.abspath(file.name), 'source': self.source, 'station_id': self.station_id}
+		m = session.query(Manifest).filter_by(**key).first()
+		self.__manifest = m or Manifest(**key)
+		self.__stat = (st.st_size, st.st_mtime)
+		self.__digest = sha1()
+		start = None
+		if m is not None and m.pos<=st.st_size:
+			if (m.size, m.mtime, m.pos)==(st.st_size, st.st_mtime, st.st_size):
+				self.skip = True
+				self.out.info('{} unchanged since last import, skipped'.format(file.name))
+				return
+			self.l = _digest(file.name, 0, m.pos, self.__digest)
+			if self.__digest.hexdigest()==m.digest:
+				start = m.pos
+				self.out.debug('{} [resuming at byte {}]'.format(self, start))
+			else:
+				self.__digest = sha1()
+				self.out.info('{} changed since last import'.format(file.name))
+		if start is None:
+			starts = [f.get('start') for f in self.__fields.values()]
+			if starts and None not in starts:
+				row = self.__row
+				if delimiter is not None:
+					parse = lambda s: row(next(csv.reader([s], delimiter=delimiter)), 0)
+				else:
+					parse = lambda s: row(s, 0)
+				start = _seek(file.name, st.st_size, min(starts), parse)
+				self.out.debug('{} [seeking to byte {}]'.format(self, start))
+			else:
+				start = 0
+			self.l = _digest(file.name, 0, start, self.__digest)
+		self.__hashed = self.pos = start
+		file.seek(start)
+	
+	def __log(self, l, c, E):
+		# unexpected exceptions during the conversion of a value
+		f = self.__fields[c]
+		metrics.count('importer_parse_failures_total', kind='value')
+		self.parselog.debug('line {}, field {} [{}]'.format(l+1,f['field'].name,f['type'].__name__))
+		self.parselog.debug(E)
+	
+	def __count(self):
+		# adds the lines read and records built since the last call to the metrics
+		records = sum(f['count'] for f in self.__fields.values())
+		metrics.count('importer_lines_total', self.l-self.__counted[0])
+		metrics.count('importer_records_total', records-self.__counted[1])
+		self.__counted = (self.l, records)
 		
 	
 	def do(self,session):
@@ -275,32 +494,38 @@ Performs the actual import, after the main class has been instantiated.
 :param session: a SQLAlchemy session object; it **needs** to be a :class:`~sqla:sqlalchemy.orm.scoping.scoped_session` if multithreading is used
 :type session: :class:`~sqla:sqlalchemy.orm.session.Session`
 		"""
-		fail = 0
-		for self.l,s in enumerate(self.file_reader):
+		if self.skip:
+			return
+		if self.__parser is not None:
 			try: 
-				t = self.datetime(s)
-			except Exception as E: 
-				if fail == 100:
-					raise UnparsedLineLimit('parsing stopped after 100 lines of no datetime match')
-				self.parselog.info('line {}: {} [header?]'.format(self.l+1,s))
-				fail += 1
-			else:
-				for c,f in self.__fields.iteritems():
-					if 'start' not in f or t>f['start']: # this line here is very sensitive; f['start'] could be None, t could be anything
-						try: 
-							f['field'].records.append(f['type'](t=t, x=f['getv'](s,c)))
-						except MissingValue: pass
-						except ValidationError: pass
-						except Exception as E: 
-							self.parselog.debug('line {}, field {} [{}]'.format(self.l+1,f['field'].name,f['type'].__name__))
-							self.parselog.debug(E)
-						else: 
-							self.__n += 1
-							f['count'] += 1
-				if self.max_commit and self.__n>=self.max_commit: 
-					self.commit(session)
-		if self.max_commit and self.__n: 
+				for block in self.__parser.blocks(self.__file, self.pos):
+					self.load(session, block)
+			except NotVectorizable as E:
+				# raised before anything is read
+				self.out.debug('{} [{}, parsing row by row]'.format(self, E))
+				self.__parser = None
+		if self.__parser is None:
+			self.__do_rows(session)
+		self.finish(session)
+	
+	def finish(self, session):
+		"""
+Commits what is left after the last :meth:`commit` and logs the outcome of the import; called at the end of :meth:`do`, and needs to be called explicitly after the last :meth:`load`.
+
+:param session: the SQLAlchemy session
+		"""
+		if self.__sorter is not None:
+			self.__unsort(session)
+		m = self.__manifest
+		if m is not None:
+			_digest(m.path, self.__hashed, self.pos, self.__digest)
+			self.__hashed = self.pos
+			m.size, m.mtime = self.__stat
+			m.pos, m.digest = self.pos, self.__digest.hexdigest()
+			session.add(m)
+		if self.max_commit and (self.__n or m is not None): 
 			self.commit(session)
+		self.__count()
 		
 		if self.committed:
 			self.out.info('{} [success]'.format(self))
@@ -308,9 +533,117 @@ Performs the actual import, after the main class has been instantiated.
 			self.out.warning('{} [pre-existing?]'.format(self))
 		else:
 			self.out.warning('{} [failure?]'.format(self))
-			
-		
-		
+	
+	def __do_rows(self, session):
+		fail = 0
+		row, order = self.__row, self.__order
+		keep, lines = self.bulk or self.rejects is not None, self.rejects is not None
+		sorter = self.__sorter
+		# self.l is the index of the current line in the loop, and the number of lines read after it
+		self.l -= 1
+		for self.l,s in enumerate(self.file_reader, self.l+1):
+			r = row(s, self.l)
+			if r is None:
+				if fail == self.fail_lines:
+					raise UnparsedLineLimit('parsing stopped after {} lines of no datetime match'.format(fail))
+				self.parselog.info('line {}: {} [header?]'.format(self.l+1,s))
+				metrics.count('importer_parse_failures_total', kind='datetime')
+				fail += 1
+			else:
+				t, values = r
+				for f,x in zip(order, values):
+					# values are SKIP if missing or invalid
+					if x is not SKIP and ('start' not in f or t>f['start']): # this line here is very sensitive; f['start'] could be None, t could be anything
+						if sorter is not None:
+							sorter.add((f['i'], t, self.l, x))
+							continue
+						if keep:
+							f['x'].append(x)
+							f['t'].append(t)
+						if lines:
+							f['l'].append(self.l)
+						if not self.bulk:
+							f['field'].records.append(f['type'](t=t, x=x if f['value'] is None else f['value'](x)))
+						self.__n += 1
+						f['count'] += 1
+				if self.max_commit and self.__n>=self.max_commit: 
+					self.commit(session)
+		self.l += 1
+	
+	def load(self, session, block):
+		"""
+Adds the values of one :class:`~databarc.parser.Block` (as yielded by a :class:`~databarc.parser.BlockParser` or :class:`~databarc.parser.RowParser` for the same field_dict, possibly in another process) to the import, applying the same rules as :meth:`do` and committing every :attr:`max_commit` records. Call :meth:`finish` after the last block.
+
+:param session: the SQLAlchemy session
+
+:param block: the parsed block of lines, which have to follow those of the previous block
+:type block: :class:`~databarc.parser.Block`
+		"""
+		valid, failed, stop = block.valid, block.failed, None
+		if self.__fail+len(failed) > self.fail_lines:
+			# stops at the same line as the row-by-row parsing
+			stop = failed[self.fail_lines-self.__fail][0]
+			failed = failed[:self.fail_lines-self.__fail]
+			valid = valid.copy()
+			valid[stop:] = False
+		for i,s in failed:
+			self.parselog.info('line {}: {} [header?]'.format(self.l+i+1,s))
+		if failed:
+			metrics.count('importer_parse_failures_total', len(failed), kind='datetime')
+		self.__fail += len(failed)
+		# line numbers in the file, kept by the caller for a part of a block (see MultiImporter.load)
+		line = np.arange(self.l, self.l+block.lines) if block.line is None else block.line
+		for c,f in self.__fields.iteritems():
+			ok = valid & block.ok[c]
+			if f.get('start') is not None:
+				ok &= block.t > np.datetime64(f['start'])
+			t, x = block.t[ok].tolist(), block.x[c][ok].tolist()
+			if self.__sorter is not None:
+				self.__sorter.extend(zip([f['i']]*len(t), t, line[ok].tolist(), x))
+				continue
+			if self.bulk or self.rejects is not None:
+				f['t'].extend(t)
+				f['x'].extend(x)
+			if self.rejects is not None:
+				f['l'].extend(line[ok].tolist())
+			if not self.bulk:
+				value = f['value'] or (lambda x: x)
+				for r in zip(t,x):
+					f['field'].records.append(f['type'](t=r[0], x=value(r[1])))
+			self.__n += len(x)
+			f['count'] += len(x)
+		if stop is not None:
+			self.l += stop
+			raise UnparsedLineLimit('parsing stopped after {} lines of no datetime match'.format(self.fail_lines))
+		self.l += block.lines
+		self.pos = block.end
+		if self.max_commit and self.__n>=self.max_commit: 
+			self.commit(session)
+	
+	def __unsort(self, session):
+		# adds the sorted values as in __do_rows, collapsing duplicate timestamps
+		fields = dict((f['i'], f) for f in self.__fields.values())
+		keep, lines = self.bulk or self.rejects is not None, self.rejects is not None
+		n = 0
+		for i,t,l,x in self.__sorter.merged(self.duplicates):
+			f = fields[i]
+			if keep:
+				f['x'].append(x)
+				f['t'].append(t)
+			if lines:
+				f['l'].append(l)
+			if not self.bulk:
+				f['field'].records.append(f['type'](t=t, x=x if f['value'] is None else f['value'](x)))
+			self.__n += 1
+			f['count'] += 1
+			n += 1
+			if self.max_commit and self.__n>=self.max_commit: 
+				self.commit(session)
+		if self.__sorter.count>n:
+			metrics.count('importer_duplicates_total', self.__sorter.count-n)
+			self.out.debug('{} [{} values with duplicate timestamps collapsed]'.format(self, self.__sorter.count-n))
+		self.__sorter = None
+	
 	def commit(self,session): 
 		"""
 Usually called by :meth:`do`, unless :attr:`max_commit` is set to 0. Commits all parsed :class:`Fields <databarc.schema.Field>` and :class:`Records <databarc.schema.Record>` to the database.
@@ -326,19 +659,439 @@ Usually called by :meth:`do`, unless :attr:`max_commit` is set to 0. Commits all
 			self.out.debug('starting commit, fields without data: {}'.format(', '.join(F)))
 		else: 
 			self.out.debug('starting commit, all fields have data.')
+		# the collections are expired on commit, so we hold on to them here
+		records = [(f['field'], f['field'].records) for f in self.__fields.values()] if self.stream else []
+		self.__count()
 		try:
-			session.commit()
+			with metrics.time('importer_commit_seconds'):
+				try:
+					n = self.__copy(session) if self.bulk else self.__n
+					session.commit()
+				except Exception as E:
+					session.rollback()
+					if self.rejects is None or not isinstance(E, self.__row_errors(session)):
+						raise
+					n, isolated = self.__isolate(session, str(E).splitlines()[0])
+					records = isolated if self.stream else []
 		except Exception:
 			session.rollback()
 			raise
 		else:
-			self.committed += self.__n
+			if self.cache is not None:
+				self.cache.invalidate(self.source, self.station_id)
+			if n<self.__n:
+				metrics.count('importer_records_skipped_total', self.__n-n)
+				self.out.debug('{} records already in database, skipped'.format(self.__n-n))
+			self.committed += n
 			self.__n = 0
+			if self.bulk or self.rejects is not None:
+				for f in self.__fields.values():
+					f['t'], f['x'] = _bulk_buffers(f['type'])
+					f['l'] = array('l')
+			for field, recs in records:
+				for r in recs:
+					session.expunge(r)
+				set_committed_value(field, 'records', [])
 			self.out.debug('{} [committed]'.format(self))
+	
+	def __row_errors(self, session):
+		# errors caused by single rows, as raised by the ORM or by the DBAPI cursor used for COPY
+		dbapi = session.get_bind().dialect.dbapi
+		return (IntegrityError, DataError, dbapi.IntegrityError, dbapi.DataError)
+	
+	def __isolate(self, session, error):
+		# retries a failed batch with savepoints, bisecting the rows of each field until the failing ones are found;
+		# returns the number of records loaded and the (field, records) pairs of those added to the session
+		if session.get_bind().dialect.name=='postgresql':
+			# otherwise the deferred unique constraints are only checked on the final commit
+			session.execute('SET CONSTRAINTS ALL IMMEDIATE')
+		for f in self.__fields.values():
+			# the records added before the rollback are added again below
+			set_committed_value(f['field'], 'records', [])
+			if f['count']>0: session.add(f['field'])
+		session.flush()
+		# new fields are detached by the rollback, so the printout has to wait until they are added again
+		self.out.warning('{} [{}, isolating rejected rows]'.format(self, error))
+		rejected, added, n = [], [], 0
+		for f in self.__fields.values():
+			rows = zip(f['l'], f['t'], f['x'])
+			added.append((f['field'], []))
+			n += self.__insert(session, f, rows, rejected, added[-1][1])
+		session.commit()
+		if rejected:
+			metrics.count('importer_parse_failures_total', len(rejected), kind='rejected')
+			with _rejects_lock, open(self.rejects, 'a') as file:
+				for f,(l,t,x),E in rejected:
+					x = x if f['value'] is None else f['value'](x)
+					file.write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(self.name, l+1, f['field'].name, t, x, str(E).splitlines()[0]))
+			self.out.warning('{} [{} rows rejected, see {}]'.format(self, len(rejected), self.rejects))
+		return n, added
+	
+	def __insert(self, session, f, rows, rejected, added):
+		if not rows:
+			return 0
+		try:
+			with session.begin_nested():
+				if self.bulk:
+					n = self.__copy(session, [(f, [r[1] for r in rows], [r[2] for r in rows])])
+				else:
+					value = f['value'] or (lambda x: x)
+					records = [f['type'](t=t, x=value(x), field_id=f['field'].id) for l,t,x in rows]
+					session.add_all(records)
+					n = len(rows)
+		except self.__row_errors(session) as E:
+			if len(rows)==1:
+				rejected.append((f, rows[0], E))
+				return 0
+			h = len(rows)//2
+			return self.__insert(session, f, rows[:h], rejected, added) + self.__insert(session, f, rows[h:], rejected, added)
+		if not self.bulk:
+			added.extend(records) # the records of a rolled back savepoint are expunged by the rollback
+		return n
+	
+	def __copy(self, session, columns=None):
+		with metrics.time('importer_copy_seconds'):
+			return self.__copy_columns(session, columns)
+	
+	def __copy_columns(self, session, columns):
+		# columns are (field, timestamps, values) tuples, by default the buffers of all fields
+		retry = columns is not None
+		if columns is None:
+			columns = [(f, f['t'], f['x']) for f in self.__fields.values()]
+		# new fields need their primary keys before the staged records can reference them
+		session.flush()
+		conn = session.connection()
+		cur = conn.connection.cursor()
+		n = 0
+		for cls in set(f['type'] for f,t,x in columns):
+			fields = [(f,t,x) for f,t,x in columns if f['type'] is cls and t]
+			if not fields: continue
+			table = cls.__table__.name
+			stage = 'stage_{}'.format(table)
+			cur.execute(_stage.format(stage=stage, x=cls.__table__.c.x.type.compile(dialect=conn.dialect)))
+			if retry:
+				# the parts of the batch loaded before are still staged
+				cur.execute('DELETE FROM {}'.format(stage))
+			fmt = _bulk_types[cls.__mapper__.polymorphic_identity][1]
+			buf = StringIO()
+			for f,T,X in fields:
+				i = f['field'].id
+				buf.writelines('{}\t{}\t{}\n'.format(i,t,fmt(x)) for t,x in zip(T,X))
+			buf.seek(0)
+			cur.copy_from(buf, stage, columns=('field_id','t','x'))
+			cur.execute(_load.format(stage=stage, table=table), {'type': cls.__mapper__.polymorphic_identity})
+			n += cur.rowcount
+		return n
 		
 
 
-def import_with_threads(files, func, num_threads):
+class _Sorter(object):
+	# sorts (field, t, line, x) tuples with at most *size* of them in memory, writing sorted runs to temporary files
+	def __init__(self, size):
+		self.size = size
+		self.count = 0
+		self.__buffer = []
+		self.__runs = []
+	
+	def add(self, row):
+		self.__buffer.append(row)
+		if len(self.__buffer)>=self.size:
+			self.__spill()
+	
+	def extend(self, rows):
+		self.__buffer.extend(rows)
+		if len(self.__buffer)>=self.size:
+			self.__spill()
+	
+	def __spill(self):
+		self.count += len(self.__buffer)
+		self.__buffer.sort()
+		file = TemporaryFile()
+		for i in xrange(0, len(self.__buffer), 10000):
+			pickle.dump(self.__buffer[i:i+10000], file, pickle.HIGHEST_PROTOCOL)
+		file.seek(0)
+		self.__runs.append(file)
+		self.__buffer = []
+	
+	def __read(self, file):
+		with file:
+			while True:
+				try: chunk = pickle.load(file)
+				except EOFError: return
+				for row in chunk:
+					yield row
+	
+	def merged(self, duplicates):
+		# the line numbers make the rows unique, hence the values are never compared and the order is that of the file
+		self.count += len(self.__buffer)
+		self.__buffer.sort()
+		collapse = _duplicates.get(duplicates, duplicates)
+		rows = merge(self.__buffer, *[self.__read(f) for f in self.__runs])
+		for (i,t),group in groupby(rows, itemgetter(0, 1)):
+			group = list(group)
+			if len(group)==1:
+				yield group[0]
+			else:
+				yield i, t, group[0][2], collapse([r[3] for r in group])
+		self.__buffer, self.__runs = [], []
+
+# policies for values with the same timestamp, see Importer.duplicates
+_duplicates = {
+	'first': lambda x: x[0],
+	'last': lambda x: x[-1],
+	'min': min,
+	'max': max
+}
+
+
+class MultiImporter(object):
+	"""
+Imports a file with the data of several stations in one pass. The station of each line is read from the column of the field_dict whose value is ``'station'`` (an :obj:`int` key for delimited, a :obj:`tuple` key for fixed-width files); its values have to be integers (as :attr:`~databarc.schema.Field.station_id`). The lines are parsed in blocks (by a :class:`~databarc.parser.BlockParser` if :attr:`Importer.vectorize` is set and the field_dict and file allow it, otherwise by a :class:`~databarc.parser.RowParser`), each block is split by station, and the parts are handed to one :class:`Importer` per station (see :meth:`Importer.load`), which is created when the station first appears. The existing fields of all stations new in a block, and the timestamps of their latest records, are looked up with one query by a :class:`MetadataCache` (:attr:`Importer.cache` if set, otherwise one for this instance). Lines without a valid station or timestamp count towards :attr:`Importer.fail_lines` for the whole file.
+
+The per-station importers hold at most :attr:`Importer.max_commit` records each before committing; the other settings of :class:`Importer` apply as well.
+
+:param session: the SQLAlchemy session
+
+:param source: :attr:`~databarc.schema.Field.source` of the fields
+
+:param dict field_dict: the :ref:`field_dict <field_dict>`, with a ``'station'`` column
+
+:param file: an opened file, or any other iterable of lines
+
+:param str delimiter: delimiter for delimited files
+
+:ivar dict importers: the :class:`Importer` instances by station id
+
+:Example:
+
+::
+	
+	DMI_multi = dict(DMI_subd)
+	DMI_multi[0] = 'station'
+	with open('dmi_all_stations.txt') as file:
+		Imp = MultiImporter(Session, 'DMI', DMI_multi, file, delimiter='\\t')
+		Imp.do(Session)
+	"""
+	def __init__(self, session, source, field_dict, file, delimiter=','):
+		if 'station' not in field_dict.values():
+			raise ValueError("the field_dict has no 'station' column")
+		self.source = source
+		self.field_dict = field_dict
+		self.delimiter = delimiter
+		self.importers = {}
+		self.l = 0
+		self.parselog = logging.getLogger('parsing')
+		self.out = logging.getLogger(__name__)
+		th = current_thread()
+		try: th.name = os.path.basename(file.name)
+		except AttributeError: pass
+		self.name = th.name
+		self.__file = file
+		self.__fail = 0
+		self.__cache = Importer.cache or MetadataCache()
+		self.__importer = type('Importer', (Importer,), {'cache': self.__cache})
+		
+		try: regular = stat.S_ISREG(os.fstat(file.fileno()).st_mode)
+		except (AttributeError, IOError, OSError, ValueError): regular = False
+		self.__parser = None
+		if Importer.vectorize and regular:
+			try: self.__parser = BlockParser(field_dict, delimiter)
+			except NotVectorizable as E:
+				self.out.debug('{}, parsing row by row'.format(E))
+	
+	def __str__(self):
+		return '{} stations, {} lines read'.format(len(self.importers), self.l)
+	
+	def do(self, session):
+		"""
+Performs the import.
+
+:param session: the SQLAlchemy session
+		"""
+		blocks = None
+		if self.__parser is not None:
+			try: 
+				for block in self.__parser.blocks(self.__file):
+					self.load(session, block)
+				blocks = True
+			except NotVectorizable as E:
+				# raised before anything is read
+				self.out.debug('{} [{}, parsing row by row]'.format(self, E))
+		if blocks is None:
+			for block in RowParser(self.field_dict, self.delimiter).blocks(self.__file):
+				self.load(session, block)
+		self.finish(session)
+	
+	def load(self, session, block):
+		"""
+Splits a :class:`~databarc.parser.Block` by station and adds the parts to the imports of the stations (see :meth:`Importer.load`).
+
+:param session: the SQLAlchemy session
+
+:param block: the parsed block of lines, which have to follow those of the previous block
+:type block: :class:`~databarc.parser.Block`
+		"""
+		valid, failed, stop = block.valid, block.failed, None
+		if self.__fail+len(failed) > Importer.fail_lines:
+			stop = failed[Importer.fail_lines-self.__fail][0]
+			failed = failed[:Importer.fail_lines-self.__fail]
+			valid = valid.copy()
+			valid[stop:] = False
+		for i,s in failed:
+			self.parselog.info('line {}: {} [header?]'.format(self.l+i+1,s))
+		if failed:
+			metrics.count('importer_parse_failures_total', len(failed), kind='datetime')
+		self.__fail += len(failed)
+		
+		# the lines of each station, in the order of the file
+		index = np.flatnonzero(valid)
+		stations = block.station[index]
+		order = np.argsort(stations, kind='mergesort')
+		index, stations = index[order], stations[order]
+		parts = np.split(index, np.flatnonzero(np.diff(stations))+1) if len(index) else []
+		
+		new = [int(block.station[i[0]]) for i in parts if int(block.station[i[0]]) not in self.importers]
+		if new:
+			self.__cache.prefetch(session, self.source, new)
+			for st in new:
+				self.importers[st] = self.__importer(session, self.source, st, self.field_dict, [], self.delimiter)
+				self.importers[st].name = self.name
+		# the parts keep the line numbers in the file, e.g. for the rejects file
+		block.line = np.arange(self.l, self.l+block.lines)
+		for i in parts:
+			self.importers[int(block.station[i[0]])].load(session, block.select(i))
+		
+		if stop is not None:
+			self.l += stop
+			raise UnparsedLineLimit('parsing stopped after {} lines of no datetime match'.format(Importer.fail_lines))
+		self.l += block.lines
+	
+	def finish(self, session):
+		"""
+Calls :meth:`Importer.finish` for all stations; needs to be called explicitly after the last :meth:`load`.
+
+:param session: the SQLAlchemy session
+		"""
+		for st in sorted(self.importers):
+			self.importers[st].finish(session)
+		self.out.info('{} [{} records committed]'.format(self, sum(i.committed for i in self.importers.values())))
+
+
+class MetadataCache(object):
+	"""
+Cache of the metadata an :class:`Importer` needs before it can import anything: the existing :class:`Fields <databarc.schema.Field>` of a :attr:`~databarc.schema.Field.source` and :attr:`~databarc.schema.Field.station_id`, the timestamps of their latest records and the :class:`Flags <databarc.schema.Flag>` of the field_dicts. It is used by all importers if set as :attr:`Importer.cache`, and can be shared by the threads of :func:`import_with_threads` (all methods are thread-safe). Only ids and timestamps are cached, since the mapped objects belong to a session; each :class:`Importer` then loads its fields (and their flags) with two queries.
+
+The fields of many stations can be loaded at once with :meth:`prefetch`, otherwise they are loaded per station when first needed. An :class:`Importer` calls :meth:`invalidate` for its station after every :meth:`~Importer.commit`, since its fields and their latest records have changed then. Changes to the database made otherwise are not noticed; call :meth:`clear` in that case.
+
+:Example:
+
+::
+	
+	from databarc.importer import Importer, MetadataCache
+	
+	Importer.cache = MetadataCache()
+	Importer.cache.prefetch(Session, 'DMI', station_ids)
+	"""
+	def __init__(self):
+		self.__lock = Lock()
+		self.__fields = {} # (source, station_id) -> {name: (field id, latest timestamp)}
+		self.__flags = {} # sorted flag dict items -> flag id
+	
+	def prefetch(self, session, source, station_ids):
+		"""
+Loads the fields of the given stations which aren't cached yet, together with the timestamps of their latest records, with one grouped query (per 1000 stations).
+
+:param session: the SQLAlchemy session
+
+:param source: the :attr:`~databarc.schema.Field.source` of the fields
+
+:param station_ids: iterable of :attr:`~databarc.schema.Field.station_id` values
+		"""
+		with self.__lock:
+			ids = sorted(set(int(s) for s in station_ids) - set(s for r,s in self.__fields if r==source))
+			for i in xrange(0, len(ids), 1000):
+				q = session.query(Field.id, Field.station_id, Field.name, func.max(Record.t)).\
+					outerjoin(Record, Record.field_id==Field.id).\
+					filter(Field.source==source, Field.station_id.in_(ids[i:i+1000])).\
+					group_by(Field.id, Field.station_id, Field.name)
+				fields = dict(((source, s), {}) for s in ids[i:i+1000])
+				for f, s, name, t in q:
+					fields[(source, s)][name] = (f, t)
+				self.__fields.update(fields)
+	
+	def fields(self, session, source, station_id):
+		"""
+:return: a :obj:`dict` mapping the names of the existing fields of a station to (field id, timestamp of the latest record) tuples
+		"""
+		self.prefetch(session, source, [station_id])
+		with self.__lock:
+			return dict(self.__fields[(source, int(station_id))])
+	
+	def flags(self, session, flags):
+		"""
+Same as :func:`databarc.utils.flags`, but only flags which haven't been seen before are looked up (or created) in the database, all at once.
+
+:return: a list of :class:`~databarc.schema.Flag` objects loaded into *session*
+		"""
+		keys = [tuple(sorted(f.iteritems())) for f in flags]
+		with self.__lock:
+			new = [k for k in set(keys) if k not in self.__flags]
+			if new:
+				for k,f in zip(new, uflags(session, [dict(k) for k in new])):
+					self.__flags[k] = f.id
+			ids = [self.__flags[k] for k in keys]
+		fl = dict((f.id, f) for f in session.query(Flag).filter(Flag.id.in_(set(ids)))) if ids else {}
+		return [fl[i] for i in ids]
+	
+	def invalidate(self, source, station_id):
+		"""Removes the fields of a station from the cache."""
+		with self.__lock:
+			self.__fields.pop((source, int(station_id)), None)
+	
+	def clear(self):
+		"""Empties the cache."""
+		with self.__lock:
+			self.__fields.clear()
+			self.__flags.clear()
+
+
+def _digest(path, start, end, digest):
+	# updates the hash with the bytes from start to end and returns the number of lines therein
+	n = 0
+	with open(path, 'rb') as file:
+		file.seek(start)
+		while start<end:
+			b = file.read(min(2**20, end-start))
+			if not b: break
+			digest.update(b)
+			n += b.count('\n')
+			start += len(b)
+	return n
+
+def _seek(path, size, after, parse, limit=2**16):
+	# binary search in a file in temporal order for the start of a line before the first one later than 'after'
+	with open(path, 'rb') as file:
+		def line(pos):
+			# start of the first line at or after pos
+			file.seek(max(pos-1, 0))
+			if pos>0: file.readline()
+			return file.tell()
+		def time(pos):
+			# timestamp of the first parseable line from pos on, None if there is none close by
+			line(pos)
+			for s in islice(iter(file.readline, ''), 100):
+				r = parse(s)
+				if r is not None:
+					return r[0]
+		lo, hi = 0, size
+		while hi-lo>limit:
+			mid = (lo+hi)//2
+			t = time(mid)
+			if t is None or t>after: hi = mid
+			else: lo = mid
+		return line(lo)
+
+def import_with_threads(files, func, num_threads, unpack=False):
 	"""
 Import files on *num_threads* :class:`threads <threading.Thread>` using a :class:`~Queue.Queue`, one file per thread at a time.
 
@@ -348,8 +1101,13 @@ Import files on *num_threads* :class:`threads <threading.Thread>` using a :class
 
 :param int num: number of threads to be used
 
+:param bool unpack: if ``True``, each element of *files* is opened with :func:`open_streams` and *func* is called with each of the resulting :class:`Streams <Stream>` in turn (i.e. with every member of an archive), instead of with the element of *files* itself (see :ref:`compressed files <compressed>`)
+
 :return: a list of :class:`Importer` instances created in the process (for debugging purposes)
 
+.. note::
+	The parsing is serialized by the :pydoc:`GIL <glossary.html#term-global-interpreter-lock>` and every thread holds its own database transaction; :func:`import_with_processes` avoids both for plain (not compressed) files.
+
 :Example:
 
 ::
@@ -390,7 +1148,11 @@ Import files on *num_threads* :class:`threads <threading.Thread>` using a :class
 			except Empty:
 				stopped.wait(1)
 			else:
-				try: func(file)
+				try: 
+					if unpack:
+						for stream in open_streams(file):
+							with stream: func(stream)
+					else: func(file)
 				except Exception as E: log.error(E)
 				queue.task_done()
 	
@@ -417,9 +1179,590 @@ Import files on *num_threads* :class:`threads <threading.Thread>` using a :class
 		except Exception: pass
 	return importers
 
+def import_with_processes(session, jobs, num_procs, writers=1, queue_size=8, report=60, split=None, hold=16, timeout=10):
+	"""
+Import files with *num_procs* parsing :class:`processes <multiprocessing.Process>` and *writers* writing processes. Unlike with :func:`import_with_threads`, the parsing isn't serialized by the :pydoc:`GIL <glossary.html#term-global-interpreter-lock>`: each parsing process takes one file at a time and parses it into :class:`~databarc.parser.Block` objects (with a :class:`~databarc.parser.BlockParser` if :attr:`Importer.vectorize` is set and the field_dict allows it, otherwise with a :class:`~databarc.parser.RowParser`), i.e. into :mod:`numpy` columns, which are sent over bounded queues to the writing processes. These own the only database connections, and load the blocks with an :class:`Importer` per file in :attr:`bulk <Importer.bulk>` mode (see :meth:`Importer.load`), so that the usual rules (existing fields, records later than the latest one in the database, :attr:`~Importer.max_commit`, :attr:`~Importer.fail_lines`) apply. All blocks of a file go to the same writer.
+
+If *split* is given, files larger than *split* bytes are divided into line-aligned byte ranges of about that size (see :func:`~databarc.parser.line_ranges`), which are parsed concurrently by different processes, so that a single large file doesn't keep only one core busy. The writer loads the blocks of the ranges in the order of the file, holding back blocks that arrive early (at most *hold* per range: a process which is further ahead waits until the writer has reached its range), hence the import is the same as if the file had been parsed in one piece (including which records are later than the latest one in the database, and which lines count towards :attr:`~Importer.fail_lines`); for (mostly) chronological files, the records are also loaded in temporal order. If the parsing of a range fails, the import of the file stops at the error: the blocks parsed before it (including those of the failing range) are loaded and committed, and the result of the job is the error.
+
+The throughput of both stages is logged every *report* seconds (and at the end): lines per second parsed and the fraction of time the parsers were blocked on full queues (i.e. waiting for the writers), records per second loaded and the fraction of time the writers were idle (i.e. waiting for the parsers). The :mod:`~databarc.metrics` recorded in the processes are merged into the :data:`~databarc.metrics.metrics` registry of the calling process (at most once a second per process).
+
+:param session: the SQLAlchemy session (or :class:`~sqla:sqlalchemy.orm.scoping.scoped_session`) used by the writers; it is closed and its engine's connection pool disposed of before the processes are started, so that no connection is shared between processes
+
+:param list jobs: tuples ``(path, source, station_id, field_dict)``, optionally with a fifth element *delimiter*, i.e. the arguments to :class:`Importer`
+
+:param int num_procs: number of parsing processes
+
+:param int writers: number of writing processes
+
+:param int queue_size: number of blocks each writer's queue can hold
+
+:param report: interval in seconds between throughput log messages
+
+:param int split: size in bytes above which files are parsed in parallel ranges (``None`` for one file per process)
+
+:param int hold: number of blocks of a range the writer holds back at most until the ranges before it are loaded
+
+:param timeout: seconds the processes are given to stop (after their current block) if a writing process dies or on :exc:`KeyboardInterrupt`, before they are terminated
+
+:return: a :obj:`list` with, for each job, the number of committed records or the exception (as :obj:`str`) that stopped the import (with the number of records committed before it if the parsing failed); if a writing process dies, the parsing processes are stopped, and the jobs which haven't finished fail
+
+:Example:
+
+::
+	
+	import os
+	from databarc.schema import session
+	from databarc.importer import DMI_subd, import_with_processes
+	
+	jobs = [(os.path.join(dir,f), 'DMI', f.split('.')[0], DMI_subd, '\\t') for f in os.listdir(dir) if f[-3:]=='txt']
+	import_with_processes(session(), jobs, 6)
+
+.. note::
+	The processes are started with :func:`os.fork` (the default of :mod:`multiprocessing` on POSIX systems), hence field_dicts with lambdas or other unpicklable callables can be used.
+	"""
+	jobs = [tuple(j) + (',',)*(5-len(j)) for j in jobs]
+	log = logging.getLogger(__name__)
+	tasks = mp.Queue()
+	parts = []
+	for i,j in enumerate(jobs):
+		if split and os.path.getsize(j[0])>split:
+			with open(j[0]) as file:
+				parts.append(line_ranges(file, split))
+		else:
+			parts.append([(0, None)])
+		for p in xrange(len(parts[i])):
+			tasks.put((i, p))
+	queues = [mp.Queue(queue_size) for w in xrange(writers)]
+	# the range of each job being loaded by the writer, len(parts[i]) once the job has finished or failed
+	progress = mp.Array('i', len(jobs))
+	stats = mp.Queue()
+	stop = mp.Event()
+	
+	session.close()
+	session.get_bind().dispose()
+	
+	parsers = [mp.Process(target=_parse_jobs, args=(jobs, parts, tasks, queues, progress, hold, stop, stats)) for n in xrange(num_procs)]
+	loaders = [mp.Process(target=_write_blocks, args=(session, jobs, parts, q, progress, stats)) for q in queues]
+	for p in parsers + loaders:
+		p.daemon = True
+		p.start()
+	for p in parsers:
+		tasks.put(None)
+	
+	results = [None] * len(jobs)
+	total = {'parse': [0, 0., 0.], 'write': [0, 0., 0.]}
+	last = dict((k, list(v)) for k,v in total.iteritems())
+	start = t = time.time()
+	def throughput(now, since, a, b):
+		s = dict((k, [x-y for x,y in zip(a[k], b[k])]) for k in a)
+		log.info('parse: {:.0f} lines/s, {:.0%} blocked on writers; write: {:.0f} records/s, {:.0%} idle'.format(
+			s['parse'][0]/(now-since), s['parse'][2]/max(s['parse'][1]+s['parse'][2], 1e-9),
+			s['write'][0]/(now-since), s['write'][2]/max(s['write'][1]+s['write'][2], 1e-9)))
+	
+	try:
+		stopping = False
+		while True:
+			try: msg = stats.get(timeout=1)
+			except Empty: msg = None
+			if msg is None: pass
+			elif msg[0]=='done':
+				results[msg[1]] = msg[2]
+			elif msg[0]=='metrics':
+				metrics.merge(msg[1])
+			else:
+				total[msg[0]] = [x+y for x,y in zip(total[msg[0]], msg[1:])]
+			if not all(p.is_alive() for p in loaders) and any(p.is_alive() for p in parsers):
+				# a writer died (e.g. outside its error handling): the parsers stop after their current block,
+				# and what they put on the queues of dead writers is discarded, so that they can exit
+				if not stop.is_set():
+					log.error('writing process died, stopping the import')
+					stop.set()
+					deadline = time.time()+timeout
+				_drain([q for q,p in zip(queues, loaders) if not p.is_alive()])
+				if time.time()>deadline:
+					log.error('parsing processes not stopping, terminating them')
+					_join(parsers, [], 0)
+			if not stopping and not any(p.is_alive() for p in parsers):
+				# all files parsed, the writers stop once their queues are empty
+				for q,p in zip(queues, loaders):
+					if p.is_alive():
+						q.put(None)
+				stopping = True
+			elif stopping and msg is None and not any(p.is_alive() for p in loaders):
+				break
+			now = time.time()
+			if now-t >= report:
+				throughput(now, t, total, last)
+				last, t = dict((k, list(v)) for k,v in total.iteritems()), now
+	except KeyboardInterrupt:
+		# the parsers stop after their current block, the writers after the block they are loading
+		stop.set()
+		_join(parsers, queues+[stats], timeout)
+		for q in queues:
+			try: q.put_nowait(None)
+			except Full: pass # a writer which has died
+		_join(loaders, [stats], timeout)
+		raise
+	throughput(time.time(), start, total, {'parse': [0, 0., 0.], 'write': [0, 0., 0.]})
+	for i,r in enumerate(results):
+		if r is None:
+			results[i] = 'writing process died' if loaders[i % writers].exitcode else 'import stopped, a writing process died'
+	return results
+
+def _drain(queues):
+	# discards what is on the queues
+	for q in queues:
+		try:
+			while True:
+				q.get_nowait()
+		except Empty: pass
+
+def _join(processes, queues, timeout):
+	# joins the processes, draining the queues they may be blocked on (a process only exits once what it
+	# put on a queue is read); terminates those which are still running after timeout seconds, which may
+	# leave a queue they were writing to unusable, hence only as a last resort
+	end = time.time()+timeout
+	while any(p.is_alive() for p in processes) and time.time()<end:
+		_drain(queues)
+		for p in processes:
+			p.join(.05)
+	for p in processes:
+		if p.is_alive():
+			p.terminate()
+			p.join()
+
+def _put(queue, item, stop):
+	# puts item on the bounded queue, unless stop is set while waiting; returns whether it did
+	while not stop.is_set():
+		try:
+			queue.put(item, timeout=.5)
+			return True
+		except Full: pass
+	return False
+
+def _blocks(file, field_dict, delimiter, start, end):
+	if Importer.vectorize:
+		try:
+			for block in BlockParser(field_dict, delimiter).blocks(file, start, end):
+				yield block
+			return
+		except NotVectorizable: pass # raised before anything is read
+	for block in RowParser(field_dict, delimiter).blocks(file, start, end):
+		yield block
+
+def _parse_jobs(jobs, parts, tasks, queues, progress, hold, stop, stats):
+	# parsing process: sends (job, part, block) to the job's writer, (job, part, None) at the end of a part
+	# and (job, part, error) if the parsing fails; waits after sending 'hold' blocks of a part the writer
+	# holds back (see _write_blocks), and stops parsing a part once its job has finished or failed
+	# and everything once stop is set
+	log = logging.getLogger(__name__)
+	metrics.reset() # copied from the parent
+	sent = 0
+	for i,p in iter(tasks.get, None):
+		if stop.is_set():
+			break
+		path, source, station_id, field_dict, delimiter = jobs[i]
+		queue = queues[i % len(queues)]
+		start, end = parts[i][p]
+		try:
+			with open(path) as file:
+				t, ahead = time.time(), 0
+				for block in _blocks(file, field_dict, delimiter, start, end):
+					busy = time.time()-t
+					t = time.time()
+					if progress[i]<p:
+						ahead += 1
+						while ahead>hold and progress[i]<p and not stop.is_set():
+							time.sleep(.05)
+					if progress[i]>=len(parts[i]) or not _put(queue, (i, p, block), stop):
+						break
+					wait = time.time()-t
+					stats.put(('parse', block.lines, busy, wait))
+					metrics.observe('parser_block_seconds', busy)
+					metrics.observe('parser_blocked_seconds', wait)
+					sent = _send_metrics(stats, sent)
+					t = time.time()
+		except Exception as E: 
+			log.error('{}: {}'.format(path, E))
+			_put(queue, (i, p, str(E)), stop)
+		else:
+			_put(queue, (i, p, None), stop)
+	_send_metrics(stats, sent, True)
+
+def _write_blocks(session, jobs, parts, queue, progress, stats):
+	# writing process: one Importer per job, all loading in bulk mode
+	# the parts of a job are loaded in order, blocks of later parts wait in 'held'; the part being loaded
+	# is shared in 'progress' (len(parts[i]) once job i has finished or failed)
+	Importer.bulk = True
+	log = logging.getLogger(__name__)
+	importers, held = {}, {}
+	metrics.reset() # copied from the parent
+	sent = 0
+	if Importer.cache is not None:
+		for source in set(j[1] for j in jobs):
+			Importer.cache.prefetch(session, source, [j[2] for j in jobs if j[1]==source])
+	while True:
+		t = time.time()
+		msg = queue.get()
+		wait = time.time()-t
+		if msg is None:
+			_send_metrics(stats, sent, True)
+			break
+		sent = _send_metrics(stats, sent)
+		i, p, block = msg
+		path, source, station_id, field_dict, delimiter = jobs[i]
+		t = time.time()
+		if progress[i]>=len(parts[i]):
+			continue # the job has finished or failed
+		if p!=progress[i]:
+			held.setdefault((i, p), []).append(block)
+			stats.put(('write', 0, time.time()-t, wait))
+			continue
+		try:
+			if i not in importers:
+				current_thread().name = os.path.basename(path)
+				importers[i] = Importer(session, source, station_id, field_dict, [], delimiter)
+				importers[i].size = os.path.getsize(path)
+			Imp = importers[i]
+			n = Imp.committed
+			blocks, error = [block], None
+			while blocks:
+				block = blocks.pop(0)
+				if isinstance(block, str): # the parsing failed
+					progress[i], error = len(parts[i]), block
+				elif block is not None:
+					Imp.load(session, block)
+				else:
+					progress[i] += 1
+					blocks.extend(held.pop((i, progress[i]), []))
+				if progress[i]>=len(parts[i]):
+					Imp.finish(session)
+					stats.put(('done', i, Imp.committed if error is None else '{} ({} records committed)'.format(error, Imp.committed)))
+					break
+			stats.put(('write', Imp.committed-n, time.time()-t, wait))
+		except Exception as E:
+			session.rollback()
+			log.error('{}: {}'.format(path, E))
+			progress[i] = len(parts[i])
+			stats.put(('done', i, str(E)))
+		if progress[i]>=len(parts[i]): # the job's state isn't needed anymore
+			importers.pop(i, None)
+			for q in xrange(len(parts[i])):
+				held.pop((i, q), None)
+
+
+def _send_metrics(stats, last, force=False):
+	# sends the metrics recorded by a worker process since the last time to the parent, at most once a second
+	now = time.time()
+	if force or now-last>=1:
+		stats.put(('metrics', metrics.snapshot(reset=True)))
+		return now
+	return last
+
+
+class Watcher(object):
+	"""
+Long-running import service for files that arrive (or grow) continuously, e.g. logger or DMI files dropped into a directory. The directories *dirs* are scanned every *interval* seconds; files whose name matches one of the *rules* and whose size and modification time haven't changed since the previous scan (i.e. which are no longer being written) are put on a bounded :class:`~Queue.Queue`, from which *num_threads* threads import them with an :class:`Importer` in :attr:`~Importer.incremental` mode, so that a file that changes again is re-imported from where the previous import stopped. If the queue is full, the scan waits until a thread takes the next file (backpressure), hence no more than *queue_size* files are held back. The threads keep their (thread-local) sessions between files, so that the connections stay in the engine's pool; all of them share a :class:`MetadataCache` (:attr:`Importer.cache` if set). Files are only imported again after they change, including those whose import failed.
+
+The rules are tuples ``(pattern, source, station_id, field_dict[, delimiter])``, and the first rule whose regular expression *pattern* matches the file name (not the path, see :func:`re.match`) is used. *source* and *station_id* can be given as callables, which are called with the match object, and *field_dict* can be a :obj:`list` of field_dicts which are tried in turn if the import stops with :exc:`UnparsedLineLimit` (as in :func:`~databarc.simport.logger_dir`).
+
+The time from the first scan that sees a file change until its import is committed is recorded in the timer ``watcher_latency_seconds``, and the files in ``watcher_files_total`` (by ``status``, ``'imported'`` or ``'failed'``) of the :mod:`~databarc.metrics`.
+
+:param session: a :class:`~sqla:sqlalchemy.orm.scoping.scoped_session`
+
+:param list rules: the rules described above
+
+:param list dirs: directories to watch
+
+:param int num_threads: number of importing threads
+
+:param int queue_size: maximum number of files waiting to be imported
+
+:param interval: seconds between scans
+
+:Example:
+
+::
+	
+	from databarc.schema import session
+	from databarc.importer import Watcher, DMI_subd, level_logger, level_logger_2
+	
+	Watcher(session(), [
+		(r'(\d+)\.txt$', 'DMI', lambda m: int(m.group(1)), DMI_subd, '\\t'),
+		(r'level_(\d+).*\.csv$', lambda m: m.group(0).split('.')[0], lambda m: int(m.group(1)), [level_logger, level_logger_2])
+	], ['/data/incoming/dmi', '/data/incoming/logger']).run()
+
+.. note::
+	The directories are polled (with one :func:`os.stat` per matching file and scan), since python 2 has no interface to inotify in its standard library; with the incremental imports, the cost of a changed file is proportional to the appended data. Stale connections in the pool (e.g. after a database restart) can be replaced transparently by creating the engine with ``pool_pre_ping=True``.
+	"""
+	def __init__(self, session, rules, dirs, num_threads=2, queue_size=100, interval=2):
+		self.out = logging.getLogger(__name__)
+		self.session = session
+		self.rules = [(compile(r[0]),) + tuple(r[1:]) + (',',)*(5-len(r)) for r in rules]
+		self.dirs = dirs
+		self.num_threads = num_threads
+		self.interval = interval
+		self.__queue = Queue(queue_size)
+		self.__stopped = Event()
+		self.__lock = Lock()
+		self.__seen = {} # path -> ((size, mtime), time first seen changed)
+		self.__done = {} # path -> (size, mtime) when last imported
+		self.__pending = set()
+		self.__importer = type('Importer', (Importer,), {'incremental': True, 'cache': Importer.cache or MetadataCache()})
+	
+	def run(self):
+		"""Starts the importing threads and scans the directories until :meth:`stop` is called (from another thread) or a :exc:`KeyboardInterrupt` is raised. Files still waiting in the queue are dropped then; they are picked up by the next :class:`Watcher`."""
+		threads = [Thread(target=self.__work, name='watcher {}'.format(n)) for n in xrange(self.num_threads)]
+		for t in threads:
+			t.setDaemon(True)
+			t.start()
+		try:
+			while not self.__stopped.is_set():
+				self.scan()
+				self.__stopped.wait(self.interval)
+		except KeyboardInterrupt: pass
+		finally:
+			self.__stopped.set()
+			for t in threads:
+				t.join()
+	
+	def stop(self):
+		"""Stops :meth:`run` after the files currently being imported."""
+		self.__stopped.set()
+	
+	def scan(self):
+		"""Scans the directories once, queueing the files that are ready to be imported (see above); called by :meth:`run`."""
+		now = time.time()
+		for d in self.dirs:
+			try: names = os.listdir(d)
+			except OSError as E:
+				self.out.error('{}: {}'.format(d, E))
+				continue
+			for name in sorted(names):
+				path = os.path.join(d, name)
+				rule = next((r for r in self.rules if r[0].match(name)), None)
+				if rule is None or self.__stopped.is_set():
+					continue
+				try: st = os.stat(path)
+				except OSError: continue
+				key = (st.st_size, st.st_mtime)
+				with self.__lock:
+					if not stat.S_ISREG(st.st_mode) or path in self.__pending or self.__done.get(path)==key:
+						continue
+					seen = self.__seen.get(path)
+					self.__seen[path] = (key, now if seen is None else seen[1])
+					if seen is None or seen[0]!=key:
+						continue # new or still being written
+					self.__pending.add(path)
+				while not self.__stopped.is_set():
+					try: self.__queue.put((path, rule, seen[1]), timeout=1)
+					except Full: continue # backpressure
+					else: break
+	
+	def __work(self):
+		while not self.__stopped.is_set():
+			try: path, rule, since = self.__queue.get(timeout=1)
+			except Empty: continue
+			key = None
+			try:
+				st = os.stat(path)
+				key = (st.st_size, st.st_mtime)
+				self.__import(path, rule)
+			except Exception as E:
+				self.session.rollback()
+				self.out.error('{}: {}'.format(path, E))
+				metrics.count('watcher_files_total', status='failed')
+			else:
+				metrics.count('watcher_files_total', status='imported')
+				metrics.observe('watcher_latency_seconds', time.time()-since)
+			finally:
+				# the connection goes back to the pool, the thread-local session is kept
+				self.session.close()
+				with self.__lock:
+					self.__pending.discard(path)
+					self.__seen.pop(path, None)
+					if key is not None:
+						self.__done[path] = key
+		self.session.remove()
+	
+	def __import(self, path, (pattern, source, station_id, field_dict, delimiter)):
+		m = pattern.match(os.path.basename(path))
+		source = source(m) if callable(source) else source
+		station_id = station_id(m) if callable(station_id) else station_id
+		field_dicts = field_dict if isinstance(field_dict, list) else [field_dict]
+		for i,fd in enumerate(field_dicts):
+			with open(path) as file:
+				Imp = self.__importer(self.session, source, station_id, fd, file, delimiter)
+				try:
+					Imp.do(self.session)
+				except UnparsedLineLimit:
+					if i+1==len(field_dicts):
+						raise
+					self.session.rollback()
+				else:
+					return
+
+
+class Stream(object):
+	"""
+Iterable over the lines of a file object which is read (and hence decompressed) on a separate :class:`~threading.Thread`, so that decompression overlaps with the parsing done by an :class:`Importer`. The lines are handed over in chunks through a bounded :class:`~Queue.Queue`, i.e. the reading thread never gets more than *buffer* chunks ahead. Usually obtained from :func:`open_streams`, and can be passed to :class:`Importer` in place of an opened file.
+
+:param fileobj: an opened file object (e.g. :class:`gzip.GzipFile` or a member of a :class:`tarfile.TarFile`)
+
+:param str name: the name reported by the :attr:`name` attribute
+
+:param int buffer: maximum number of chunks of :attr:`chunk` lines held in memory
+
+:ivar str name: name of the file (or archive member, including its path within the archive), without compression suffix
+	"""
+	
+	chunk = 1000
+	"""number of lines handed over from the reading thread at a time"""
+	
+	def __init__(self, fileobj, name, buffer=16):
+		self.name = name
+		self.__file = fileobj
+		self.__queue = Queue(buffer)
+		self.__stopped = Event()
+		self.__done = False
+		self.__thread = Thread(target=self.__read, name='reader {}'.format(os.path.basename(name)))
+		self.__thread.setDaemon(True)
+		self.__thread.start()
+	
+	def __read(self):
+		lines = iter(self.__file)
+		try:
+			while not self.__stopped.is_set():
+				chunk = list(islice(lines, self.chunk))
+				if not chunk: break
+				self.__put(chunk)
+		except Exception as E:
+			self.__put(E)
+		self.__put(None)
+	
+	def __put(self, item):
+		# gives up if the consumer has closed the stream
+		while not self.__stopped.is_set():
+			try: 
+				self.__queue.put(item, timeout=1)
+			except Full: pass
+			else: return
+	
+	def __iter__(self):
+		while not self.__done:
+			chunk = self.__queue.get()
+			if chunk is None:
+				self.__done = True
+			elif isinstance(chunk, Exception):
+				self.__done = True
+				raise chunk
+			else:
+				for line in chunk:
+					yield line
+	
+	def close(self):
+		"""Stops the reading thread and closes the underlying file object."""
+		self.__stopped.set()
+		self.__thread.join()
+		self.__file.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+
+
+def open_streams(path, buffer=16):
+	"""
+Generator which opens the file at *path* and yields one :class:`Stream` for a plain or compressed (``.gz``, ``.bz2``, ``.xz``) file, or one per regular member of a ``.tar`` (also compressed, e.g. ``.tar.gz`` or ``.tgz``) or ``.zip`` archive. Nothing is written to disk. Tar archives are read sequentially, so each :class:`Stream` should be consumed (or closed) before the next one is requested. Archive members which are themselves ``.gz`` or ``.bz2`` compressed (as in NCDC's yearly isd-lite tarballs) are decompressed too; since they are read into memory first, this is meant for small members.
+
+:param str path: path to the file
+
+:param int buffer: see :class:`Stream`
+
+.. note::
+	Python 2 has no :mod:`lzma` module; ``.xz`` files need the `backports.lzma <https://pypi.python.org/pypi/backports.lzma>`_ package.
+	"""
+	base, ext = os.path.splitext(path)
+	if ext in ('.tgz','.tbz2','.txz'):
+		base, ext = base+'.tar', {'.tgz':'.gz', '.tbz2':'.bz2', '.txz':'.xz'}[ext]
+	if ext=='.zip':
+		with ZipFile(path) as z:
+			for m in z.infolist():
+				if not m.filename.endswith('/'):
+					with Stream(*_member(z.open(m), m.filename), buffer=buffer) as stream:
+						yield stream
+		return
+	if ext in _decompress:
+		fileobj = _decompress[ext](path)
+	else:
+		base = path
+		fileobj = open(path, 'rb')
+	if base.endswith('.tar'):
+		with closing(tarfile.open(fileobj=fileobj, mode='r|')) as tar:
+			for m in tar:
+				if m.isfile():
+					with Stream(*_member(tar.extractfile(m), m.name), buffer=buffer) as stream:
+						yield stream
+		fileobj.close()
+	else:
+		with Stream(fileobj, base, buffer) as stream:
+			yield stream
+
+
+def _member(fileobj, name):
+	# members of archives can't be seeked, as GzipFile would need to
+	base, ext = os.path.splitext(name)
+	if ext=='.gz':
+		return gzip.GzipFile(fileobj=StringIO(fileobj.read())), base
+	if ext=='.bz2':
+		return StringIO(bz2.decompress(fileobj.read())), base
+	return fileobj, name
+
+def _xz(path):
+	if lzma is None:
+		raise ImportError('reading .xz files requires the backports.lzma package')
+	return lzma.open(path, 'rb')
+
+_decompress = {'.gz': gzip.open, '.bz2': bz2.BZ2File, '.xz': _xz}
+
+
+def _scaled(x):
+	# COPY text of a scaled Record_num value
+	q, r = divmod(abs(x), 10**Record_num.scale)
+	return '{}{}.{:0{}d}'.format('-' if x<0 else '', q, r, Record_num.scale)
+
+# array typecode and COPY formatter of the values
+# in bulk mode, by polymorphic identity of the Record subclass
+_bulk_types = {
+	'int': ('l', str),
+	'float': ('d', repr),
+	'num': ('l', _scaled)
+}
+
+def _bulk_buffers(type):
+	code = _bulk_types[type.__mapper__.polymorphic_identity][0]
+	return [], array(code)
+
+_rejects_lock = Lock()
+
+_stage = 'CREATE TEMPORARY TABLE IF NOT EXISTS {stage} (field_id integer, t timestamp, x {x}) ON COMMIT DELETE ROWS'
+
+# the unique constraint on (field_id, t) is deferrable and hence can't be used with ON CONFLICT
+_load = """WITH s AS (
+	SELECT DISTINCT ON (field_id, t) field_id, t, x FROM {stage} ORDER BY field_id, t
+), r AS (
+	INSERT INTO record (type, field_id, t) SELECT %(type)s, s.field_id, s.t FROM s
+	WHERE NOT EXISTS (SELECT 1 FROM record WHERE record.field_id=s.field_id AND record.t=s.t)
+	RETURNING id, field_id, t
+)
+INSERT INTO {table} (id, x) SELECT r.id, s.x FROM r JOIN s USING (field_id, t)"""
+
 		
 class MissingValue(Exception):
-	"""Raised when a missing value as specified in field_dict is encountered; main purpose is to distinguish from other exceptions."""
+	"""Formerly raised when a missing value as specified in field_dict was encountered; the rows are now parsed by :func:`~databarc.parser.compile_row`, which returns :data:`~databarc.parser.SKIP` instead."""
 	pass
 			
 class UnparsedLineLimit(Exception):
@@ -494,10 +1837,38 @@ NCDC_isd_lite = {
 }
 
 
+def slash_datetime(date, time, order='ymd'):
+	"""
+Returns a callable for the ``'datetime'`` entry of a delimited :ref:`field_dict <field_dict>` (see :ref:`timecall`), for timestamps split into a date column of the form ``Y/m/d`` and a time column of the form ``H:M:S``, as written by the pressure and level loggers. The columns are split on the separators, without regular expressions; the date of the previous line is kept, so that only the time column is converted on consecutive lines of the same day.
+
+:param int date: index of the date column
+
+:param int time: index of the time column
+
+:param str order: order of year, month and day in the date column, e.g. ``'dmy'`` for ``d/m/Y``
+	"""
+	y, m, d = order.index('y'), order.index('m'), order.index('d')
+	# a single tuple, since the field_dicts (and hence this function) are shared between threads
+	last = [(None, (None, None, None))]
+	def parse(line):
+		k = line[date]
+		key, (Y, M, D) = last[0]
+		if k!=key:
+			p = k.split('/')
+			Y, M, D = int(p[y]), int(p[m]), int(p[d])
+			last[0] = k, (Y, M, D)
+		h, mi, sec = line[time].split(':')
+		return datetime(Y, M, D, int(h), int(mi), int(sec))
+	return parse
+
 def _parse(*ind):
 	p = compile('(\d+)/(\d+)/(\d+);(\d+):(\d+):(\d+)')
+	fast = slash_datetime(*ind)
 	def parse(line):
-		return datetime(*[int(x) for x in p.search(';'.join(line[i] for i in ind)).groups()])
+		# the regular expression is only needed for cells with extra characters
+		try: return fast(line)
+		except Exception:
+			return datetime(*[int(x) for x in p.search(';'.join(line[i] for i in ind)).groups()])
 	return parse
 
 flags = [
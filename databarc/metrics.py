@@ -0,0 +1,180 @@
+"""
+Using the metrics module
+========================
+
+The metrics module keeps counters and timers of what the :class:`~databarc.importer.Importer` and the :class:`~databarc.aggregator.Aggregator` are doing, so that one can see where an import or aggregation spends its time without attaching a profiler. All instances record into the module-level :class:`Metrics` registry :data:`metrics`, which is shared by all threads of a process; :func:`~databarc.importer.import_with_processes` collects the metrics of its parsing and writing processes into the registry of the calling process. The registry can be written to a file (as JSON or in the Prometheus text format) at regular intervals with an :class:`Exporter`::
+
+	from databarc.metrics import metrics, Exporter
+	from databarc.importer import import_with_processes
+
+	with Exporter(metrics, 'databarc.prom', interval=30, format='prometheus'):
+		import_with_processes(Session, jobs, 6)
+
+The following metrics are recorded (timers in seconds):
+
+=================================== ======= =========================================================================
+name                                type    description
+=================================== ======= =========================================================================
+``importer_lines_total``            counter lines read
+``importer_parse_failures_total``   counter lines or values that couldn't be parsed, by ``kind``: ``'datetime'`` (lines without a timestamp, e.g. headers), ``'value'`` (unexpected exceptions converting a value) and ``'rejected'`` (rows rejected by the database, see :attr:`~databarc.importer.Importer.rejects`)
+``importer_records_total``          counter records built (or collected in bulk mode)
+``importer_records_skipped_total``  counter records skipped on commit because they were already in the database
+``importer_commit_seconds``         timer   :meth:`~databarc.importer.Importer.commit` latency
+``importer_copy_seconds``           timer   time spent loading with ``COPY`` in :attr:`~databarc.importer.Importer.bulk` mode (part of the commit)
+``parser_block_seconds``            timer   time spent parsing a block in the processes of :func:`~databarc.importer.import_with_processes`
+``parser_blocked_seconds``          timer   time these processes were blocked on full queues, i.e. waiting for the writers
+``aggregator_func_seconds``         timer   time spent in the :ref:`aggregation function <aggr_func>`, by ``func``; its count is the number of bins processed
+``aggregator_records_total``        counter records binned, by ``func``
+``aggregator_commit_seconds``       timer   commit latency of :meth:`~databarc.aggregator.Aggregator.finish`
+``aggregator_sql_seconds``          timer   time spent in the ``INSERT ... SELECT`` statement of :meth:`~databarc.aggregator.Aggregator.run_sql`, by ``func``
+=================================== ======= =========================================================================
+"""
+import os, json, time
+from threading import Lock, Thread, Event
+from contextlib import contextmanager
+
+
+class Metrics(object):
+	"""
+A registry of counters and timers, identified by a name and optional labels (keyword arguments with :obj:`str` values, as in the Prometheus data model). All methods are thread-safe.
+
+:Example:
+
+::
+
+	metrics.count('importer_parse_failures_total', kind='datetime')
+	with metrics.time('importer_commit_seconds'):
+		session.commit()
+	"""
+	def __init__(self):
+		self.__lock = Lock()
+		self.reset()
+
+	def count(self, name, n=1, **labels):
+		"""Adds *n* to the counter *name*."""
+		key = (name, tuple(sorted(labels.iteritems())))
+		with self.__lock:
+			self.__counters[key] = self.__counters.get(key, 0) + n
+
+	def observe(self, name, seconds, **labels):
+		"""Records one measurement of *seconds* in the timer *name*."""
+		key = (name, tuple(sorted(labels.iteritems())))
+		with self.__lock:
+			c, s, m = self.__timers.get(key, (0, 0., 0.))
+			self.__timers[key] = (c+1, s+seconds, max(m, seconds))
+
+	@contextmanager
+	def time(self, name, **labels):
+		"""Context manager recording the time spent in its block in the timer *name* (also if the block raises)."""
+		t = time.time()
+		try:
+			yield
+		finally:
+			self.observe(name, time.time()-t, **labels)
+
+	def snapshot(self, reset=False):
+		"""
+Returns the current values as a picklable :obj:`dict`, which can be given to :meth:`merge` (e.g. in another process).
+
+:param bool reset: if ``True``, the registry is reset at the same time, so that the snapshot contains the changes since the last one
+		"""
+		with self.__lock:
+			s = {'counters': dict(self.__counters), 'timers': dict(self.__timers)}
+			if reset:
+				self.__counters, self.__timers = {}, {}
+		return s
+
+	def merge(self, snapshot):
+		"""Adds the values of a :meth:`snapshot` to this registry."""
+		with self.__lock:
+			for k,n in snapshot['counters'].iteritems():
+				self.__counters[k] = self.__counters.get(k, 0) + n
+			for k,(c,s,m) in snapshot['timers'].iteritems():
+				C, S, M = self.__timers.get(k, (0, 0., 0.))
+				self.__timers[k] = (C+c, S+s, max(M, m))
+
+	def reset(self):
+		"""Removes all values."""
+		with self.__lock:
+			self.__counters, self.__timers = {}, {}
+
+	def json(self):
+		"""Returns the values as JSON text, with the timers as objects with keys ``count``, ``sum`` and ``max``."""
+		s = self.snapshot()
+		return json.dumps({
+			'time': time.time(),
+			'counters': dict((_name(k), v) for k,v in s['counters'].iteritems()),
+			'timers': dict((_name(k), {'count': c, 'sum': t, 'max': m}) for k,(c,t,m) in s['timers'].iteritems())
+		}, indent=1, sort_keys=True)
+
+	def prometheus(self):
+		"""Returns the values in the Prometheus text format, with the timers as summaries (``_sum`` and ``_count``)."""
+		s = self.snapshot()
+		lines, types = [], set()
+		for k,v in sorted(s['counters'].iteritems()):
+			if k[0] not in types:
+				lines.append('# TYPE {} counter'.format(k[0]))
+				types.add(k[0])
+			lines.append('{} {}'.format(_name(k), v))
+		for k,(c,t,m) in sorted(s['timers'].iteritems()):
+			if k[0] not in types:
+				lines.append('# TYPE {} summary'.format(k[0]))
+				types.add(k[0])
+			lines.append('{} {!r}'.format(_name((k[0]+'_sum', k[1])), t))
+			lines.append('{} {}'.format(_name((k[0]+'_count', k[1])), c))
+		return '\n'.join(lines) + '\n'
+
+	def write(self, path, format='json'):
+		"""Writes the values to the file *path* in *format* (``'json'`` or ``'prometheus'``), replacing it atomically so that readers never see a partial file."""
+		tmp = '{}.tmp'.format(path)
+		with open(tmp, 'w') as file:
+			file.write(self.json() if format=='json' else self.prometheus())
+		os.rename(tmp, path)
+
+
+class Exporter(Thread):
+	"""
+:class:`~threading.Thread` which writes the values of a :class:`Metrics` registry to a file every *interval* seconds (see :meth:`Metrics.write`), and a last time when stopped. Can be used as a context manager, which starts and stops it.
+
+:param metrics: the registry, usually :data:`metrics`
+
+:param str path: path of the file
+
+:param interval: seconds between writes
+
+:param str format: ``'json'`` or ``'prometheus'``
+	"""
+	def __init__(self, metrics, path, interval=60, format='json'):
+		super(Exporter, self).__init__(name='metrics exporter')
+		self.setDaemon(True)
+		self.metrics, self.path, self.interval, self.format = metrics, path, interval, format
+		self.__stopped = Event()
+
+	def run(self):
+		while not self.__stopped.wait(self.interval):
+			self.metrics.write(self.path, self.format)
+
+	def stop(self):
+		"""Stops the thread and writes the file once more."""
+		self.__stopped.set()
+		self.join()
+		self.metrics.write(self.path, self.format)
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *args):
+		self.stop()
+
+
+def _name(key):
+	# name{label="value",...} as in the Prometheus text format
+	name, labels = key
+	if not labels:
+		return name
+	return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k,v in labels))
+
+
+metrics = Metrics()
+"""the :class:`Metrics` registry the :class:`~databarc.importer.Importer` and :class:`~databarc.aggregator.Aggregator` record into"""
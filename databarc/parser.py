@@ -0,0 +1,608 @@
+"""
+Using the parser module
+=======================
+
+The parser module contains an alternative to the row-at-a-time loop of :meth:`Importer.do <databarc.importer.Importer.do>`, which slices (or splits) every line, calls :obj:`int` on every cell and constructs a :class:`~datetime.datetime` per line. :class:`BlockParser` instead memory-maps the file and parses whole blocks of lines at once into :mod:`numpy` arrays: ``datetime64`` timestamps, :obj:`int` / :obj:`float` values and masks for values matching the ``missing`` pattern of a :ref:`field_dict <field_dict>`. It is used by the :class:`~databarc.importer.Importer` if :attr:`~databarc.importer.Importer.vectorize` is set, but can also be used on its own::
+
+	from databarc.parser import BlockParser
+	from databarc.importer import NCDC_isd_lite
+
+	with open('010010-99999-2015') as file:
+		for block in BlockParser(NCDC_isd_lite).blocks(file):
+			temp = block.x[(13,19)][block.ok[(13,19)] & block.valid]
+
+Both the :ref:`fixed-width <fixedwidth>` style (:obj:`tuple` keys, which become fixed byte offsets) and the delimited style (:obj:`int` keys, e.g. :data:`~databarc.importer.DMI_subd`) are supported. A cell is considered valid if and only if the python conversion (:obj:`int`, :obj:`float` or :meth:`Record_num.to_scaled <databarc.schema.Record_num.to_scaled>`, depending on the :class:`~databarc.schema.Record` subclass) would succeed on it, and gives the same value (except that :obj:`int` and scaled values have to fit into 64 bits, as they have to in the database); cells which the vectorized code can't decide on (e.g. ``'1e3'`` or ``'nan'``) are converted in python. Lines whose timestamp can't be parsed (such as headers) are marked as not :attr:`~Block.valid`.
+
+.. note::
+	The vectorized path can't be used with a callable ``'datetime'`` entry in the field_dict, nor for delimited files containing quote characters (which :func:`csv.reader` would interpret). :class:`BlockParser` raises :exc:`NotVectorizable` in those cases.
+"""
+import os, stat, mmap, csv
+import numpy as np
+from re import compile
+from datetime import datetime
+from itertools import islice
+from databarc.schema import Record_num
+
+
+class NotVectorizable(Exception):
+	"""Raised by :class:`BlockParser` if a field_dict or file can't be parsed by the vectorized code."""
+	pass
+
+
+class Block(object):
+	"""
+The result of parsing one block of lines with :class:`BlockParser`. All arrays have one entry per line.
+
+:ivar int lines: number of lines in the block
+
+:ivar int start: byte offset of the block in the file
+
+:ivar int end: byte offset of the end of the block in the file
+
+:ivar t: timestamps as ``datetime64[us]`` array (undefined where not :attr:`valid`)
+
+:ivar valid: :obj:`bool` array, ``False`` for lines whose timestamp couldn't be parsed
+
+:ivar dict x: value arrays by field_dict key; ``int64`` for :class:`~databarc.schema.Record_int`, ``float64`` for :class:`~databarc.schema.Record_float` and scaled ``int64`` (see :meth:`~databarc.schema.Record_num.to_scaled`) for :class:`~databarc.schema.Record_num` (undefined where not :attr:`ok`)
+
+:ivar dict ok: :obj:`bool` arrays by field_dict key, ``True`` where a value could be parsed and isn't missing
+
+:ivar dict missing: :obj:`bool` arrays by field_dict key, ``True`` where the ``missing`` pattern matched
+
+:ivar list failed: (line number within the block, line) tuples for the lines which are not :attr:`valid`
+
+:ivar station: station ids as ``int64`` array if the field_dict has a ``'station'`` column (see :class:`~databarc.importer.MultiImporter`), otherwise ``None``; lines whose station id can't be parsed are not :attr:`valid`
+
+:ivar line: (0-based) line numbers in the file as ``int64`` array if set by the caller, which :meth:`select` keeps for the selected lines (e.g. for the parts of each station of :class:`~databarc.importer.MultiImporter`), otherwise ``None``; :meth:`Importer.load <databarc.importer.Importer.load>` then numbers the lines from its own line counter
+	"""
+	def __init__(self, start, end, lines):
+		self.start = start
+		self.end = end
+		self.lines = lines
+		self.x = {}
+		self.ok = {}
+		self.missing = {}
+		self.station = None
+		self.line = None
+
+	def select(self, index):
+		"""
+Returns a new block with only some of the lines of this one, and without :attr:`failed` lines.
+
+:param index: :obj:`bool` mask or integer index array of the lines
+		"""
+		t = self.t[index]
+		block = Block(self.start, self.end, len(t))
+		block.t, block.valid, block.failed = t, self.valid[index], []
+		for d,e in ((self.x, block.x), (self.ok, block.ok), (self.missing, block.missing)):
+			for k,v in d.iteritems():
+				e[k] = v[index]
+		if self.station is not None:
+			block.station = self.station[index]
+		if self.line is not None:
+			block.line = self.line[index]
+		return block
+
+
+class BlockParser(object):
+	"""
+Vectorized parser for a :ref:`field_dict <field_dict>` (see the :mod:`module docstring <databarc.parser>`).
+
+:param dict field_dict: the field_dict, which is not modified
+
+:param str delimiter: delimiter for field_dicts with :obj:`int` keys
+	"""
+
+	block_size = 2**20
+	"""approximate size in bytes of the blocks yielded by :meth:`blocks`"""
+
+	max_width = 40
+	"""cells wider than this are converted in python"""
+
+	def __init__(self, field_dict, delimiter=','):
+		if 'datetime' in field_dict:
+			raise NotVectorizable('callable datetime entries need the row-at-a-time parser')
+		time = {}
+		self.fields = {}
+		self.station = None
+		for k,v in field_dict.iteritems():
+			if v=='station':
+				self.station = k
+			elif isinstance(v, basestring):
+				time[_time.index(v)] = k
+			else:
+				m = v.get('missing')
+				if m is not None and not (_meta & set(m)):
+					m = np.frombuffer(m, np.uint8)
+				elif m is not None:
+					m = compile(m)
+				self.fields[k] = (v['type'].__mapper__.polymorphic_identity, m)
+		# the time columns are used positionally (year, month, day, ...), as by the Importer
+		self.time = [time[i] for i in sorted(time)]
+		if len(self.time)<3:
+			raise NotVectorizable('year, month and day columns are required')
+		self.csv = isinstance(self.time[0], int)
+		self.delimiter = ord(delimiter)
+
+	def blocks(self, file, start=0, end=None):
+		"""
+Generator yielding a :class:`Block` for each chunk of about :attr:`block_size` bytes (aligned on lines) of *file*, which is memory-mapped.
+
+:param file file: an opened, regular file
+
+:param int start: byte offset from which to start parsing
+
+:param int end: byte offset at which to stop parsing (the end of the file if ``None``); has to be at the start of a line, as returned by :func:`line_ranges`
+		"""
+		try: mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError: return # empty file
+		try:
+			size = mm.size() if end is None else min(end, mm.size())
+			if self.csv and mm.find('"', start, size)>=0:
+				raise NotVectorizable('quoted delimited files need the csv module')
+			while start<size:
+				stop = mm.rfind('\n', start, start+self.block_size)+1
+				if stop<=start or start+self.block_size>=size:
+					stop = min(mm.find('\n', start+self.block_size)+1 or size, size)
+				# copy, so that nothing references the map once it is closed
+				buf = np.frombuffer(mm[start:stop], np.uint8)
+				yield self.parse(buf, start)
+				start = stop
+		finally:
+			mm.close()
+
+	def parse(self, buf, start=0):
+		"""
+Parses a buffer of complete lines.
+
+:param buf: the lines as ``uint8`` array, or :obj:`str`
+
+:param int start: byte offset of *buf* in the file (for :attr:`Block.start`)
+
+:rtype: :class:`Block`
+		"""
+		if isinstance(buf, str):
+			buf = np.frombuffer(buf, np.uint8)
+		nl = np.flatnonzero(buf==10)
+		if len(buf) and buf[-1]!=10:
+			nl = np.r_[nl, len(buf)]
+		ls = np.r_[0, nl[:-1]+1]
+		block = Block(start, start+len(buf), len(nl))
+		cols = self.__split(buf, nl, ls) if self.csv else self.__slice(nl, ls)
+
+		t, valid = [], np.ones(len(nl), bool)
+		for k in self.time:
+			x, ok, m = _convert(buf, cols(k), 'int', width=self.max_width)
+			valid &= ok
+			t.append(x)
+		if self.station is not None:
+			block.station, ok, m = _convert(buf, cols(self.station), 'int', width=self.max_width)
+			valid &= ok
+		block.t, ok = _datetime64(t, valid)
+		block.valid = valid & ok
+		block.failed = [(i, buf[ls[i]:nl[i]].tostring()) for i in np.flatnonzero(~block.valid)]
+
+		for k,(kind,missing) in self.fields.iteritems():
+			block.x[k], ok, block.missing[k] = _convert(buf, cols(k), kind, missing, self.max_width)
+			block.ok[k] = ok & ~block.missing[k]
+		return block
+
+	def __slice(self, nl, ls):
+		# fixed-width: the tuple keys are fixed offsets from the line starts
+		def cols(k):
+			S = ls + k[0]
+			E = np.minimum(ls + k[1], nl)
+			return S, np.maximum(E, S)
+		return cols
+
+	def __split(self, buf, nl, ls):
+		# delimited: the separators (delimiters and line ends) are counted per line
+		seps = np.flatnonzero((buf==self.delimiter) | (buf==10))
+		if len(buf) and buf[-1]!=10:
+			seps = np.r_[seps, len(buf)]
+		first = np.r_[0, np.searchsorted(seps, nl[:-1], 'right')]
+		count = np.diff(np.r_[first, len(seps)])
+		n = len(nl)
+		def cols(k):
+			has = count>k
+			i = first[has] + k
+			S = np.full(n, -1, np.int64)
+			E = np.full(n, -1, np.int64)
+			E[has] = seps[i]
+			S[has] = seps[i-1]+1 if k>0 else ls[has]
+			return S, E
+		return cols
+
+
+class RowParser(object):
+	"""
+Row-at-a-time counterpart of :class:`BlockParser`, for field_dicts and files the vectorized code can't handle (see :exc:`NotVectorizable`). Each line is parsed by the function made with :func:`compile_row`, but the lines are grouped into the same :class:`Block` objects, so that the results of both parsers can be handled alike (e.g. sent to another process, as :func:`~databarc.importer.import_with_processes` does). :attr:`Block.missing` is determined separately, by testing the ``missing`` patterns on the cells.
+
+:param dict field_dict: the field_dict, which is not modified
+
+:param str delimiter: delimiter for field_dicts with :obj:`int` keys
+	"""
+
+	block_lines = 10**4
+	"""number of lines per :class:`Block`"""
+
+	def __init__(self, field_dict, delimiter=','):
+		self.row, self.keys = compile_row(field_dict)
+		self.kinds = [field_dict[k]['type'].__mapper__.polymorphic_identity for k in self.keys]
+		k = [k for k in field_dict if k!='datetime']
+		self.csv = isinstance(k[0], int)
+		self.delimiter = delimiter
+		cell = (lambda k: lambda s: s[k]) if self.csv else (lambda k: lambda s: s[k[0]:k[1]])
+		k = [k for k in k if field_dict[k]=='station']
+		self.station = cell(k[0]) if k else None
+		self.missing = {}
+		for k in self.keys:
+			m = field_dict[k].get('missing')
+			if m is not None:
+				test = compile(m).search if _meta & set(m) else (lambda m: lambda c: m in c)(m)
+				self.missing[k] = (cell(k), test)
+
+	def blocks(self, file, start=0, end=None):
+		"""
+Generator yielding a :class:`Block` for every :attr:`block_lines` lines of *file*.
+
+:param file: an opened file, or any other iterable of lines
+
+:param int start: byte offset of the first line (for :attr:`Block.start` and :attr:`Block.end`)
+
+:param int end: if given, *file* has to be an opened, regular file; it is read from *start* to *end*, which have to be at the start of a line (as returned by :func:`line_ranges`)
+		"""
+		pos = [start]
+		if end is not None:
+			file.seek(start)
+			file = iter(file.readline, '')
+		def lines():
+			for line in file:
+				if end is not None and pos[0]>=end:
+					return
+				pos[0] += len(line)
+				yield line
+		rows = csv.reader(lines(), delimiter=self.delimiter) if self.csv else lines()
+		while True:
+			chunk = list(islice(rows, self.block_lines))
+			if not chunk:
+				return
+			yield self.parse(chunk, start, pos[0])
+			start = pos[0]
+
+	def parse(self, rows, start=0, end=0):
+		"""
+Parses a list of rows (lists of cells for delimited, lines for fixed-width field_dicts).
+
+:rtype: :class:`Block`
+		"""
+		n = len(rows)
+		block = Block(start, end, n)
+		t, x = [], [[] for k in self.keys]
+		block.valid = np.ones(n, bool)
+		block.failed = []
+		station = self.station
+		if station is not None:
+			block.station = np.zeros(n, np.int64)
+		for i,s in enumerate(rows):
+			r = self.row(s, i)
+			if r is not None and station is not None:
+				try: block.station[i] = int(station(s))
+				except (ValueError, IndexError, OverflowError): r = None
+			if r is None:
+				block.valid[i] = False
+				block.failed.append((i, s))
+				t.append(_epoch)
+				for v in x:
+					v.append(SKIP)
+			else:
+				t.append(r[0])
+				for v,y in zip(x, r[1]):
+					v.append(y)
+		block.t = np.array(t, 'datetime64[us]')
+		for k,kind,v in zip(self.keys, self.kinds, x):
+			ok = np.array([y is not SKIP for y in v], bool)
+			v = [y if y is not SKIP else 0 for y in v]
+			try: a = np.array(v, np.float64 if kind=='float' else np.int64)
+			except OverflowError: a = np.array(v, object)
+			block.x[k], block.ok[k] = a, ok
+		for k in self.keys:
+			block.missing[k] = m = np.zeros(n, bool)
+			if k in self.missing:
+				cell, test = self.missing[k]
+				for i,s in enumerate(rows):
+					try: m[i] = bool(test(cell(s)))
+					except IndexError: pass
+		return block
+
+
+class Column(object):
+	"""
+The values of one field of a file, as returned by :func:`read`. All arrays have one entry per line with a valid timestamp, in the order of the file.
+
+:ivar str name: name of the field
+
+:ivar t: timestamps as ``datetime64[us]`` array
+
+:ivar x: values, with the types of :attr:`Block.x` (undefined where not :attr:`ok`)
+
+:ivar ok: :obj:`bool` array, ``True`` where a value could be parsed and isn't missing
+
+:ivar missing: :obj:`bool` array, ``True`` where the ``missing`` pattern matched
+
+:ivar flagged: :obj:`bool` array, ``True`` where the value is one of the :attr:`flags`
+
+:ivar dict flags: descriptions of the in-data flag values of the field (see :ref:`flags <flags>`), by value
+	"""
+	def __init__(self, name, t, x, ok, missing, flags, scale=0):
+		self.name = name
+		self.t, self.x, self.ok, self.missing = t, x, ok, missing
+		self.flags = dict((f['value'], f.get('desc')) for f in flags if f.get('in_data'))
+		# the values of Record_num fields are scaled
+		values = [v * 10**scale for v in self.flags]
+		if x.dtype==object:
+			self.flagged = np.array([v in values for v in x], bool)
+		else:
+			self.flagged = np.in1d(x, values)
+		self.flagged &= ok
+
+	def __repr__(self):
+		return '<{} {}: {} of {} values>'.format(self.__class__.__name__, self.name, self.ok.sum(), len(self.t))
+
+
+def read(file, field_dict, delimiter=','):
+	"""
+Reads a file with a :ref:`field_dict <field_dict>` into :mod:`numpy` arrays, without a database (e.g. for a quick look at the data, or to analyze it without importing it first). Regular files are parsed by a :class:`BlockParser` if the field_dict allows it, otherwise (and for other iterables of lines) by a :class:`RowParser`. No values are left out because of records already in a database, and the ``mult`` factors are not applied.
+
+:param file: an opened file, or any other iterable of lines
+
+:param dict field_dict: the field_dict, which is not modified
+
+:param str delimiter: delimiter for field_dicts with :obj:`int` keys
+
+:return: a :obj:`dict` of :class:`Column` objects by field name
+
+:Example:
+
+::
+	
+	from databarc.parser import read
+	from databarc.importer import NCDC_isd_lite
+	
+	with open('010010-99999-2015') as file:
+		temp = read(file, NCDC_isd_lite)['temp isd NCDC']
+	t, x = temp.t[temp.ok], temp.x[temp.ok]
+	"""
+	try: regular = stat.S_ISREG(os.fstat(file.fileno()).st_mode)
+	except (AttributeError, IOError, OSError, ValueError): regular = False
+	blocks = None
+	if regular:
+		try: blocks = list(BlockParser(field_dict, delimiter).blocks(file))
+		except NotVectorizable: pass # raised before anything is read
+	if blocks is None:
+		blocks = RowParser(field_dict, delimiter).blocks(file)
+	keys = [k for k,v in field_dict.iteritems() if not isinstance(v, basestring) and k!='datetime']
+	t, x = [], dict((k, ([], [], [])) for k in keys)
+	for b in blocks:
+		t.append(b.t[b.valid])
+		for k in keys:
+			for a,c in zip(x[k], (b.x[k], b.ok[k], b.missing[k])):
+				a.append(c[b.valid])
+	cat = lambda a, dtype: np.concatenate(a) if a else np.zeros(0, dtype)
+	t = cat(t, 'datetime64[us]')
+	scale = lambda k: Record_num.scale if issubclass(field_dict[k]['type'], Record_num) else 0
+	return dict((field_dict[k]['name'], Column(field_dict[k]['name'], t, cat(x[k][0], object), cat(x[k][1], bool), cat(x[k][2], bool), field_dict[k].get('flags', []), scale(k))) for k in keys)
+
+
+def line_ranges(file, size):
+	"""
+Divides a file into byte ranges of about *size* bytes each, which begin and end at the start of a line, so that they can be parsed independently (by :meth:`BlockParser.blocks` or :meth:`RowParser.blocks`).
+
+:param file file: an opened, regular file
+
+:param int size: approximate size of the ranges in bytes
+
+:return: a :obj:`list` of ``(start, end)`` tuples, in the order of the file
+	"""
+	file.seek(0, 2)
+	total = file.tell()
+	ranges, start = [], 0
+	while start<total:
+		file.seek(start+size-1)
+		file.readline()
+		end = min(file.tell(), total)
+		ranges.append((start, end))
+		start = end
+	return ranges
+
+
+SKIP = object()
+"""sentinel returned by the functions made with :func:`compile_row` for values that are missing or can't be converted"""
+
+
+def compile_row(field_dict, log=None):
+	"""
+Compiles a :ref:`field_dict <field_dict>` into a single python function parsing one row, which is what :meth:`Importer.do <databarc.importer.Importer.do>` calls for every line unless :attr:`~databarc.importer.Importer.vectorize` is used. The source of the function is generated with the column indexes (or slices) as constants, literal ``missing`` patterns are tested with the ``in`` operator instead of a regular expression search (which gives the same result), the year, month and day are only converted when the date changes from the previous line, and the values are converted to the python type of the :class:`~databarc.schema.Record` subclass.
+
+The returned function is called as ``row(s, l)``, with *s* the list of cells (delimited files) or the line (fixed-width files) and *l* the line number, which is only handed on to *log*. It returns ``None`` if the timestamp can't be parsed, otherwise a tuple ``(t, values)`` with the values in the order of the returned keys; values that are missing or not convertible are :data:`SKIP`. No exceptions are raised by the function.
+
+:param dict field_dict: the field_dict, which is not modified
+
+:param log: callable ``log(l, key, exception)`` for unexpected exceptions (i.e. other than :exc:`ValueError` and :exc:`ArithmeticError`) during the conversion of a value
+
+:returns: (function, keys)
+	"""
+	ns = {'datetime': datetime, 'SKIP': SKIP, 'log': log or (lambda l,k,E: None)}
+	time, keys = {}, []
+	for k,v in field_dict.iteritems():
+		if k=='datetime':
+			ns['dt'] = v
+		elif v=='station':
+			pass # used by MultiImporter
+		elif isinstance(v, basestring):
+			time[_time.index(v)] = k
+		else:
+			keys.append(k)
+	if isinstance((keys or time.values() or [0])[0], int):
+		cell = lambda k: 's[{}]'.format(k)
+	else:
+		cell = lambda k: 's[{}:{}]'.format(*k)
+
+	src = ['def row(s, l):']
+	time = [time[i] for i in sorted(time)]
+	if 'dt' in ns or len(time)<3:
+		# the time columns are used positionally (year, month, day, ...)
+		t = 'dt(s)' if 'dt' in ns else 'datetime({})'.format(', '.join('int({})'.format(cell(c)) for c in time))
+		src.extend(['\ttry: t = {}'.format(t), '\texcept Exception: return None'])
+	else:
+		# the date of the previous line is kept, keyed by the date cells (or the slice spanning them)
+		ymd = time[:3]
+		if isinstance(ymd[0], int) or max(c[1] for c in ymd) - min(c[0] for c in ymd) > 16:
+			key = map(cell, ymd)
+		else:
+			key = [cell((min(c[0] for c in ymd), max(c[1] for c in ymd)))]
+		ns['last'] = [None] * (len(key)+1)
+		src.extend([
+			'\ttry:',
+			'\t\tif {}: Y, M, D = last[-1]'.format(' and '.join('{}==last[{}]'.format(k,i) for i,k in enumerate(key))),
+			'\t\telse:',
+			'\t\t\tY, M, D = {}'.format(', '.join('int({})'.format(cell(c)) for c in ymd)),
+			'\t\t\tlast[:] = [{}, (Y, M, D)]'.format(', '.join(key)),
+			'\t\tt = datetime({})'.format(', '.join(['Y', 'M', 'D'] + ['int({})'.format(cell(c)) for c in time[3:]])),
+			'\texcept Exception: return None'
+		])
+
+	for i,k in enumerate(keys):
+		v = field_dict[k]
+		ns['c{}'.format(i)] = _python[v['type'].__mapper__.polymorphic_identity]
+		x = 'c{}(c)'.format(i)
+		m = v.get('missing')
+		if m is not None and not (_meta & set(m)):
+			x = 'SKIP if {!r} in c else {}'.format(m, x)
+		elif m is not None:
+			ns['m{}'.format(i)] = compile(m)
+			x = 'SKIP if m{}.search(c) else {}'.format(i, x)
+		src.extend([
+			'\ttry:',
+			'\t\tc = {}'.format(cell(k)),
+			'\t\tx{} = {}'.format(i, x),
+			'\texcept (ValueError, ArithmeticError): x{} = SKIP'.format(i),
+			'\texcept Exception as E:',
+			'\t\tx{} = SKIP'.format(i),
+			'\t\tlog(l, {!r}, E)'.format(k)
+		])
+	src.append('\treturn t, ({})'.format(''.join('x{}, '.format(i) for i in range(len(keys)))))
+	exec '\n'.join(src) in ns
+	return ns['row'], keys
+
+
+# placeholder timestamp of lines that couldn't be parsed
+_epoch = datetime(1970,1,1)
+
+_time = ('year','month','day','hour','minute','second','microsecond')
+
+# regular expression syntax, patterns without it are searched for as literals
+_meta = set('.^$*+?{}[]\\|()')
+
+# python conversion of the cells the vectorized code doesn't handle
+_python = {'int': int, 'float': float, 'num': Record_num.to_scaled}
+
+# whitespace as stripped by int(), float() and Decimal()
+_space = np.zeros(256, bool)
+_space[[9,10,11,12,13,32]] = True
+
+
+def _cells(buf, S, E, width):
+	# gathers the cells into a (lines, width) matrix padded with spaces
+	n = np.clip(E-S, 0, width)
+	n[S<0] = 0
+	j = np.arange(width)
+	idx = np.clip(S[:,None] + j, 0, max(len(buf)-1, 0))
+	return np.where(j < n[:,None], buf[idx] if len(buf) else 32, 32).astype(np.uint8)
+
+
+def _convert(buf, (S, E), kind, missing=None, width=40):
+	"""
+Converts the cells given by start and end offsets *S*, *E* (-1 for lines without the cell), returning the values, a mask of the cells that could be converted and a mask of the cells matching *missing*. Cells wider than *width* are converted in python.
+	"""
+	lines = len(S)
+	exists = S>=0
+	wide = exists & (E-S > width)
+	c = _cells(buf, S, E, max(min(int((E-S)[exists].max()) if exists.any() else 1, width), 1))
+
+	digit = (c>=48) & (c<=57)
+	space = _space[c]
+	sign = (c==45) | (c==43)
+	dot = c==46
+
+	# the only non-space characters may be digits, a leading sign and (for floats) one dot
+	nonspace = ~space
+	j = np.arange(c.shape[1])
+	first = nonspace.argmax(1)
+	last = c.shape[1] - 1 - nonspace[:,::-1].argmax(1)
+	inner = (j>=first[:,None]) & (j<=last[:,None])
+	other = (nonspace & ~(digit | sign | dot)).any(1)
+	ok = exists & ~wide & ~other & digit.any(1) & ~(space & inner).any(1) & ~(sign & (j!=first[:,None])).any(1)
+	ndot = dot.sum(1)
+	ok &= (ndot==0) if kind=='int' else (ndot<=1)
+	python = wide | (exists & other)
+
+	frac = (digit & (np.cumsum(dot, 1)>0)).sum(1)
+	if kind=='num':
+		# scaled integers, too many digits for int64 or more decimals than the scale (which need rounding)
+		big = ok & ((digit.sum(1) + Record_num.scale - frac > 18) | (frac > Record_num.scale))
+	else:
+		# too many digits for int64 (or for an exact float computation)
+		big = ok & (digit.sum(1) > (18 if kind=='int' else 15))
+	python |= big
+	ok &= ~big
+	# each digit is weighted by 10 to the power of the number of digits following it
+	digit &= ok[:,None]
+	following = np.cumsum(digit[:,::-1], 1)[:,::-1] - digit
+	v = (np.where(digit, c-48, 0).astype(np.int64) * 10**following).sum(1)
+	v[c[np.arange(lines), first]==45] *= -1
+	if kind=='int':
+		x = v
+	elif kind=='num':
+		x = v * 10**np.clip(Record_num.scale-frac, 0, None)
+	else:
+		# both operands are exact, hence the quotient is rounded as float() would
+		x = v / 10.**frac
+
+	m = np.zeros(lines, bool)
+	if isinstance(missing, np.ndarray):
+		k = len(missing)
+		for o in xrange(c.shape[1]-k+1):
+			m |= (c[:,o:o+k]==missing).all(1)
+		m &= exists
+		literal, regex, check = missing.tostring(), None, wide
+	else:
+		literal, regex, check = None, missing, exists & (missing is not None)
+	for i in np.flatnonzero(check | python):
+		s = buf[S[i]:E[i]].tostring()
+		if check[i] and (regex.search(s) if regex else literal in s):
+			m[i] = True
+		elif python[i]:
+			try: x[i] = _python[kind](s)
+			except Exception: pass
+			else: ok[i] = True
+	return x, ok, m
+
+
+def _datetime64(parts, valid):
+	"""
+Combines arrays of year, month, day[, hour, minute, second, microsecond] into ``datetime64[us]``, returning also a mask of combinations :class:`datetime.datetime` would accept.
+	"""
+	parts = parts + [np.zeros(len(valid), np.int64)] * (7-len(parts))
+	Y, M, D, h, m, s, us = parts
+	ok = valid & (Y>=1) & (Y<=9999) & (M>=1) & (M<=12) & (h>=0) & (h<24) & (m>=0) & (m<60) \
+		& (s>=0) & (s<60) & (us>=0) & (us<10**6)
+	Y = np.where(ok, Y, 1970)
+	M = np.where(ok, M, 1)
+	month = ((Y-1970)*12 + M-1).astype('datetime64[M]')
+	day = month.astype('datetime64[D]')
+	ok &= (D>=1) & (D <= ((month+1).astype('datetime64[D]') - day).astype(np.int64))
+	t = day + np.where(ok, D-1, 0).astype('timedelta64[D]')
+	t = t.astype('datetime64[us]') + ((np.where(ok, h, 0)*60 + np.where(ok, m, 0))*60 + np.where(ok, s, 0)).astype('timedelta64[s]') \
+		+ np.where(ok, us, 0).astype('timedelta64[us]')
+	return t, ok
@@ -13,16 +13,17 @@ corresponds to a row in the table 'field' with values 'windspeed', 'm/s' and '43
 .. note::
 	The attributes of the mapped classes can generally be populated by :obj:`str` objects, even if they represent number types in the database - *and vice versa*. SQLAlchemy will perform obvious conversions on persisting the data to the database.
 """
-from sqlalchemy import Column,Integer,String,Numeric,Float,Date,DateTime,Boolean,Interval,\
+from sqlalchemy import Column,Integer,BigInteger,String,Numeric,Float,Date,DateTime,Boolean,Interval,\
 	ForeignKey,Table,Index,cast,Text,UniqueConstraint,text,create_engine,and_,PickleType
 from sqlalchemy.ext.declarative import declarative_base,declared_attr
 from sqlalchemy.orm import relationship,sessionmaker,scoped_session,backref,column_property,\
 	object_session,validates
 from sqlalchemy.sql import select,func
 from sqlalchemy.types import TypeDecorator
+from contextlib import contextmanager
 from geoalchemy2 import Geography, Geometry
 from datetime import timedelta
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP
 
 
 def session(desc=None):
@@ -130,17 +131,87 @@ This has, among others, the following benefits:
 		primaryjoin='record_assoc.c.parent_id==record.c.id', 
 		secondaryjoin='record_assoc.c.child_id==record.c.id',
 	)
-	"""If the record's ``x`` value has been computed as a function of other records (e.g. an average over a period of time), contains a list of the original records used in the computation."""
+	"""If the record's ``x`` value has been computed as a function of other records (e.g. an average over a period of time), contains a list of the original records used in the computation, as rows of the ``record_assoc`` table. Records aggregated with compact provenance have a :attr:`bin_range` instead; :attr:`sources` returns the original records of either kind."""
+	bin_range = relationship('Bin_range', uselist=False, cascade='all, delete-orphan', passive_deletes=True)
+	"""the original records as :class:`Bin_range` (or ``None``), instead of :attr:`binned`"""
 	field_id = Column(Integer, ForeignKey('field.id',deferrable=True,initially='deferred',onupdate='CASCADE',ondelete='CASCADE'), nullable=False, index=True)
 	__mapper_args__ = {'polymorphic_on': type, 'with_polymorphic':'*'}
 	__table_args__ = (UniqueConstraint('field_id','t',deferrable=True,initially='deferred'),)
 	
+	@property
+	def sources(self):
+		"""
+The original records used in the computation of the record's ``x`` value, from :attr:`bin_range` if the record has one and from :attr:`binned` otherwise (read-only; this is a plain property, hence it can't be used in queries).
+		"""
+		if self.bin_range is not None:
+			return self.bin_range.records
+		return self.binned
+	
 	def __repr__(self):
 		s = '<{} id: {}, '.format(self.__class__.__name__, self.id)
 		if self.field: s = '{}field: {}, '.format(s,self.field.name)
 		return '{}date: {}, x: {}>'.format(s,self.t.strftime('%Y/%m/%d %H:%M'), self.x)
 
 
+class Bin_range(Base):
+	"""
+Compact record of the original records of an aggregated :class:`Record` (see :attr:`Record.bin_range` and :attr:`Record.sources`): instead of one row of the ``record_assoc`` table for each binned record, they are stored as the records of the parent :attr:`field` from :attr:`t_start` to :attr:`t_end` (both included) - a bin is always contiguous in time. This is written by the :class:`~databarc.aggregator.Aggregator` if :attr:`~databarc.aggregator.Aggregator.compact` is set. The ranges of many aggregated records can be resolved with one query per parent field by :meth:`load`.
+
+.. note::
+	The table is created with the others by :func:`~databarc.scripts.create`; in an existing database, it can be created with ``Bin_range.__table__.create(engine)``.
+	"""
+	id = Column(Integer, ForeignKey('record.id',deferrable=True,initially='deferred',onupdate='CASCADE',ondelete='CASCADE'), primary_key=True)
+	"""the :attr:`~Record.id` of the aggregated record"""
+	field_id = Column(Integer, ForeignKey('field.id',deferrable=True,initially='deferred',onupdate='CASCADE',ondelete='CASCADE'), nullable=False, index=True)
+	field = relationship('Field')
+	"""the parent :class:`Field` of the binned records"""
+	t_start = Column(DateTime, nullable=False)
+	"""timestamp of the first binned record"""
+	t_end = Column(DateTime, nullable=False)
+	"""timestamp of the last binned record"""
+	
+	@property
+	def records(self):
+		"""the binned records, ordered by :attr:`~Record.t`; queried when first accessed, unless they have been loaded by :meth:`load` or assigned"""
+		try:
+			return self.__records
+		except AttributeError:
+			self.__records = object_session(self).query(Record).filter(Record.field_id==self.field_id, 
+				Record.t>=self.t_start, Record.t<=self.t_end).order_by(Record.t).all()
+			return self.__records
+	
+	@records.setter
+	def records(self, records):
+		self.__records = records
+	
+	@staticmethod
+	def load(records):
+		"""
+Resolves the :attr:`Record.sources` of the aggregated *records* in bulk: the :attr:`Record.bin_range` of all of them is loaded with one query, and the binned records with one range query per parent field, instead of one or two queries per aggregated record. Afterwards, :attr:`Record.sources` doesn't emit any queries for records with a :class:`Bin_range` (and for those without, only the one for :attr:`Record.binned`).
+
+:param list records: aggregated :class:`Records <Record>` attached to a session
+		"""
+		from sqlalchemy.orm.attributes import set_committed_value
+		from bisect import bisect_left, bisect_right
+		if not records:
+			return
+		session = object_session(records[0])
+		ids = set(r.field_id for r in records)
+		ranges = dict((b.id, b) for b in session.query(Bin_range).join(Record, Record.id==Bin_range.id).filter(Record.field_id.in_(ids)))
+		by_field = {}
+		for r in records:
+			b = ranges.get(r.id)
+			set_committed_value(r, 'bin_range', b)
+			if b is not None:
+				by_field.setdefault(b.field_id, []).append(b)
+		for field_id, bins in by_field.iteritems():
+			parent = session.query(Record).filter(Record.field_id==field_id, Record.t>=min(b.t_start for b in bins), 
+				Record.t<=max(b.t_end for b in bins)).order_by(Record.t).all()
+			t = [r.t for r in parent]
+			for b in bins:
+				b.records = parent[bisect_left(t, b.t_start):bisect_right(t, b.t_end)]
+
+
 class Flag(Base):
 	"""
 Saves information about flag values and can be associated with a :class:`Field` via its :attr:`Field.flags` attribute (a :sqla:`many-t-many relationship<orm/basic_relationships.html#many-to-many>`). Flags can be set in either the data (i.e. the ``x`` attribute of :ref:`record_sub`) or the :attr:`Record.info` attribute. It is assumed that flag :attr:`values<value>` are integers.
@@ -216,6 +287,31 @@ flag_field = Table('flag_field', Base.metadata,
 )
 
 
+class Manifest(Base):
+	"""
+Records how far a file has been imported by an :class:`~databarc.importer.Importer` with :attr:`~databarc.importer.Importer.incremental` set, so that the next import of the same file (by :attr:`path`, :attr:`source` and :attr:`station_id`) can skip it if it hasn't changed, or resume at :attr:`pos` if data has only been appended.
+	"""
+	id = Column(Integer, primary_key=True)
+	path = Column(Text, nullable=False)
+	"""absolute path of the file"""
+	source = Column(String(100))
+	"""as :attr:`Field.source` of the imported fields"""
+	station_id = Column(Integer)
+	"""as :attr:`Field.station_id` of the imported fields"""
+	size = Column(BigInteger)
+	"""size of the file in bytes at the time of the import"""
+	mtime = Column(Float)
+	"""modification time of the file (as returned by :func:`os.stat`) at the time of the import"""
+	pos = Column(BigInteger)
+	"""byte offset up to which the file has been imported"""
+	digest = Column(String(40))
+	"""SHA-1 hex digest of the file's contents up to :attr:`pos`"""
+	
+	__table_args__ = (UniqueConstraint('path','source','station_id',deferrable=True,initially='deferred'),)
+	def __repr__(self):
+		return '<{} {}, source: {}, station_id: {}, pos: {}>'.format(self.__class__.__name__,self.path,self.source,self.station_id,self.pos)
+
+
 class ValidationError(Exception):
 	pass
 
@@ -252,12 +348,18 @@ class Record_num(Record):
 	"""
 This record class has a :class:`decimal.Decimal` pythonic type as :attr:`x`, which gets mapped to a :sqla:`Numeric <core/type_basics.html#sqlalchemy.types.Numeric>` type in the database. This guarantees that decimal numbers are saved as such and not as floating point numbers (not all decimal numbers have exact floating point representations).
 
+Since the values have a fixed number of decimal places (:attr:`scale`), they can also be handled exactly as :obj:`int` multiples of ``10**-scale``, which is much faster than :class:`~decimal.Decimal` arithmetic. The :mod:`~databarc.parser` and the :attr:`bulk <databarc.importer.Importer.bulk>` imports use such 'scaled integers' throughout, :attr:`x_scaled` reads them back from the database and the :class:`~databarc.aggregator.Aggregator` computes with them (see :meth:`~databarc.aggregator.Aggregator.unscaled`); :meth:`to_scaled` and :meth:`from_scaled` convert between both representations.
+
 .. note::
 	The CPython extension `cdecimal <https://pypi.python.org/pypi/cdecimal>`_ is faster than the pure python :mod:`decimal` and can be used as a replacement when installed - see this module's ``__init__.py`` file.
 	"""
 	id = Column(Integer,ForeignKey('record.id',deferrable=True,initially='deferred',onupdate='CASCADE',ondelete='CASCADE'),primary_key=True)
 	x = Column(Numeric(10,4))
 	"""recorded physical quantity (type :obj:`decimal`)"""
+	scale = 4
+	"""number of decimal places of :attr:`x`"""
+	x_scaled = column_property(cast(x * 10**scale, BigInteger), deferred=True)
+	""":attr:`x` as scaled :obj:`int`, computed by the database (deferred, i.e. only loaded when accessed or :func:`undeferred <sqlalchemy.orm.undefer>` in a query)"""
 	
 	@validates('x')
 	def validates_x(self, key, value):
@@ -265,6 +367,20 @@ This record class has a :class:`decimal.Decimal` pythonic type as :attr:`x`, whi
 		except TypeError: return None
 		except ValueError: raise ValidationError
 		else: return x
+	
+	@staticmethod
+	def to_scaled(value):
+		"""
+Converts *value* (e.g. a :obj:`str` or :class:`~decimal.Decimal`) to an :obj:`int` multiple of ``10**-scale``, rounding half away from zero like the database does.
+
+:raises: :exc:`ValueError` or :exc:`ArithmeticError` if *value* isn't a finite number
+		"""
+		return int(Decimal(value).scaleb(Record_num.scale).to_integral_value(ROUND_HALF_UP))
+	
+	@staticmethod
+	def from_scaled(value):
+		"""Converts the scaled :obj:`int` *value* back to a :class:`~decimal.Decimal`."""
+		return Decimal(value).scaleb(-Record_num.scale)
 		
 	__mapper_args__ = {'polymorphic_identity': 'num'}
 	
@@ -388,3 +504,82 @@ class Adj_Field(Field):
 	id = Column(Integer, ForeignKey('field.id',deferrable=True,initially='deferred',onupdate='CASCADE',ondelete='CASCADE'), primary_key=True)
 	time_adj = Column(Interval)
 	__mapper_args__ = {'polymorphic_identity': 'time_adjusted'}
+
+
+# the tables written by imports and aggregations
+_bulk_tables = tuple(m.local_table.name for m in Record.__mapper__.self_and_descendants) + ('record_assoc',)
+
+def _bulk_indexes(engine, tables, existing):
+	# the secondary indexes of *tables* as defined in the metadata, which (don't) exist in the database
+	from sqlalchemy import inspect
+	names = set(i['name'] for t in tables for i in inspect(engine).get_indexes(t))
+	return [i for t in tables for i in Base.metadata.tables[t].indexes if not i.unique and (i.name in names)==existing]
+
+@contextmanager
+def bulk_load(engine, tables=_bulk_tables, jobs=4):
+	"""
+Context manager for large backfills: drops the secondary indexes (on :attr:`Record.type`, :attr:`Record.field_id` and those of the ``record_assoc`` table) of *tables* in one transaction, so that they aren't updated with every loaded batch, and recreates them with :func:`restore_indexes` when the block is left - also if it is left by an exception or a :exc:`KeyboardInterrupt`. If the process is killed before that, run :func:`restore_indexes` (or the :func:`databarc-restore <databarc.scripts.restore>` script) before using the database again.
+
+The unique constraint on (:attr:`Record.field_id`, :attr:`Record.t`) is kept: both the :ref:`bulk loading <bulk>` and the lookup of the latest record of a field by the :class:`~databarc.importer.Importer` depend on its index.
+
+:param engine: a SQLAlchemy engine (the indexes are rebuilt on several connections)
+
+:param tuple tables: names of the tables whose indexes are dropped, by default ``record``, the tables of its subclasses and ``record_assoc``
+
+:param int jobs: number of indexes built in parallel
+
+:Example:
+
+::
+	
+	from databarc.schema import session, bulk_load
+	from databarc.importer import Importer, import_with_processes
+	
+	Session = session()
+	Importer.bulk = True
+	with bulk_load(Session.get_bind()):
+		import_with_processes(Session, jobs, 8, writers=2)
+	"""
+	indexes = _bulk_indexes(engine, tables, True)
+	with engine.begin() as conn:
+		for i in indexes:
+			i.drop(conn)
+	try:
+		yield
+	finally:
+		restore_indexes(engine, tables, jobs)
+
+def restore_indexes(engine, tables=_bulk_tables, jobs=4):
+	"""
+Recreates the secondary indexes of *tables* that are missing from the database exactly as defined in the schema (see :func:`bulk_load`), building up to *jobs* of them in parallel (each on its own connection), and runs ``ANALYZE`` on the tables afterwards. Indexes which exist are left alone, hence this can be called any number of times.
+
+:param engine: a SQLAlchemy engine
+
+:param tuple tables: names of the tables
+
+:param int jobs: number of indexes built in parallel
+	"""
+	from threading import Thread
+	from Queue import Queue, Empty
+	q, errors = Queue(), []
+	for i in _bulk_indexes(engine, tables, False):
+		q.put(i)
+	def build():
+		while True:
+			try: i = q.get_nowait()
+			except Empty: return
+			try:
+				with engine.begin() as conn:
+					i.create(conn)
+			except Exception as E:
+				errors.append(E)
+	threads = [Thread(target=build) for n in range(min(jobs, q.qsize()))]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	if errors:
+		raise errors[0]
+	with engine.begin() as conn:
+		for t in tables:
+			conn.execute('ANALYZE {}'.format(t))
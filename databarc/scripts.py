@@ -38,4 +38,23 @@ The description is used used with :func:`.schema.session` to retrieve a particul
 	eng = create_engine(url)
 	if not eng.table_names():
 		eng.execute('create extension postgis;')
-		Base.metadata.create_all(bind=eng)
\ No newline at end of file
+		Base.metadata.create_all(bind=eng)
+
+def restore():
+	"""
+This function is installed as command-line script ``databarc-restore``. It recreates the indexes dropped by :func:`~databarc.schema.bulk_load` if a backfill was killed before it could do so itself (see :func:`~databarc.schema.restore_indexes`).
+
+:param arg1: description of the database connection in the configuration file (optional, as for :func:`.schema.session`)
+:param arg2: number of indexes built in parallel (optional, default 4)
+
+:Example:
+
+::
+
+	databarc-restore description 4
+	"""
+	import sys
+	from databarc.schema import session, restore_indexes
+	desc = sys.argv[1] if len(sys.argv)>1 else None
+	jobs = int(sys.argv[2]) if len(sys.argv)>2 else 4
+	restore_indexes(session(desc).get_bind(), jobs=jobs)
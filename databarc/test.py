@@ -3,16 +3,32 @@ import unittest
 def rec(f):
 	return [round(r.x,11) for r in f.records]
 
+def connect():
+	# the test database, in which all tests roll back what they do
+	from sqlalchemy import create_engine
+	return create_engine('postgresql://arno@/DMI').connect()
+
+def nested_session(connection):
+	# a session whose commits and rollbacks only go to a savepoint in the connection's transaction
+	from sqlalchemy import event
+	from sqlalchemy.orm import Session
+	S = Session(bind=connection)
+	S.begin_nested()
+	@event.listens_for(S, 'after_transaction_end')
+	def restart(session, transaction):
+		if transaction.nested and not transaction._parent.nested:
+			session.expire_all()
+			session.begin_nested()
+	return S
+
 class TestAggregation(unittest.TestCase):
 	@classmethod
 	def setUpClass(cls):
 		from sqlalchemy.orm import sessionmaker, scoped_session
-		from sqlalchemy import create_engine
 		from databarc.schema import Aggregate_field
 		from databarc.aggregator import Daily_aggregator, DMI_daily 
 		
-		engine = create_engine('postgresql://arno@/DMI')
-		cls.connection = engine.connect()
+		cls.connection = connect()
 		cls.trans = cls.connection.begin()
 		cls.S = scoped_session(sessionmaker(bind=cls.connection))
 		cls.S.autoflush = False
@@ -32,6 +48,106 @@ class TestAggregation(unittest.TestCase):
 		a = [f for f in self.a if f.code=='d'][0]
 		b = [b.field for b in self.b if b.field.code=='d'][0]
 		self.assertEqual(rec(a),rec(b))
+	
+	def setUp(self):
+		# the fields of each test are rolled back after it
+		self.S.begin_nested()
+	
+	def tearDown(self):
+		self.S.rollback()
+	
+	def parent(self, type, until=None):
+		# a field of a made-up station with a record every 6 hours from 30 Jan to 3 Mar 2000, except on 10 Feb, 
+		# missing values from 14 to 16 Feb (and every 11th), and trace (-1) flag values; only before *until* if given
+		from databarc.schema import Field, Flag
+		station_id = 99990 + self.S.query(Field).filter_by(source='TEST').count()
+		f = Field(name='x', code='x', station_id=station_id, source='TEST')
+		f.flags = [self.S.query(Flag).filter_by(value=-1, in_data=True).first() or Flag(value=-1, desc='trace', in_data=True)]
+		self.extend(f, type, until=until)
+		return f
+	
+	def extend(self, field, type, since=None, until=None):
+		from datetime import datetime, timedelta
+		for i in range(33*4):
+			t = datetime(2000,1,30) + timedelta(hours=6*i)
+			if t.day!=10 and (since is None or t>=since) and (until is None or t<until):
+				field.records.append(type(t=t, x=None if t.day in (14, 15, 16) or i%11==0 else (i*7)%23-3))
+		self.S.add(field)
+		self.S.flush()
+	
+	def aggregate(self, cls, parent, sql=False, incremental=False, compact=False, **kw):
+		# the records of the aggregation of *parent* (as read back from the database) as (t, x, info, source timestamps)
+		from databarc.schema import Record, Bin_range
+		from databarc.aggregator import Aggregator
+		switches = dict(sql=sql, incremental=incremental, compact=compact)
+		for k,v in switches.iteritems():
+			setattr(Aggregator, k, v)
+		try:
+			a = cls(parent=parent, commit=False, **kw)
+			a.run()
+		finally:
+			for k in switches:
+				setattr(Aggregator, k, False)
+		self.S.flush()
+		self.S.expire_all()
+		records = self.S.query(Record).filter(Record.field_id==a.field.id).order_by(Record.t).all()
+		Bin_range.load(records)
+		return [(r.t, None if r.x is None else round(r.x, 9), r.info, [b.t for b in r.sources]) for r in records]
+	
+	def test_sql(self):
+		from databarc.schema import Record_int, Record_float
+		from databarc.aggregator import Daily_aggregator, Monthly_aggregator, ave, rain_month
+		for cls in (Daily_aggregator, Monthly_aggregator):
+			for func, type in ((ave, Record_float), (ave, Record_int), (rain_month, Record_int)):
+				for zero_incl in (True, False):
+					p = self.parent(type)
+					kw = dict(type=type, func=func, zero_incl=zero_incl)
+					a = self.aggregate(cls, p, **kw)
+					b = self.aggregate(cls, p, sql=True, name='x sql', **kw)
+					self.assertEqual(a, b, '{} {} {} zero_incl={}'.format(cls.__name__, func.__name__, type.__name__, zero_incl))
+	
+	def test_sql_fallback(self):
+		from databarc.schema import Record_float
+		from databarc.aggregator import Aggregator, Daily_aggregator, ave
+		class Plain(Daily_aggregator):
+			bin_sql = Aggregator.__dict__['bin_sql']
+		p = self.parent(Record_float)
+		a = self.aggregate(Daily_aggregator, p, type=Record_float, func=ave)
+		b = self.aggregate(Plain, p, sql=True, name='x plain', type=Record_float, func=ave)
+		self.assertEqual(a, b)
+	
+	def test_incremental(self):
+		from datetime import datetime
+		from databarc.schema import Record_int, Record_float
+		from databarc.aggregator import Daily_aggregator, Monthly_aggregator, ave, rain_month
+		for cls, func, type in ((Daily_aggregator, ave, Record_float), (Monthly_aggregator, rain_month, Record_int)):
+			for zero_incl in (True, False):
+				for sql in (False, True):
+					kw = dict(type=type, func=func, zero_incl=zero_incl)
+					a = self.aggregate(cls, self.parent(type), sql=sql, **kw)
+					# in the middle of a day and month, and after the first record of a month
+					for until in (datetime(2000,2,20,9), datetime(2000,3,1,6)):
+						p = self.parent(type, until=until)
+						self.aggregate(cls, p, sql=sql, **kw)
+						self.extend(p, type, since=until)
+						b = self.aggregate(cls, p, sql=sql, incremental=True, **kw)
+						msg = '{} {} zero_incl={} sql={} until {}'.format(cls.__name__, func.__name__, zero_incl, sql, until)
+						self.assertEqual((len(p.aggregates), b), (1, a), msg)
+	
+	def test_compact(self):
+		from databarc.schema import Record, Record_int, Record_float, Bin_range
+		from databarc.aggregator import Daily_aggregator, Monthly_aggregator, ave, rain_month
+		for cls, func, type in ((Daily_aggregator, ave, Record_float), (Monthly_aggregator, rain_month, Record_int)):
+			for sql in (False, True):
+				p = self.parent(type)
+				kw = dict(type=type, func=func)
+				a = self.aggregate(cls, p, sql=sql, **kw)
+				b = self.aggregate(cls, p, sql=sql, compact=True, name='x compact', **kw)
+				ranges = self.S.query(Bin_range).filter_by(field_id=p.id).count()
+				self.assertEqual((ranges, b), (len(b), a), '{} {} sql={}'.format(cls.__name__, func.__name__, sql))
+				# Record.binned is the record_assoc relationship, which only the default provenance uses
+				assoc = dict((f.name, self.S.query(Record).filter(Record.field_id==f.id, Record.binned.any()).count()) for f in p.aggregates)
+				self.assertEqual(assoc, {'x '+cls.interval: len(a), 'x compact': 0})
 		
 # 	def test_t(self):
 # 		a = [f for f in self.a if f.code=='t'][0]
@@ -39,6 +155,216 @@ class TestAggregation(unittest.TestCase):
 # 		self.assertEqual(rec(a),rec(b))
 # 		
 	
+
+class TestImport(unittest.TestCase):
+	def setUp(self):
+		self.connection = connect()
+		self.trans = self.connection.begin()
+		self.S = nested_session(self.connection)
+	
+	def tearDown(self):
+		self.S.close()
+		self.trans.rollback()
+		self.connection.close()
+	
+	def test_rejects(self):
+		import os
+		from tempfile import NamedTemporaryFile
+		from databarc.importer import Importer, MultiImporter, DMI_subd
+		fd = dict(DMI_subd)
+		fd[0] = 'station'
+		# the last line repeats the timestamp of the first one of its station
+		s = 'stat\tyear\n99991\t2000\t2\t28\t6\t90\n99992\t2000\t2\t28\t6\t80\n99992\t2000\t2\t28\t7\t70\n99991\t2000\t2\t28\t6\t91\n'
+		with NamedTemporaryFile(suffix='.txt') as file, NamedTemporaryFile() as rejects:
+			file.write(s)
+			file.flush()
+			Importer.rejects = rejects.name
+			try:
+				with open(file.name) as f:
+					Imp = MultiImporter(self.S, 'TEST', fd, f, delimiter='\t')
+					Imp.do(self.S)
+			finally:
+				Importer.rejects = None
+			rows = [l.split('\t') for l in rejects]
+		self.assertEqual([r[:5] for r in rows], [[os.path.basename(file.name), '5', 'd', '2000-02-28 06:00:00', '91']])
+		self.assertEqual(sum(i.committed for i in Imp.importers.values()), 3)
+
+
+class TestBlockParser(unittest.TestCase):
+	def test_dmi(self):
+		from datetime import datetime
+		from databarc.parser import BlockParser
+		from databarc.importer import DMI_subd
+		b = BlockParser(DMI_subd, '\t').parse('stat\tyear\n4360\t2000\t2\t29\t6\t 90\t\t1e3\n4360\t2000\t2\t30\t6\t1\n')
+		self.assertEqual(list(b.valid), [False, True, False])
+		self.assertEqual(b.t[1].tolist(), datetime(2000,2,29,6))
+		self.assertEqual((b.x[5][1], b.ok[5][1], b.ok[6][1], b.ok[7][1]), (90, True, False, False))
+
+	def test_compile_row(self):
+		from datetime import datetime
+		from databarc.parser import compile_row, SKIP
+		from databarc.importer import NCDC_isd_lite
+		row, keys = compile_row(NCDC_isd_lite)
+		t, x = row('2015 01 01 06   -56  -99  10200 -9999', 0)
+		x = dict(zip(keys, x))
+		self.assertEqual((t, x[(13,19)], x[(25,31)], x[(31,37)], x[(37,43)]), (datetime(2015,1,1,6), -56, 10200, SKIP, SKIP))
+		self.assertIsNone(row('header', 1))
+
+	def test_row_parser(self):
+		from databarc.parser import BlockParser, RowParser
+		from databarc.importer import DMI_subd
+		s = 'stat\tyear\n4360\t2000\t2\t29\t6\t 90\t\t1e3\n4360\t2000\t2\t30\t6\t1\n'
+		a = BlockParser(DMI_subd, '\t').parse(s)
+		b = list(RowParser(DMI_subd, '\t').blocks(s.splitlines(True)))[0]
+		self.assertEqual((list(b.valid), b.t[1], b.lines, b.end), (list(a.valid), a.t[1], 3, len(s)))
+		self.assertEqual([(b.x[k][1], b.ok[k][1]) for k in (5,6,7)], [(a.x[k][1], a.ok[k][1]) for k in (5,6,7)])
+
+	def test_station(self):
+		import numpy as np
+		from databarc.parser import BlockParser, RowParser
+		from databarc.importer import DMI_subd
+		fd = dict(DMI_subd)
+		fd[0] = 'station'
+		s = 'stat\tyear\n4360\t2000\t2\t28\t6\t90\n4220\t2000\t2\t28\t6\t80\nx\t2000\t2\t28\t7\t1\n'
+		for b in (BlockParser(fd, '\t').parse(s), list(RowParser(fd, '\t').blocks(s.splitlines(True)))[0]):
+			self.assertEqual((list(b.valid), list(b.station[1:3])), ([False, True, True, False], [4360, 4220]))
+			b.line = np.arange(10, 14)
+			c = b.select(b.station==4220)
+			self.assertEqual((c.lines, list(c.x[5]), c.failed, list(c.line)), (1, [80], [], [12]))
+
+	def test_line_ranges(self):
+		import numpy as np
+		from tempfile import TemporaryFile
+		from databarc.parser import BlockParser, RowParser, line_ranges
+		from databarc.importer import NCDC_isd_lite
+		s = ''.join('2015 01 {:02d} {:02d}   -56  -99  10200 -9999\n'.format(d,h) for d in range(1,29) for h in range(24))
+		with TemporaryFile() as file:
+			file.write(s)
+			r = line_ranges(file, 1000)
+			self.assertEqual((r[0][0], r[-1][1]), (0, len(s)))
+			self.assertTrue(all(a[1]==b[0] and s[b[0]-1]=='\n' for a,b in zip(r, r[1:])))
+			for P in (BlockParser, RowParser):
+				t = [b.t for a,e in r for b in P(NCDC_isd_lite).blocks(file, a, e)]
+				self.assertEqual(sum(len(x) for x in t), 28*24)
+				self.assertTrue((np.diff(np.concatenate(t)).astype(int)==3600*10**6).all())
+
+	def test_read(self):
+		from databarc.parser import read
+		from databarc.importer import NCDC_isd_lite
+		s = ''.join('2015 01 01 {:02d}   {:3d}  -99  10200 -9999\n'.format(h,h) for h in range(24))
+		c = read(iter(('header\n'+s).splitlines(True)), NCDC_isd_lite)
+		self.assertEqual((len(c['temp isd NCDC'].t), c['temp isd NCDC'].ok.sum(), c['dir isd NCDC'].missing.sum()), (24, 24, 24))
+		self.assertEqual(list(c['temp isd NCDC'].x[:3]), [0, 1, 2])
+
+	def test_scaled(self):
+		from tempfile import TemporaryFile
+		from databarc.schema import Record_num
+		from databarc.parser import BlockParser, RowParser
+		from databarc.importer import DMI_subd
+		fd = dict(DMI_subd)
+		fd[9] = dict(fd[9], type=Record_num)
+		cells = ['1.5', '-0.25', '12.34567', '-0.00005', '+4.', '.5', '1e3', 'nan']
+		s = 'stat\tyear\n' + ''.join('4360\t2000\t2\t28\t{}\t90\t5\t9\t1\t{}\n'.format(i, c) for i,c in enumerate(cells))
+		with TemporaryFile() as file:
+			file.write(s)
+			file.seek(0)
+			a = list(BlockParser(fd, '\t').blocks(file))[0]
+		b = list(RowParser(fd, '\t').blocks(s.splitlines(True)))[0]
+		for c in (a, b):
+			self.assertEqual(list(c.x[9][c.ok[9]]), [15000, -2500, 123457, -1, 40000, 5000, 10000000])
+		self.assertEqual(str(Record_num.from_scaled(-2500)), '-0.2500')
+
+	def test_sort(self):
+		from databarc.importer import _Sorter
+		s = _Sorter(3)
+		s.extend([(0, 5, 0, 1.), (1, 2, 1, 7.), (0, 2, 2, 3.)])
+		s.add((0, 5, 3, 2.))
+		s.extend([(0, 1, 4, 4.), (0, 5, 5, 0.)])
+		self.assertEqual(list(s.merged('last')), [(0, 1, 4, 4.), (0, 2, 2, 3.), (0, 5, 0, 0.), (1, 2, 1, 7.)])
+		self.assertEqual(s.count, 6)
+
+
+class TestBinning(unittest.TestCase):
+	def test_daily(self):
+		from datetime import datetime, timedelta
+		from databarc.aggregator import Daily_aggregator
+		class O(object): pass
+		a = Daily_aggregator.__new__(Daily_aggregator)
+		a.parent, a.field, a.bins = O(), O(), []
+		a.field.zero_hour, a.field.zero_incl, a.field.postpone = 6, True, timedelta(0)
+		t = [datetime(2000,1,1,h) for h in (0,6,18)] + [datetime(2000,3,1,h) for h in (5,6)]
+		a.parent.records = [O() for _ in t]
+		for r,s in zip(a.parent.records, t): r.t = s
+		a.step = a.finish = lambda: a.bins.append((a.t.day, a.t.month, [r.t.hour for r in a.bin]))
+		a.run()
+		self.assertEqual(a.bins, [(31, 12, [0]), (1, 1, [6, 18]), (29, 2, [5]), (1, 3, [6])])
+
+	def test_monthly_resume(self):
+		from datetime import datetime
+		from databarc.aggregator import Monthly_aggregator
+		class O(object): pass
+		a = Monthly_aggregator.__new__(Monthly_aggregator)
+		a.parent, a.field, a.bins = O(), O(), []
+		a.field.zero_incl, a.resume = False, datetime(2000,1,1)
+		t = [datetime(2000,2,1,6), datetime(2000,2,1,12), datetime(2000,3,1,6)]
+		a.parent.records = [O() for _ in t]
+		for r,s in zip(a.parent.records, t): r.t = s
+		a.step = a.finish = lambda: a.bins.append((a.t.month, [(r.t.month, r.t.hour) for r in a.bin]))
+		a.run()
+		self.assertEqual(a.bins, [(1, [(2, 6)]), (2, [(2, 12), (3, 6)])])
+
+
+class TestScheduler(unittest.TestCase):
+	def test_order(self):
+		from databarc.aggregator import _Scheduler
+		class O(object):
+			def __init__(self, code, station_id):
+				self.code, self.station_id, self.source, self.name = code, station_id, 'DMI', code
+		aggr = {'d': {'aux_fields': ['f']}, 'f': {}, 'r': {'aux_fields': ['x']}, 'x': {'aux_fields': ['f']}}
+		s = _Scheduler([O('d', 1), O('r', 1), O('f', 1), O('d', 2), O('t', 1)], aggr)
+		self.assertEqual(s.order, [('f', 1, 'DMI'), ('d', 1, 'DMI'), ('r', 1, 'DMI'), ('d', 2, 'DMI')])
+		self.assertEqual(s.components(), [[('f', 1, 'DMI'), ('d', 1, 'DMI')], [('r', 1, 'DMI')], [('d', 2, 'DMI')]])
+		aggr['f']['aux_fields'] = ['r']
+		self.assertRaisesRegexp(Exception, 'Circular auxiliary fields: r -> x -> f -> r', _Scheduler, [O(c, 1) for c in 'rxf'], aggr)
+		self.assertRaisesRegexp(Exception, 'multiplicity', _Scheduler, [O('d', 1), O('d', 1)], aggr)
+
+	def test_feed(self):
+		from threading import Thread
+		from databarc.aggregator import _Feed
+		class O(object): pass
+		a = O()
+		f = _Feed('f', 1)
+		t = Thread(target=lambda: [f.put(*x) for x in [(1, ['a']), (3, ['b']), (4, ['c']), (None, None)]])
+		t.start()
+		b = f.bins(a)
+		x = []
+		for a.t in (0, 1, 2, 3, 5, 6):
+			x.append(b.next())
+		t.join()
+		self.assertEqual(x, [[], ['a'], [], ['b'], [], []])
+		f = _Feed('f')
+		f.put(None, 'ValueError: x')
+		a.field = O()
+		a.field.name = 'd day'
+		self.assertRaisesRegexp(Exception, 'Auxiliary field f for field d day failed', f.bins(a).next)
+
+
+class TestMetrics(unittest.TestCase):
+	def test_merge(self):
+		from databarc.metrics import Metrics
+		a, b = Metrics(), Metrics()
+		a.count('lines_total', 3)
+		b.count('lines_total', 2)
+		b.count('failures_total', kind='datetime')
+		b.observe('commit_seconds', 0.5)
+		a.merge(b.snapshot(reset=True))
+		self.assertEqual(b.snapshot(), {'counters': {}, 'timers': {}})
+		self.assertEqual(a.prometheus().splitlines(), [
+			'# TYPE failures_total counter', 'failures_total{kind="datetime"} 1',
+			'# TYPE lines_total counter', 'lines_total 5',
+			'# TYPE commit_seconds summary', 'commit_seconds_sum 0.5', 'commit_seconds_count 1'
+		])
+
 		
 if __name__ == '__main__':
     unittest.main(exit=False)
\ No newline at end of file
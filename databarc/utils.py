@@ -10,7 +10,7 @@ def recX(session,op,value):
 
 def flags(session, flags):
 	"""
-Check if a flag already exists in database; create it if not.
+Check if a flag already exists in database; create it if not. All flags are looked up with one query, and the missing ones are created with one commit.
 
 :param session: a SQLAlchemy session object
 :type session: :class:`~sqla:sqlalchemy.orm.session.Session`
@@ -20,19 +20,50 @@ Check if a flag already exists in database; create it if not.
 :return: a list of :class:`~databarc.schema.Flag` objects
 :rtype: list
 	"""
-	fl = []
-	for f in flags:
-		try: 
-			flag = Flag(**f)
-			session.add(flag)
+	from sqlalchemy import or_
+	from sqlalchemy.exc import IntegrityError
+	if not flags:
+		return []
+	def find():
+		fl = session.query(Flag).filter(or_(*[and_(*[getattr(Flag,k)==v for k,v in f.iteritems()]) for f in flags])).all()
+		return [next((x for x in fl if all(getattr(x,k)==v for k,v in f.iteritems())), None) for f in flags]
+	fl = find()
+	new = dict((tuple(sorted(f.iteritems())), f) for f,x in zip(flags,fl) if x is None)
+	if new:
+		try:
+			session.add_all([Flag(**f) for f in new.values()])
 			session.commit()
-		except Exception: 
+		except IntegrityError:
+			# created concurrently by someone else
 			session.rollback()
-			flag = session.query(Flag).filter_by(**f).one()
-		fl.append(flag)
+		fl = find()
 	return fl
 
 
+def series(session, field):
+	"""
+Reads the timestamps and values of a field's records into :mod:`numpy` arrays with one query, without constructing :class:`~databarc.schema.Record` objects. The values of :class:`~databarc.schema.Record_num` records are read as scaled integers (see :attr:`~databarc.schema.Record_num.x_scaled`), so that no :class:`~decimal.Decimal` is created.
+
+:param session: a SQLAlchemy session object
+:type session: :class:`~sqla:sqlalchemy.orm.session.Session`
+
+:param field: the field
+:type field: :class:`~databarc.schema.Field`
+
+:return: ``datetime64[us]`` timestamps (in order) and values (``int64`` for :class:`~databarc.schema.Record_int` and :class:`~databarc.schema.Record_num`, ``float64`` for :class:`~databarc.schema.Record_float`, :obj:`object` if some values are ``NULL``)
+:rtype: tuple
+	"""
+	import numpy as np
+	kind = session.query(Record.type).filter(Record.field_id==field.id).limit(1).scalar()
+	if kind is None:
+		return np.zeros(0, 'datetime64[us]'), np.zeros(0)
+	cls = Record.__mapper__.polymorphic_map[kind].class_
+	x = cls.x_scaled if cls is Record_num else cls.x
+	rows = session.query(cls.t, x).filter(cls.field_id==field.id).order_by(cls.t).all()
+	t, x = zip(*rows)
+	return np.array(t, 'datetime64[us]'), np.array(x, object if None in x else np.float64 if kind=='float' else np.int64)
+
+
 def latest(obj=Field,lim=10):
 	from sqlalchemy import desc
 	return Session.query(obj).order_by(desc(obj.id)).limit(lim).all()
@@ -158,6 +189,7 @@ class _comp(object):
 		i = -1
 		n = 0
 		t = [r.t.date() for r in g.records]
+		Bin_range.load(f.records)
 		for r in f.records:
 			try: i = t.index(r.t.date()+timedelta(days=delta),i+1)
 			except: pass
@@ -170,7 +202,7 @@ class _comp(object):
 					if self.x[-1]+self.y[-1]==-1: self.trace += 1
 					else:
 						l = [r.t,self.x[-1],self.y[-1]]
-						for s in r.binned:
+						for s in r.sources:
 							l.extend((s.t.hour,s.info,s.x))
 						self.diff.append(l)
 				elif self.x[-1]==0 and self.y[-1]==0: self.zero += 1
@@ -10,7 +10,8 @@ setup(
 	packages=['databarc'],
 	zip_safe=False,
 	entry_points={'console_scripts':[
-		'databarc-create = databarc.scripts:create'
+		'databarc-create = databarc.scripts:create',
+		'databarc-restore = databarc.scripts:restore'
 	]},
 	install_requires=[
 		'sqlalchemy',